@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Measures a no-op `quark up` and the URL queries of `quark freeze` on a
+project with many git dependencies: the number of external commands spawned
+for each subproject, which is what dominates on platforms where starting a
+process is expensive, and the wall-clock time.
+
+Usage: python3 benchmarks/bench_git_update.py [-m MODULES] [-n RUNS] [-j JOBS]
+
+The report comes after the (verbose) output of the runs.
+"""
+
+import argparse
+import collections
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from os.path import abspath, basename, dirname, join
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from quark import aio  # noqa: E402
+from quark.subproject import Subproject, generate_cmake_script  # noqa: E402
+
+
+def git(*args, cwd=None):
+    subprocess.check_call(("git",) + args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def make_repo(path, conf=None):
+    os.makedirs(path)
+    git("-c", "init.defaultBranch=master", "init", "-q", cwd=path)
+    if conf is not None:
+        with open(join(path, "subprojects.quark"), "w") as f:
+            json.dump(conf, f)
+    with open(join(path, "CMakeLists.txt"), "w") as f:
+        f.write("project(%s)\n" % basename(path))
+    git("add", "-A", cwd=path)
+    git("-c", "user.name=bench", "-c", "user.email=bench", "commit", "-q", "-m", "init", cwd=path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-m", "--modules", type=int, default=20)
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("-j", "--jobs", type=int, default=1)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix="quark-bench-")
+    try:
+        names = ["mod%03d" % i for i in range(args.modules)]
+        for name in names:
+            make_repo(join(tmpdir, "repos", name))
+        make_repo(join(tmpdir, "repos", "root"), {
+            "depends": {name: {"url": "git+file://" + join(tmpdir, "repos", name)} for name in names},
+        })
+        dest = join(tmpdir, "checkout")
+        git("clone", "-q", "file://" + join(tmpdir, "repos", "root"), dest)
+        generate_cmake_script(dest, jobs=args.jobs)
+
+        spawns = collections.Counter()
+        real_run = aio.run
+
+        async def run(cmd, **kwargs):
+            # the queries to the remotes run out of the clones
+            spawns[cmd[1] if cmd[1] == "ls-remote" else basename(kwargs.get("cwd") or "")] += 1
+            return await real_run(cmd, **kwargs)
+
+        aio.run = run
+        samples = []
+        freeze_samples = []
+        try:
+            for _ in range(args.runs):
+                start = time.perf_counter()
+                generate_cmake_script(dest, jobs=args.jobs)
+                samples.append(time.perf_counter() - start)
+            spawns_up = dict(spawns)
+            spawns.clear()
+            for _ in range(args.runs):
+                root, modules = Subproject.load_dependency_tree(dest)
+                start = time.perf_counter()
+                aio.run_sync(aio.gather(*[mod.url_from_checkout_async() for mod in modules.values()]))
+                freeze_samples.append(time.perf_counter() - start)
+        finally:
+            aio.run = real_run
+        print("modules:                     %d" % args.modules)
+        print("quark up spawns per module:  %g" % statistics.mean(spawns_up.get(name, 0) / args.runs for name in names))
+        print("quark up spawns for root:    %g" % (spawns_up.get(basename(dest), 0) / args.runs))
+        print("quark up ls-remote calls:    %g" % (spawns_up.get("ls-remote", 0) / args.runs))
+        print("quark up (median):           %.1fms" % (statistics.median(samples) * 1000))
+        print("freeze spawns per module:    %g" % statistics.mean(spawns[name] / args.runs for name in names))
+        print("freeze URLs (median):        %.1fms" % (statistics.median(freeze_samples) * 1000))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Measures the startup time of the quark command line: the time it takes
+`quark <cmd> --help` to dispatch to a builtin command (in-process, versus
+the old re-spawn of a quark-<cmd> console script) and `quark` alone to
+list the available commands (with the plugin index warm, versus scanning
+PATH).
+
+Usage: python3 benchmarks/bench_startup.py [-n RUNS] [COMMAND...]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from os.path import abspath, dirname
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+# What quark.cli.main used to do: find quark-<cmd> in PATH and run it
+RESPAWN = """
+import shutil, subprocess, sys
+shutil.which('quark-' + sys.argv[1])
+subprocess.check_call([sys.executable, '-c', 'import sys; from quark.entrypoints import commands; '
+                       'dict(commands)[sys.argv[1]]()', sys.argv[1]] + sys.argv[2:])
+"""
+
+SCAN = "from quark import cli; cli.scan_plugins(cli.environ['PATH'].split(cli.pathsep))"
+
+
+def timeit(cmd, runs):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.check_call(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples), min(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-n", "--runs", type=int, default=20)
+    parser.add_argument("commands", nargs="*", default=["query", "status", "update"])
+    args = parser.parse_args()
+
+    cases = []
+    for cmd in args.commands:
+        cases.append(("quark %s --help (in-process)" % cmd, [sys.executable, "-m", "quark", cmd, "--help"]))
+        cases.append(("quark %s --help (re-spawn)" % cmd, [sys.executable, "-c", RESPAWN, cmd, "--help"]))
+    # the listing exits with 1
+    cases.append(("quark (plugin index)", [sys.executable, "-c", "import sys; sys.argv = ['quark']\n"
+                                           "from quark import cli\ntry: cli.main()\nexcept SystemExit: pass"]))
+    cases.append(("quark (PATH scan)", [sys.executable, "-c", SCAN]))
+
+    print("%-40s %10s %10s" % ("", "median", "min"))
+    for name, cmd in cases:
+        median, best = timeit(cmd, args.runs)
+        print("%-40s %8.1fms %8.1fms" % (name, median * 1000, best * 1000))
+
+
+if __name__ == "__main__":
+    main()
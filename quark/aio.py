@@ -0,0 +1,206 @@
+"""
+Asyncio-based execution of the external commands (git, svn, ...).
+
+All the commands run on a single event loop, living in a background thread,
+and at most max_processes() of them run at the same time; coroutines can
+await run/check_call/check_output directly, possibly overlapping many of
+them with gather(), while synchronous code (including the worker threads of
+the updates) goes through run_sync().
+"""
+
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+
+from quark import ssh
+from quark.utils import print_cmd
+
+# Before Python 3.8 asyncio can't spawn processes from an event loop that
+# isn't in the main thread (nor, on Windows, from the default loop); there
+# the commands are run by a thread pool on behalf of the loop instead.
+NATIVE_SUBPROCESS = sys.version_info >= (3, 8)
+
+_lock = threading.Lock()
+_loop = None
+_loop_thread = None
+_semaphore = None
+_host_semaphores = {}
+# Per host, set once the first SSH master connection towards it is up
+_masters = {}
+
+
+def max_processes():
+    """Maximum number of external commands running at the same time."""
+    return int(os.environ.get("QUARK_MAX_PROCESSES", str(4 * (os.cpu_count() or 1))))
+
+
+def get_loop():
+    global _loop, _loop_thread
+    with _lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+
+            def serve():
+                asyncio.set_event_loop(loop)
+                loop.run_forever()
+
+            _loop_thread = threading.Thread(target=serve, name="quark-aio")
+            _loop_thread.daemon = True
+            _loop_thread.start()
+            _loop = loop
+        return _loop
+
+
+def _get_semaphore():
+    # Created lazily, as on old Pythons it binds to the current loop
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(max_processes())
+    return _semaphore
+
+
+def _get_host_semaphore(host):
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = _host_semaphores[host] = asyncio.Semaphore(ssh.max_per_host())
+    return semaphore
+
+
+async def run(cmd, cwd=None, env=None, stdin=None, stdout=None, stderr=None, check=True, comment="", host=None,
+              over_ssh=False):
+    """
+    Runs cmd, returning the (returncode, stdout, stderr) tuple (the outputs
+    are None unless the corresponding argument is subprocess.PIPE); if check
+    is set, a non-zero exit status raises CalledProcessError.
+    host is the server cmd talks with, if any: the commands towards the same
+    server are limited and, if over_ssh is set (it's reached over SSH), share
+    its SSH connection (see quark.ssh).
+    """
+    print_cmd(cmd, comment, cwd=cwd)
+    if host is None:
+        return await _run(cmd, cwd, env, stdin, stdout, stderr, check)
+    # The server slot comes first, waiting for it mustn't hold a process slot
+    async with _get_host_semaphore(host):
+        if not over_ssh or ssh.host_dir(host) is None:
+            return await _run(cmd, cwd, env, stdin, stdout, stderr, check)
+        env = ssh.environ(env, host)
+        master = _masters.get(host)
+        if master is not None:
+            await master.wait()
+            return await _run(cmd, cwd, env, stdin, stdout, stderr, check)
+        # The first command towards host opens the master connection; the
+        # others would race to do the same (and the losers would go without
+        # multiplexing), they wait for its socket to show up instead
+        master = _masters[host] = asyncio.Event()
+        task = asyncio.ensure_future(_run(cmd, cwd, env, stdin, stdout, stderr, check))
+        try:
+            while not task.done() and not ssh.has_master(host):
+                await asyncio.wait([task], timeout=0.05)
+        finally:
+            master.set()
+        return await task
+
+
+async def _run(cmd, cwd, env, stdin, stdout, stderr, check):
+    async with _get_semaphore():
+        if NATIVE_SUBPROCESS:
+            proc = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, env=env, stdin=stdin,
+                                                        stdout=stdout, stderr=stderr)
+            out, err = await proc.communicate()
+            returncode = proc.returncode
+        else:
+            def blocking():
+                proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdin=stdin, stdout=stdout, stderr=stderr)
+                out, err = proc.communicate()
+                return proc.returncode, out, err
+
+            returncode, out, err = await asyncio.get_event_loop().run_in_executor(None, blocking)
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd, out, err)
+    return returncode, out, err
+
+
+async def check_call(cmd, **kwargs):
+    await run(cmd, **kwargs)
+    return 0
+
+
+async def check_output(cmd, universal_newlines=False, **kwargs):
+    _, out, _ = await run(cmd, stdout=subprocess.PIPE, comment="captured", **kwargs)
+    return out.decode() if universal_newlines else out
+
+
+async def gather(*coros, return_exceptions=False):
+    return await asyncio.gather(*coros, return_exceptions=return_exceptions)
+
+
+class Batch:
+    """
+    Coalesces the queries about many targets issued together (e.g. by
+    gather() or by concurrent threads) into a single call of
+    run_batch(targets), a coroutine returning a dictionary mapping each
+    target to its result, or to the exception to raise for it.
+    """
+
+    def __init__(self, run_batch):
+        self.run_batch = run_batch
+        self.pending = {}
+
+    async def query(self, target):
+        # Only ever runs on the commands loop, no locking needed
+        loop = asyncio.get_event_loop()
+        if not self.pending:
+            loop.call_soon(lambda: asyncio.ensure_future(self._flush()))
+        future = self.pending.get(target)
+        if future is None:
+            future = self.pending[target] = loop.create_future()
+        return await future
+
+    async def _flush(self):
+        # Give the queries already scheduled a chance to join the batch
+        await asyncio.sleep(0)
+        pending, self.pending = self.pending, {}
+        try:
+            results = await self.run_batch(list(pending))
+        except Exception as ex:
+            results = {target: ex for target in pending}
+        for target, future in pending.items():
+            result = results.get(target, KeyError(target))
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class Memo:
+    """
+    Runs the query(key) coroutine at most once for each key, sharing its
+    result (or exception) between all the callers, including the ones
+    arriving while it's still running.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.tasks = {}
+
+    async def get(self, key):
+        # Only ever runs on the commands loop, no locking needed
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = asyncio.ensure_future(self.query(key))
+        return await task
+
+
+def start(coro):
+    """Starts coro on the commands loop without waiting for it."""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+
+def run_sync(coro):
+    """Runs coro on the commands loop, waiting for its result."""
+    loop = get_loop()
+    if threading.current_thread() is _loop_thread:
+        raise RuntimeError("run_sync called from the commands loop, await the coroutine instead")
+    return asyncio.run_coroutine_threadsafe(coro, loop).result()
@@ -1,7 +1,6 @@
 
 from urllib.parse import urlparse
 from argparse import ArgumentParser
-from .subproject import generate_cmake_script
 from os.path import abspath, basename
 from .utils import parse_option
 from os import getcwd
@@ -16,7 +15,10 @@ def run():
                         help="Print dependency tree in JSON format")
     parser.add_argument("-o", "--options", action='append',
                     help="set option value (will be taken into account when downloading optional dependencies)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of subprojects to fetch in parallel")
     optlist = parser.parse_args()
+    from .subproject import generate_cmake_script
     url = optlist.url
     options = {}
     if optlist.options:
@@ -24,7 +26,7 @@ def run():
             key, value = parse_option(option)
             options[key] = value
     source_dir = abspath(optlist.source_directory or (optlist.url and basename(urlparse(optlist.url).path)) or getcwd())
-    generate_cmake_script(source_dir, url, print_tree=optlist.verbose, options=options)
+    generate_cmake_script(source_dir, url, print_tree=optlist.verbose, options=options, jobs=optlist.jobs)
 
 if __name__ == "__main__":
     run()
\ No newline at end of file
@@ -1,33 +1,104 @@
+import json
+import os
 import sys
 from os import access, environ, pathsep, X_OK, listdir
-from os.path import isfile, split, join, abspath, basename, exists
-from shutil import which
-from subprocess import check_call, CalledProcessError
+from os.path import isfile, isdir, join
 
-def main():
+from quark.entrypoints import aliases, commands
+from quark.utils import mkdir, user_cache_dir
+
+# Bump whenever the layout of the index changes
+PLUGIN_INDEX_VERSION = 1
+
+def plugin_index_path():
+    return user_cache_dir("plugins.json")
+
+def scan_plugins(dirs):
+    """
+    Finds the quark-* executables in dirs (earlier directories win), except
+    for the console scripts of the builtin commands.
+    """
+    builtins = set(name for name, _ in commands + aliases)
+    exes = {}
+    for path in dirs:
+        try:
+            for entry in listdir(path):
+                if not entry.startswith('quark-'):
+                    continue
+                name = entry[len('quark-'):]
+                if os.name == 'nt':
+                    name = os.path.splitext(name)[0]
+                exe_file = join(path, entry)
+                if name not in builtins and name not in exes and isfile(exe_file) and access(exe_file, X_OK):
+                    exes[name] = exe_file
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            pass
+    return exes
+
+def plugins(refresh=False):
+    """
+    Returns the external quark-<name> commands found in PATH, as a name ->
+    path dictionary; the result is cached on disk and rebuilt only when PATH
+    or the modification time of any of its directories changes (or if
+    refresh is set).
+    """
+    dirs = [path for path in environ.get("PATH", "").split(pathsep) if path]
+    # Adding or removing a file changes the mtime of its directory
+    mtimes = [os.stat(path).st_mtime if isdir(path) else None for path in dirs]
+
+    index_path = plugin_index_path()
     try:
-        if len(sys.argv) > 1 and which('quark-' + sys.argv[1]):
-            check_call(['quark-' + sys.argv[1]] + sys.argv[2:])
-        else:
-            def is_exe(fpath):
-                return isfile(fpath) and access(fpath, X_OK)
-            exes = {}
-            for path in environ["PATH"].split(pathsep):
-                try:
-                    for entry in listdir(path):
-                        if not entry.startswith('quark-'):
-                            continue
-                        exe_file = join(path, entry)
-                        if is_exe(exe_file) and not entry in exes:
-                            exes[entry] = exe_file
-                except FileNotFoundError:
-                    pass
-            print('\nAvailable commands:\n')
-            for cmd in exes.keys():
-                print('    ' + cmd.replace('quark-', ''))
-    except CalledProcessError as cpe:
-        sys.exit(cpe.returncode)
+        if refresh:
+            raise IOError("refresh requested")
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if index["version"] == PLUGIN_INDEX_VERSION and index["dirs"] == dirs and index["mtimes"] == mtimes:
+            return index["plugins"]
+    except (IOError, OSError, ValueError, KeyError, TypeError):
         pass
 
+    exes = scan_plugins(dirs)
+    try:
+        mkdir(os.path.dirname(index_path))
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump({"version": PLUGIN_INDEX_VERSION, "dirs": dirs, "mtimes": mtimes, "plugins": exes}, f)
+        os.replace(index_path + '.tmp', index_path)
+    except (IOError, OSError):
+        # The index is just an optimization, never fail because of it
+        pass
+    return exes
+
+def print_commands(exes):
+    print('\nAvailable commands:\n')
+    for cmd in sorted(set(name for name, _ in commands) | set(exes.keys())):
+        print('    ' + cmd)
+
+def main():
+    cmd = sys.argv[1] if len(sys.argv) > 1 else ""
+    cmd = dict(aliases).get(cmd, cmd)
+    fn = dict(commands).get(cmd)
+    if fn:
+        # Builtin commands run in-process, with argparse showing "quark <cmd>"
+        sys.argv[:] = ["%s %s" % tuple(sys.argv[0:2])] + sys.argv[2:]
+        return fn()
+
+    exes = plugins()
+    if cmd and (cmd not in exes or not isfile(exes[cmd])):
+        # The index may be stale if PATH changed within the mtime granularity
+        exes = plugins(refresh=True)
+    if cmd in exes:
+        from subprocess import check_call, CalledProcessError
+
+        try:
+            check_call([exes[cmd]] + sys.argv[2:])
+        except CalledProcessError as cpe:
+            sys.exit(cpe.returncode)
+        return
+
+    if cmd:
+        print("Unknown command: %s" % cmd)
+    print_commands(exes)
+    sys.exit(1)
+
 if __name__ == "__main__":
     main()
@@ -1,13 +1,29 @@
-from quark import checkout, freeze, status, update, mirror, foreach, query
+from importlib import import_module
+
+
+class Command:
+    """
+    Entry point of a command, given as "module:function"; the module is
+    imported only when the command is actually run, so that dispatching a
+    command doesn't pay for importing all the others.
+    """
+
+    def __init__(self, target):
+        self.target = target
+
+    def __call__(self, *args, **kwargs):
+        module, function = self.target.split(':')
+        return getattr(import_module(module), function)(*args, **kwargs)
+
 
 commands = [
-    ('checkout', checkout.run),
-    ('freeze', freeze.run),
-    ('status', status.run),
-    ('update', update.run),
-    ('mirror', mirror.run),
-    ('foreach', foreach.run),
-    ('query', query.run)
+    ('checkout', Command('quark.checkout:run')),
+    ('freeze', Command('quark.freeze:run')),
+    ('status', Command('quark.status:run')),
+    ('update', Command('quark.update:run')),
+    ('mirror', Command('quark.mirror:run')),
+    ('foreach', Command('quark.foreach:run')),
+    ('query', Command('quark.query:run'))
 ]
 
 aliases = [('co', 'checkout'),
@@ -20,9 +36,9 @@ aliases = [('co', 'checkout'),
 def mk_setup_entry_points():
     res = ["quark=quark.cli:main"]
     for cmd, fn in commands:
-        res.append("quark-%s=%s:%s" % (cmd, fn.__module__, fn.__qualname__))
+        res.append("quark-%s=%s" % (cmd, fn.target))
     dcommands = dict(commands)
     for alias, cmd in aliases:
         fn = dcommands[cmd]
-        res.append("quark-%s=%s:%s" % (alias, fn.__module__, fn.__qualname__))
+        res.append("quark-%s=%s" % (alias, fn.target))
     return res
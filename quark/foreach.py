@@ -3,11 +3,20 @@
 import os
 import sys
 import subprocess
+import threading
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
-from quark.utils import DirectoryContext
 
-from .subproject import Subproject
+def write_bytes(stream, data):
+    # Commands output is passed through as is, whatever its encoding
+    if hasattr(stream, "buffer"):
+        stream.flush()
+        stream.buffer.write(data)
+        stream.buffer.flush()
+    else:
+        stream.write(data.decode(errors="replace"))
+        stream.flush()
 
 
 def run():
@@ -40,6 +49,23 @@ def run():
         action="append",
         help="Only iterate on the projects of the given type (git/svn); if repeated, all the specified types are matched"
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Run the command in up to JOBS subprojects at the same time; the output of each subproject is "
+             "collected and printed in order once it's done"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Print the output as soon as it's produced, prefixing each line with the subproject name"
+    )
+    parser.add_argument(
+        "-k", "--keep-going",
+        action="store_true",
+        help="Don't stop at the first failure, run the command everywhere and report all the failures at the end"
+    )
     parser.add_argument(
         "command",
         action="store",
@@ -48,27 +74,118 @@ def run():
     )
 
     optlist = parser.parse_args()
+    from .subproject import Subproject
 
-    root, modules = Subproject.create_dependency_tree(
-        os.getcwd(), update=False
-    )
+    toplevel = os.getcwd()
+    root, modules = Subproject.load_dependency_tree(toplevel)
+    # Set at the first failure (unless --keep-going), no new command is started afterwards
+    stop = threading.Event()
+    output_lock = threading.Lock()
+
+    def finished(returncode):
+        # Don't wait for the output of the previous subprojects to be
+        # printed to stop starting new commands
+        if returncode and not optlist.keep_going:
+            stop.set()
+        return returncode
 
-    for path, module in sorted(modules.items()):
+    def module_env(module):
         cmd_env = dict(os.environ)
-        cmd_env.update(module.get_env_variables(toplevel=os.getcwd()))
+        cmd_env.update(module.get_env_variables(toplevel=toplevel))
         if optlist.type and cmd_env['version_control'] not in optlist.type:
-            continue
-
-        with DirectoryContext(module.directory):
-            if not optlist.quiet:
-                sys.stdout.write("Entering {}\n".format(cmd_env["name"]))
-                sys.stdout.flush()
-
-            subprocess.check_call(
-                optlist.command[0],
-                shell=True,
-                env=cmd_env
-            )
+            return None
+        return cmd_env
+
+    def announce(name):
+        if not optlist.quiet:
+            sys.stdout.write("Entering {}\n".format(name))
+            sys.stdout.flush()
+
+    def run_live(module):
+        cmd_env = module_env(module)
+        if cmd_env is None:
+            return None
+        announce(cmd_env["name"])
+        return subprocess.call(optlist.command[0], shell=True, cwd=module.directory, env=cmd_env)
+
+    def run_captured(module):
+        if stop.is_set():
+            return None
+        cmd_env = module_env(module)
+        if cmd_env is None:
+            return None
+        proc = subprocess.Popen(optlist.command[0], shell=True, cwd=module.directory, env=cmd_env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        return finished(proc.returncode), out, err
+
+    def run_streamed(module):
+        if stop.is_set():
+            return None
+        cmd_env = module_env(module)
+        if cmd_env is None:
+            return None
+        prefix = (cmd_env["name"] + ": ").encode()
+        proc = subprocess.Popen(optlist.command[0], shell=True, cwd=module.directory, env=cmd_env,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def pump(pipe, stream):
+            for line in iter(pipe.readline, b""):
+                if not line.endswith(b"\n"):
+                    line += b"\n"
+                with output_lock:
+                    write_bytes(stream, prefix + line)
+
+        stderr_pump = threading.Thread(target=pump, args=(proc.stderr, sys.stderr))
+        stderr_pump.start()
+        pump(proc.stdout, sys.stdout)
+        stderr_pump.join()
+        return finished(proc.wait())
+
+    failures = []
+
+    def check(name, returncode):
+        if returncode:
+            failures.append((name, returncode))
+            if not optlist.keep_going:
+                stop.set()
+
+    selected = sorted(modules.items())
+    if optlist.jobs <= 1 and not optlist.stream:
+        for name, module in selected:
+            check(name, run_live(module))
+            if stop.is_set():
+                break
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, optlist.jobs)) as executor:
+            if optlist.stream:
+                futures = [(name, executor.submit(run_streamed, module)) for name, module in selected]
+                for name, future in futures:
+                    check(name, future.result())
+            else:
+                futures = [(name, executor.submit(run_captured, module)) for name, module in selected]
+                # In order, each subproject as soon as itself and the
+                # previous ones are done
+                for name, future in futures:
+                    result = future.result()
+                    if result is None:
+                        continue
+                    returncode, out, err = result
+                    announce(name)
+                    write_bytes(sys.stdout, out)
+                    write_bytes(sys.stderr, err)
+                    check(name, returncode)
+
+    if failures:
+        if optlist.keep_going:
+            sys.stderr.write("Command failed in {} subprojects:\n".format(len(failures)))
+            for name, returncode in failures:
+                sys.stderr.write("  {} (exit status {})\n".format(name, returncode))
+            sys.exit(1)
+        for name, returncode in failures:
+            sys.stderr.write("Command failed in {} (exit status {})\n".format(name, returncode))
+        # negative for commands killed by a signal
+        sys.exit(max(failures[0][1], 1))
 
 
 if __name__ == "__main__":
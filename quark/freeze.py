@@ -1,7 +1,6 @@
 import json
 from argparse import ArgumentParser
 from .utils import freeze_file
-from .subproject import Subproject
 from os.path import join
 from os import getcwd
 
@@ -10,11 +9,14 @@ def run():
     parser.add_argument("source_directory", metavar="SOURCE_DIR", nargs='?',
                         help="Specify the source directory", default=getcwd())
     optlist = parser.parse_args()
+    from .subproject import Subproject
 
-    root, modules = Subproject.create_dependency_tree(optlist.source_directory, update=False)
-    freeze_conf = {}
-    for name, mod in modules.items():
-        freeze_conf[name] = mod.url_from_checkout()
+    root, modules = Subproject.load_dependency_tree(optlist.source_directory)
+    names = sorted(modules.keys())
+    # The git/svn queries of all the modules run concurrently
+    from . import aio
+    urls = aio.run_sync(aio.gather(*[modules[name].url_from_checkout_async() for name in names]))
+    freeze_conf = dict(zip(names, urls))
     with open(join(root.directory, freeze_file), 'w') as f:
         json.dump(freeze_conf, f, indent=4, sort_keys = True)
 
@@ -0,0 +1,230 @@
+"""
+Reads the metadata of git clones (remotes, HEAD, refs) straight from the
+.git directory, sparing a git process for the most common questions.
+
+Only the plain layouts are handled: whenever something would make git
+itself answer differently (config includes, URL rewriting, per-worktree
+config, alternative ref storage, GIT_* environment overrides, ...) the
+functions raise Unsupported, and the caller is expected to ask git.
+"""
+
+import os
+import re
+from os.path import expanduser, isdir, isfile, join
+
+# Environment variables changing where git looks for repository and config
+ENV_OVERRIDES = ("GIT_DIR", "GIT_COMMON_DIR", "GIT_CONFIG", "GIT_CONFIG_GLOBAL", "GIT_CONFIG_SYSTEM",
+                 "GIT_CONFIG_NOSYSTEM", "GIT_CONFIG_COUNT", "GIT_CONFIG_PARAMETERS", "GIT_NAMESPACE")
+
+HASH_RE = re.compile(r'^(?:[0-9a-f]{40}|[0-9a-f]{64})$')
+
+
+class Unsupported(Exception):
+    """The repository layout isn't handled here, ask git instead."""
+
+
+def find(worktree):
+    """
+    Returns the (git_dir, common_dir) couple of the clone checked out in
+    worktree; they differ only for worktrees made with `git worktree add`,
+    whose .git is a file pointing to their private directory.
+    """
+    if any(var in os.environ for var in ENV_OVERRIDES):
+        raise Unsupported("git environment overrides")
+    dotgit = join(worktree, '.git')
+    if isdir(dotgit):
+        git_dir = dotgit
+    elif isfile(dotgit):
+        with open(dotgit, 'r') as f:
+            content = f.read().strip()
+        if not content.startswith('gitdir: '):
+            raise Unsupported("unknown .git file format")
+        git_dir = join(worktree, content[len('gitdir: '):])
+    else:
+        raise Unsupported("not a git clone")
+    common_dir = git_dir
+    try:
+        with open(join(git_dir, 'commondir'), 'r') as f:
+            common_dir = join(git_dir, f.read().strip())
+    except FileNotFoundError:
+        pass
+    return os.path.normpath(git_dir), os.path.normpath(common_dir)
+
+
+def parse_value(raw):
+    # Quotes, escapes and trailing comments, as in git-config(1)
+    value = []
+    quoted = False
+    i = 0
+    while i < len(raw):
+        c = raw[i]
+        if c == '"':
+            quoted = not quoted
+        elif c == '\\':
+            i += 1
+            if i == len(raw):
+                raise Unsupported("line continuations")
+            escape = raw[i]
+            if escape not in '"\\ntb':
+                raise Unsupported("invalid escape in config")
+            value.append({'n': '\n', 't': '\t', 'b': '\b'}.get(escape, escape))
+        elif c in '#;' and not quoted:
+            break
+        else:
+            value.append(c)
+        i += 1
+    if quoted:
+        raise Unsupported("unbalanced quotes in config")
+    return ''.join(value).strip()
+
+
+def read_config(path):
+    """
+    Parses a git config file into a dictionary mapping (section, subsection,
+    key) to the list of the values, with section and key lowercased and
+    subsection None when missing; keys without a value map to True.
+    """
+    entries = {}
+    section = subsection = None
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line.startswith('['):
+                m = re.match(r'^\[\s*([A-Za-z0-9.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\](.*)$', line)
+                if m is None:
+                    raise Unsupported("unparsable config section")
+                section, subsection, rest = m.groups()
+                if subsection is not None:
+                    subsection = re.sub(r'\\(.)', r'\1', subsection)
+                elif '.' in section:
+                    # deprecated [section.subsection] syntax
+                    section, subsection = section.split('.', 1)
+                section = section.lower()
+                line = rest.strip()
+                if not line or line[0] in '#;':
+                    continue
+            if section is None:
+                raise Unsupported("config entry outside of a section")
+            key, eq, raw = line.partition('=')
+            key = key.strip().lower()
+            if not re.match(r'^[a-z][a-z0-9-]*$', key):
+                raise Unsupported("unparsable config entry")
+            entries.setdefault((section, subsection, key), []).append(parse_value(raw) if eq else True)
+    return entries
+
+
+def repo_config(common_dir):
+    """
+    Reads the repository config, refusing the features that would require
+    to look elsewhere.
+    """
+    config = read_config(join(common_dir, 'config'))
+    for section, subsection, key in config:
+        if section in ('include', 'includeif'):
+            raise Unsupported("config includes")
+        if section == 'extensions' and key in ('worktreeconfig', 'refstorage'):
+            raise Unsupported("extensions.%s" % key)
+    return config
+
+
+def user_config_paths():
+    xdg = os.environ.get('XDG_CONFIG_HOME') or join(expanduser('~'), '.config')
+    return [join(xdg, 'git', 'config'), join(expanduser('~'), '.gitconfig'), '/etc/gitconfig']
+
+
+def check_no_rewrites(config):
+    """
+    Raises Unsupported if any of config or of the user/system configs may
+    rewrite URLs (url.<base>.insteadOf) or include other files.
+    """
+    if any(section == 'url' for section, _, _ in config):
+        raise Unsupported("URL rewriting")
+    for path in user_config_paths():
+        try:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                content = f.read().lower()
+        except (IOError, OSError):
+            continue
+        if 'insteadof' in content or 'include' in content:
+            raise Unsupported("URL rewriting or includes in %s" % path)
+
+
+def remote_url(worktree, remote='origin', rewrite=True):
+    """
+    URL of the given remote of the clone in worktree, as in `git remote
+    get-url` (or as in `git config --get remote.<remote>.url` if rewrite is
+    False).
+    """
+    _, common_dir = find(worktree)
+    config = repo_config(common_dir)
+    if rewrite:
+        check_no_rewrites(config)
+    urls = config.get(('remote', remote, 'url'))
+    if not urls or urls[-1] is True:
+        raise Unsupported("no url for remote %s" % remote)
+    # git config --get returns the last value, git remote get-url the first
+    return urls[0] if rewrite else urls[-1]
+
+
+def read_ref(git_dir, common_dir, ref):
+    """
+    Resolves ref (HEAD or a full ref name) to the hash it points to,
+    following symbolic refs; returns None if the ref doesn't exist.
+    """
+    for _ in range(10):
+        # HEAD and the refs outside refs/ are private to each worktree
+        base = common_dir if ref.startswith('refs/') and not ref.startswith(('refs/bisect/', 'refs/worktree/')) \
+            else git_dir
+        try:
+            with open(join(base, ref), 'r') as f:
+                content = f.read().strip()
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            content = packed_refs(common_dir).get(ref)
+            if content is None:
+                return None
+        if content.startswith('ref: '):
+            ref = content[len('ref: '):]
+            continue
+        if not HASH_RE.match(content):
+            raise Unsupported("unknown content of ref %s" % ref)
+        return content
+    raise Unsupported("too many levels of symbolic refs")
+
+
+def symbolic_ref(git_dir, ref='HEAD'):
+    """
+    Full name of the ref a symbolic ref (HEAD, by default) points to, as in
+    `git symbolic-ref`; None if it's detached.
+    """
+    with open(join(git_dir, ref), 'r') as f:
+        content = f.read().strip()
+    if content.startswith('ref: '):
+        return content[len('ref: '):]
+    return None
+
+
+def packed_refs(common_dir):
+    refs = {}
+    try:
+        with open(join(common_dir, 'packed-refs'), 'r') as f:
+            for line in f:
+                if line.startswith(('#', '^')):
+                    continue
+                parts = line.split()
+                if len(parts) == 2:
+                    refs[parts[1]] = parts[0]
+    except FileNotFoundError:
+        pass
+    return refs
+
+
+def head_commit(worktree):
+    """Commit checked out in worktree, as in `git rev-parse HEAD`."""
+    git_dir, common_dir = find(worktree)
+    repo_config(common_dir)
+    commit = read_ref(git_dir, common_dir, 'HEAD')
+    if commit is None:
+        raise Unsupported("unborn HEAD")
+    return commit
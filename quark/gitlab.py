@@ -0,0 +1,475 @@
+import hashlib
+import http.client
+import json
+import logging
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+from contextlib import ExitStack, contextmanager
+from os.path import join
+
+from quark.utils import QuarkError
+
+logger = logging.getLogger(__name__)
+
+
+def max_connections():
+    """
+    Maximum number of parallel requests towards the same GitLab host (and thus
+    of parallel artifact downloads).
+    """
+    return int(os.environ.get("QUARK_GITLAB_MAX_CONNECTIONS", "4"))
+
+
+def request_timeout():
+    """
+    Seconds without any data from the GitLab server after which a request
+    (or the download of an artifact) is considered stalled.
+    """
+    return float(os.environ.get("QUARK_GITLAB_TIMEOUT", "60"))
+
+
+def download_retries():
+    """
+    How many times an interrupted download is resumed before giving up (the
+    count starts over whenever a retry makes some progress).
+    """
+    return int(os.environ.get("QUARK_DOWNLOAD_RETRIES", "5"))
+
+
+def download_backoff():
+    """Seconds to wait before the first retry, doubled at each further one."""
+    return float(os.environ.get("QUARK_DOWNLOAD_BACKOFF", "1"))
+
+
+class HTTPError(QuarkError):
+    def __init__(self, status, reason, url):
+        super().__init__("HTTP error %d (%s) for %s" % (status, reason, url))
+        self.status = status
+
+    @property
+    def transient(self):
+        return self.status >= 500 or self.status in (408, 429)
+
+
+class GitlabClient:
+    """
+    HTTP(S) client for the GitLab API of a given host, shared by all the
+    GitLab subprojects of a run.
+
+    Connections are kept alive and reused between requests (urlopen pays a
+    new TCP + TLS handshake every time), and at most max_connections requests
+    run at the same time towards the same host, so that parallel downloads
+    don't hammer the server.
+    """
+
+    TOKEN_HEADER = "PRIVATE-TOKEN"
+    MAX_REDIRECTS = 5
+
+    clients = {}
+    clients_lock = threading.Lock()
+
+    @staticmethod
+    def get(base_url, token):
+        key = (base_url, token)
+        with GitlabClient.clients_lock:
+            if key not in GitlabClient.clients:
+                GitlabClient.clients[key] = GitlabClient(base_url, token)
+            return GitlabClient.clients[key]
+
+    def __init__(self, base_url, token):
+        parsed = urllib.parse.urlparse(base_url)
+        self.base_url = base_url
+        self.scheme = parsed.scheme
+        self.netloc = parsed.netloc
+        self.token = token
+        self.slots = threading.BoundedSemaphore(max_connections())
+        self.timeout = request_timeout()
+        self.idle = []
+        self.lock = threading.Lock()
+        # Jobs of the latest successful pipeline of each (project, ref), and
+        # the locks making concurrent lookups of the same pipeline wait for
+        # the first one instead of repeating the same API calls
+        self.pipeline_jobs = {}
+        self.pipeline_locks = {}
+
+    def api_url(self, path):
+        return "%s/api/v4/%s" % (self.base_url, path.lstrip("/"))
+
+    def _connect(self):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+        return http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def _acquire_connection(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self._connect(), False
+
+    def _release_connection(self, conn, response):
+        # The connection can be reused only if the response has been
+        # consumed entirely and the server didn't ask to close it
+        if response is not None and response.isclosed() and not response.will_close:
+            with self.lock:
+                self.idle.append(conn)
+        else:
+            conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+    def _send(self, path, headers):
+        conn, reused = self._acquire_connection()
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.HTTPException, OSError):
+            conn.close()
+            if not reused:
+                raise
+        # The server dropped a kept-alive connection, try again on a new one
+        conn = self._connect()
+        try:
+            conn.request("GET", path, headers=headers)
+            return conn, conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+
+    @contextmanager
+    def request(self, path, headers=None):
+        """
+        GETs the given API path (relative to /api/v4), yielding the response
+        object; the connection goes back to the pool when the block ends.
+        """
+        url = self.api_url(path)
+        all_headers = {self.TOKEN_HEADER: self.token}
+        all_headers.update(headers or {})
+        with self.slots:
+            conn, response = None, None
+            try:
+                for _ in range(self.MAX_REDIRECTS + 1):
+                    parsed = urllib.parse.urlparse(url)
+                    if (parsed.scheme, parsed.netloc) != (self.scheme, self.netloc):
+                        # Artifacts may be served from an object storage on
+                        # another host: don't pool it and, most importantly,
+                        # don't send it our token
+                        foreign_headers = {k: v for k, v in all_headers.items() if k != self.TOKEN_HEADER}
+                        with urllib.request.urlopen(urllib.request.Request(url, headers=foreign_headers)) as foreign:
+                            yield foreign
+                        return
+                    conn, response = self._send(parsed._replace(scheme="", netloc="").geturl(), all_headers)
+                    if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                        url = urllib.parse.urljoin(url, response.getheader("Location"))
+                        response.read()
+                        self._release_connection(conn, response)
+                        conn, response = None, None
+                        continue
+                    if response.status >= 400:
+                        raise HTTPError(response.status, response.reason, url)
+                    yield response
+                    return
+                raise QuarkError("Too many redirects for %s" % self.api_url(path))
+            finally:
+                if conn is not None:
+                    self._release_connection(conn, response)
+
+    def get_json(self, path):
+        with self.request(path) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    def resolve_job_id(self, project: str, ref: str, job_name: str) -> str:
+        """
+        Finds the id of the given job in the latest successful pipeline for
+        ref; the jobs list is fetched once per (project, ref), so all the
+        artifacts coming from the same pipeline cost two API calls in total.
+        """
+        # NOTE: This method requires an API token. A CI job token isn't sufficient. As such, this
+        # should be called only when freezing or when a PAT is readily available.
+        key = (project, ref)
+        with self.lock:
+            lock = self.pipeline_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.pipeline_jobs:
+                # Latest successful pipeline for a given ref
+                pipeline = self.get_json("/projects/%s/pipelines?ref=%s&status=success&page=1&per_page=1" % (
+                    urllib.parse.quote_plus(project),
+                    urllib.parse.quote_plus(ref),
+                ))
+                if len(pipeline) != 1:
+                    raise QuarkError("Could not find latest successful pipeline for ref %s" % ref)
+                pipeline = pipeline[0]
+
+                # Jobs in latest pipeline
+                jobs = self.get_json("/projects/%s/pipelines/%s/jobs?scope=success&include_retried=true&page=1&per_page=100" % (
+                    urllib.parse.quote_plus(project),
+                    pipeline["id"],
+                ))
+                self.pipeline_jobs[key] = (pipeline["id"], {job["name"]: str(job["id"]) for job in reversed(jobs)})
+        pipeline_id, jobs = self.pipeline_jobs[key]
+        if job_name not in jobs:
+            raise QuarkError("Could not find job %s in pipeline %s" % (job_name, pipeline_id))
+        return jobs[job_name]
+
+
+class HashingReader:
+    """
+    File-like wrapper around a download computing its SHA1 while it's read,
+    optionally copying the data to output and reporting the progress every
+    progress_step bytes; this allows consuming the download as a stream (e.g.
+    extracting an archive on the fly) without reading it twice.
+    """
+
+    def __init__(self, reader, output=None, progress=None, progress_step=819200):
+        self.reader = reader
+        self.output = output
+        self.progress = progress
+        self.progress_step = progress_step
+        self.digestobj = hashlib.sha1()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.reader.read(size)
+        if data:
+            self.digestobj.update(data)
+            if self.output is not None:
+                self.output.write(data)
+            if self.progress and (self.size + len(data)) // self.progress_step != self.size // self.progress_step:
+                self.progress(self.size + len(data))
+            self.size += len(data)
+        return data
+
+    def drain(self, chunk_size=819200):
+        """Reads whatever is left of the download."""
+        while self.read(chunk_size):
+            pass
+
+    def hexdigest(self):
+        return self.digestobj.hexdigest()
+
+
+class Download:
+    """
+    File-like reader over a GitLab download which survives dropped
+    connections: when the response breaks off, it's resumed with a Range
+    request from the last byte received, up to download_retries() times with
+    exponential backoff.
+
+    If partial_dir is given, the received bytes are also kept there, so that
+    a download interrupted for good is resumed by the next run; the bytes
+    already on disk are handed out first, so that the reader still sees the
+    whole file (and e.g. can rebuild its SHA1). The download must then be
+    completed with finish().
+    """
+
+    CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+    def __init__(self, client, path, partial_dir=None):
+        self.client = client
+        self.path = path
+        self.partial_dir = partial_dir
+        self.retries = download_retries()
+        self.backoff = download_backoff()
+        self.failures = 0
+        self.work_dir = None
+        self.output = None
+        self.replay = None
+        self.replay_end = 0
+        self.stack = None
+        self.response = None
+        self.headers = None
+        self.state = {}
+        self.offset = 0  # bytes handed out
+        self.received = 0  # bytes handed out or waiting on disk to be replayed
+        self.total = None
+
+    @property
+    def persistent(self):
+        return self.work_dir is not None
+
+    def __enter__(self):
+        try:
+            if self.partial_dir:
+                self._claim()
+            self._reopen()
+        except BaseException:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _claim(self):
+        # Take the partial download away from its shared location, so that
+        # another quark downloading the same artifact meanwhile starts its own
+        parent = os.path.dirname(self.partial_dir)
+        try:
+            os.makedirs(parent, exist_ok=True)
+            work_dir = tempfile.mkdtemp(dir=parent, prefix=os.path.basename(self.partial_dir) + ".")
+        except OSError as err:
+            logger.warning("Can't keep partial download in %s: %s" % (parent, err))
+            return
+        try:
+            os.rmdir(work_dir)
+            os.rename(self.partial_dir, work_dir)
+            with open(join(work_dir, "state.json"), "r", encoding="utf-8") as fileobj:
+                self.state = json.load(fileobj)
+            if self.state.get("path") == self.path:
+                self.received = os.path.getsize(join(work_dir, "data"))
+        except (OSError, ValueError):
+            self.state = {}
+        if not self.received:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            os.mkdir(work_dir)
+            self.state = {}
+        self.work_dir = work_dir
+        self.output = open(join(work_dir, "data"), "r+b" if self.received else "wb")
+        self.output.seek(self.received)
+
+    def _open(self):
+        headers = {}
+        if self.received:
+            headers["Range"] = "bytes=%d-" % self.received
+            # Artifact URLs are immutable anyway, If-Range is just for good measure
+            validator = self.state.get("etag") or self.state.get("last_modified")
+            if validator:
+                headers["If-Range"] = validator
+        stack = ExitStack()
+        try:
+            response = stack.enter_context(self.client.request(self.path, headers))
+            skip = 0
+            if response.status == 206:
+                match = self.CONTENT_RANGE_RE.match(response.getheader("Content-Range") or "")
+                if not match or int(match.group(1)) != self.received:
+                    raise QuarkError("Unexpected Content-Range for %s" % self.path)
+                self.total = int(match.group(2)) + 1
+            else:
+                etag = response.getheader("ETag")
+                if self.offset == 0:
+                    # Nothing handed out yet, just start over
+                    self.received = 0
+                    if self.output is not None:
+                        self.output.seek(0)
+                        self.output.truncate()
+                elif etag and self.state.get("etag") and etag != self.state["etag"]:
+                    raise QuarkError("%s changed while downloading it" % self.path)
+                else:
+                    # The server doesn't support ranges
+                    skip = self.received
+                length = response.getheader("Content-Length")
+                self.total = int(length) if length else None
+                self.state = {
+                    "path": self.path,
+                    "etag": etag,
+                    "last_modified": response.getheader("Last-Modified"),
+                }
+                if self.persistent:
+                    with open(join(self.work_dir, "state.json"), "w", encoding="utf-8") as fileobj:
+                        json.dump(self.state, fileobj)
+            while skip:
+                data = response.read(min(skip, 819200))
+                if not data:
+                    raise http.client.IncompleteRead(b"", skip)
+                skip -= len(data)
+        except BaseException:
+            stack.close()
+            raise
+        self.stack, self.response = stack, response
+        if self.headers is None:
+            self.headers = response.headers
+        if self.received > self.offset and self.replay is None:
+            self.replay = open(join(self.work_dir, "data"), "rb")
+            self.replay_end = self.received
+
+    def _close_response(self):
+        if self.stack is not None:
+            self.stack.close()
+        self.stack, self.response = None, None
+
+    def _retryable(self, err):
+        if isinstance(err, HTTPError):
+            return err.transient
+        # socket.timeout, a stalled connection, is an OSError as well
+        return isinstance(err, (OSError, socket.timeout, http.client.HTTPException))
+
+    def _reopen(self, err=None):
+        while True:
+            if err is not None:
+                if not self._retryable(err) or self.failures >= self.retries:
+                    raise err
+                delay = self.backoff * 2 ** self.failures
+                self.failures += 1
+                logger.warning("Download of %s interrupted at %d bytes (%s), retrying in %gs" % (
+                    self.path, self.received, err, delay))
+                time.sleep(delay)
+            self._close_response()
+            try:
+                self._open()
+                return
+            except Exception as ex:
+                err = ex
+
+    def read(self, size=-1):
+        if self.replay is not None:
+            left = self.replay_end - self.offset
+            data = self.replay.read(left if size is None or size < 0 else min(size, left))
+            if data:
+                self.offset += len(data)
+                return data
+            self.replay.close()
+            self.replay = None
+        while True:
+            try:
+                data = self.response.read(None if size is None or size < 0 else size)
+                if not data and self.total is not None and self.received < self.total:
+                    # http.client just reports EOF when the connection drops
+                    raise http.client.IncompleteRead(b"", self.total - self.received)
+                break
+            except Exception as err:
+                self._reopen(err)
+        if data:
+            self.failures = 0
+            if self.output is not None:
+                self.output.write(data)
+            self.offset += len(data)
+            self.received += len(data)
+        return data
+
+    def finish(self, dest):
+        """
+        Moves the completed download to dest, returning whether it was kept
+        on disk at all (i.e. if the download is persistent).
+        """
+        if not self.persistent:
+            return False
+        self.output.close()
+        self.output = None
+        shutil.move(join(self.work_dir, "data"), dest)
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.work_dir = None
+        return True
+
+    def close(self):
+        self._close_response()
+        for fileobj in (self.replay, self.output):
+            if fileobj is not None:
+                fileobj.close()
+        self.replay, self.output = None, None
+        if self.work_dir is not None:
+            # Unfinished, leave it for the next run
+            try:
+                os.rename(self.work_dir, self.partial_dir)
+            except OSError:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.work_dir = None
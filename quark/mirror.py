@@ -1,26 +1,130 @@
 from argparse import ArgumentParser
-from .subproject import generate_cmake_script, Subproject
-from .utils import parse_option
+from concurrent.futures import ThreadPoolExecutor
+from .utils import MIRROR_MODES, mirror_files, reserve_stdout
+import json
 import os
 
+# Kept in the destination of incremental mirrors
+manifest_file = '.quark-mirror.json'
+# Bump whenever the layout of the manifest changes
+MANIFEST_VERSION = 1
+# --format -> tarfile stream mode
+ARCHIVE_FORMATS = {'tar': 'w|', 'tar.gz': 'w|gz', 'tar.xz': 'w|xz'}
+
+def load_manifest(dest_dir):
+    """
+    Returns the manifests of the last incremental mirror into dest_dir, as a
+    dictionary mapping the path of each module (relative to dest_dir) to
+    the manifest returned by its mirror method; empty if there's none.
+    """
+    try:
+        with open(os.path.join(dest_dir, manifest_file), 'r') as f:
+            data = json.load(f)
+        if data["version"] == MANIFEST_VERSION:
+            return data["modules"]
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return {}
+
+def store_manifest(dest_dir, modules):
+    path = os.path.join(dest_dir, manifest_file)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({"version": MANIFEST_VERSION, "modules": modules}, f)
+    os.replace(path + '.tmp', path)
+
+def mirror_tree(root, modules, dest_dir, previous=None, mode='copy', jobs=4):
+    """
+    Mirrors root and modules into dest_dir, running up to jobs modules at
+    the same time; returns the manifests of the modules, by path.
+    """
+    def relpath(mod):
+        return os.path.relpath(mod.directory, root.directory)
+
+    def mirror(mod, parents):
+        # A mirror may start by wiping its destination, wait for the ones
+        # of the enclosing modules
+        for future in parents:
+            future.result()
+        return mod.mirror(os.path.normpath(os.path.join(dest_dir, relpath(mod))),
+                          None if previous is None else previous.get(relpath(mod), {}), mode)
+
+    # Sorted, enclosing modules come first
+    ordered = sorted(modules, key=lambda mod: relpath(mod).split(os.sep))
+    futures = {}
+    # The root encloses everything, it's done before starting the others
+    manifests = {relpath(root): mirror(root, [])}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for mod in ordered:
+            parents = [future for path, future in futures.items()
+                       if (relpath(mod) + os.sep).startswith(path + os.sep)]
+            futures[relpath(mod)] = executor.submit(mirror, mod, parents)
+        for path, future in futures.items():
+            manifests[path] = future.result()
+    return manifests
+
+def write_archive(output, archive_format, root, modules, prefix='', jobs=4):
+    """
+    Writes to the output file object an archive of the versioned files of
+    root and modules, as a stream (no seeking nor temporary files).
+    """
+    import tarfile
+
+    # The listings are made in parallel, the archive is written in order
+    # as they come
+    ordered = [root] + sorted(modules, key=lambda mod: os.path.relpath(mod.directory, root.directory))
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        listings = executor.map(lambda mod: sorted(mod.versioned_entries()), ordered)
+        with tarfile.open(fileobj=output, mode=ARCHIVE_FORMATS[archive_format], format=tarfile.PAX_FORMAT) as tar:
+            for mod, entries in zip(ordered, listings):
+                base = os.path.join(prefix, os.path.relpath(mod.directory, root.directory))
+                for _, path, _ in entries:
+                    tar.add(os.path.join(mod.directory, path), arcname=os.path.normpath(os.path.join(base, path)),
+                            recursive=False)
+
 def run():
-    parser = ArgumentParser(description='Update all dependencies in a project source tree')
+    parser = ArgumentParser(description='Copy the versioned files of a project and of its dependencies')
     parser.add_argument("source_directory", metavar="SOURCE_DIR", nargs='?',
                         help="Specify the source directory")
     parser.add_argument('destination', metavar='destination', type=str,
-                        help='destination directory')
+                        help='destination directory, or archive file (- for the standard output) with --format')
+    parser.add_argument("--incremental", action="store_true",
+                        help="Copy only the files changed since the last incremental mirror into the same "
+                             "destination, and remove the ones gone; the state is kept in %s in the "
+                             "destination" % manifest_file)
+    parser.add_argument("--mode", choices=MIRROR_MODES, default='copy',
+                        help="Copy the files (the default), hard link them or make copy-on-write clones "
+                             "(reflink, on filesystems supporting them); links fall back to copies across "
+                             "filesystems. Notice that changes to hard linked files show up on both sides")
+    parser.add_argument("--format", choices=sorted(ARCHIVE_FORMATS),
+                        help="Write a single archive of all the files to destination instead of copying them")
+    parser.add_argument("--prefix", default='',
+                        help="With --format, directory to put all the files under in the archive")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of subprojects to mirror in parallel (default: 4)")
     optlist = parser.parse_args()
+    from .subproject import Subproject
+    if optlist.format and (optlist.incremental or optlist.mode != 'copy'):
+        parser.error("--incremental and --mode can't be used with --format")
     source_dir = optlist.source_directory or os.getcwd()
-    dest_dir = optlist.destination
+    dest = optlist.destination
 
-    root = Subproject.create("root", None, source_dir, {}, toplevel = True)
-    root.mirror(dest_dir)
+    root, modules = Subproject.load_dependency_tree(source_dir)
+    if optlist.format:
+        if dest == '-':
+            output = reserve_stdout('wb')
+        else:
+            output = open(dest, 'wb')
+        with output:
+            write_archive(output, optlist.format, root, modules.values(), optlist.prefix, optlist.jobs)
+        return
 
-    root, modules = Subproject.create_dependency_tree(source_dir, update=False)
-    for mod in (list(modules.values())):
-        relpath = os.path.relpath(mod.directory, source_dir)
-        dest_subdir = os.path.join(dest_dir, relpath)
-        mod.mirror(dest_subdir)
+    previous = load_manifest(dest) if optlist.incremental else None
+    manifests = mirror_tree(root, modules.values(), dest, previous, optlist.mode, optlist.jobs)
+    if optlist.incremental:
+        # Modules not in the tree anymore
+        for relpath in set(previous) - set(manifests):
+            mirror_files(source_dir, os.path.join(dest, relpath), {}, previous[relpath])
+        store_manifest(dest, manifests)
 
 if __name__ == "__main__":
     run()
@@ -26,7 +26,7 @@ def run():
 
     args = parser.parse_args()
     source_dir = os.path.join(os.path.abspath("."), '')
-    conf = load_conf(source_dir)
+    conf = load_conf(source_dir, revalidate_catalog=False)
     if conf is None:
         print("This is not a quark project. Aborting.")
         sys.exit(1)
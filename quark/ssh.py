@@ -0,0 +1,143 @@
+"""
+Sharing of the connections towards the git/svn servers.
+
+At most max_per_host() of the commands talking with the same server run at
+the same time (see aio.run), so that parallel updates don't trip its
+connection limits. If QUARK_SSH_MULTIPLEX is set, the ones going over SSH
+also share a single connection per host: the first opens an SSH master
+connection (ControlMaster), the others just open a session over it, sparing
+the handshake and the authentication. The masters last for the run, and are
+closed at exit.
+"""
+
+import atexit
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import urllib.parse
+from os.path import join
+
+from quark.utils import str2bool
+
+_lock = threading.Lock()
+_control_dir = None
+
+
+def max_per_host():
+    """
+    Maximum number of commands talking with the same server at the same
+    time; the default stays below the 10 sessions per connection allowed by
+    sshd (MaxSessions), which is what bounds multiplexed connections.
+    """
+    return int(os.environ.get("QUARK_MAX_PER_HOST", "8"))
+
+
+def multiplex_enabled():
+    # The Windows port of OpenSSH has no ControlMaster
+    return sys.platform != "win32" and str2bool(os.environ.get("QUARK_SSH_MULTIPLEX") or "no")
+
+
+def host_of(url):
+    """
+    Server a git remote or svn URL points to (lowercased), None for local
+    repositories.
+    """
+    if '://' in url:
+        parsed = urllib.parse.urlsplit(url)
+        return None if parsed.scheme == 'file' else parsed.hostname
+    # scp-like syntax, [user@]host:path (a single letter is a Windows drive)
+    m = re.match(r'^(?:[^@/]+@)?([^:/]{2,}):', url)
+    return m.group(1).lower() if m else None
+
+
+def uses_ssh(url):
+    """
+    Whether a git remote or svn URL is reached over SSH (ssh:// and
+    svn+ssh:// URLs, scp-like git remotes).
+    """
+    if '://' in url:
+        return urllib.parse.urlsplit(url).scheme.lower() in ('ssh', 'git+ssh', 'ssh+git', 'svn+ssh')
+    return host_of(url) is not None
+
+
+def control_dir():
+    """
+    Directory of the sockets of the master connections, created on first
+    use; None if multiplexing is disabled.
+    """
+    global _control_dir
+    if not multiplex_enabled():
+        return None
+    import tempfile
+
+    with _lock:
+        if _control_dir is None:
+            # Socket paths are limited to about 100 characters, stay out of
+            # the long TMPDIRs of macOS
+            _control_dir = tempfile.mkdtemp(prefix="quark-ssh-", dir="/tmp" if os.path.isdir("/tmp") else None)
+            atexit.register(close_masters)
+        return _control_dir
+
+
+def host_dir(host):
+    """
+    Directory of the sockets of the master connections towards host (one
+    per user and port), created on first use; None if multiplexing is
+    disabled.
+    """
+    directory = control_dir()
+    if directory is None:
+        return None
+    import hashlib
+
+    # Short, to stay within the limits of socket paths
+    directory = join(directory, hashlib.sha1(host.encode('utf-8')).hexdigest()[:8])
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def has_master(host):
+    """Whether a master connection towards host is already up."""
+    directory = host_dir(host)
+    return directory is not None and len(os.listdir(directory)) != 0
+
+
+def environ(env=None, host=None):
+    """
+    Returns env (by default, the current environment) with GIT_SSH_COMMAND
+    and SVN_SSH set to go through the master connection towards host, if
+    multiplexing is enabled; the ssh command already set there, if any, is
+    kept.
+    """
+    directory = None if host is None else host_dir(host)
+    if directory is None:
+        return env
+    env = dict(os.environ if env is None else env)
+    options = ['-o', 'ControlMaster=auto', '-o', 'ControlPath=' + join(directory, '%C'),
+               # masters left behind by a crash go away by themselves
+               '-o', 'ControlPersist=60']
+    # GIT_SSH (a program, without arguments) would be overridden
+    if "GIT_SSH" not in env or "GIT_SSH_COMMAND" in env:
+        # git runs it through the shell, svn splits it on whitespace
+        env["GIT_SSH_COMMAND"] = " ".join([env.get("GIT_SSH_COMMAND") or "ssh"] + [shlex.quote(o) for o in options])
+    env["SVN_SSH"] = " ".join([env.get("SVN_SSH") or "ssh -q"] + options)
+    return env
+
+
+def close_masters():
+    """Closes the master connections opened so far."""
+    global _control_dir
+    with _lock:
+        directory, _control_dir = _control_dir, None
+    if directory is None:
+        return
+    for subdir in os.listdir(directory):
+        for name in os.listdir(join(directory, subdir)):
+            # With an explicit socket the host doesn't matter
+            subprocess.call(['ssh', '-o', 'ControlPath=' + join(directory, subdir, name), '-O', 'exit', 'quark'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    shutil.rmtree(directory, ignore_errors=True)
@@ -1,7 +1,6 @@
 import json
 from argparse import ArgumentParser
 from .utils import freeze_file
-from .subproject import Subproject, url_from_directory
 from os.path import join
 from os import getcwd
 
@@ -10,8 +9,9 @@ def run():
     parser.add_argument("source_directory", metavar="SOURCE_DIR", nargs='?',
                         help="Specify the source directory", default=getcwd())
     optlist = parser.parse_args()
+    from .subproject import Subproject, url_from_directory
 
-    root, modules = Subproject.create_dependency_tree(optlist.source_directory, update=False)
+    root, modules = Subproject.load_dependency_tree(optlist.source_directory)
     root = Subproject.create("root", url_from_directory(root.directory), root.directory, {})
     for mod in ([root] + list(modules.values())):
         print("=== Status of %s" % mod.directory)
@@ -1,4 +1,7 @@
-import hashlib
+# NOTE: Modules needed only by some backend (archives, XML, HTTP, hashing) are
+# imported where they are used, so that commands which don't need them (e.g.
+# `quark query`, invoked many times by build systems) don't pay for them.
+import contextlib
 import itertools
 import json
 import logging
@@ -6,33 +9,31 @@ import os
 import shutil
 import stat
 import sys
-import tarfile
-import tempfile
+import threading
 import urllib.parse
-import urllib.request
-import xml.etree.ElementTree as ElementTree
-import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from os.path import exists, isdir, join
 from subprocess import PIPE, CalledProcessError, Popen, check_output
 from urllib.parse import urlparse
 
-from quark.utils import DirectoryContext as cd
+from quark import ssh
 from quark.utils import (
+    QuarkError,
     cmake_escape,
     dependency_file,
     fork,
+    artifact_cache_dir,
     freeze_file,
+    git_cache_dir,
     load_conf,
     log_check_output,
+    mirror_files,
     mkdir,
     print_msg,
 )
 
 logger = logging.getLogger(__name__)
 
-class QuarkError(RuntimeError):
-    pass
-
 def vcs_class(directory):
     if exists(join(directory, ".svn")):
         cls = SvnSubproject
@@ -61,6 +62,13 @@ Please remove it and re-run quark up.
 """ % (directory, proj_type))
 
 class Subproject:
+    # Whether updating this kind of subproject is just a download, that can
+    # be done in background even in a serial update
+    download_only = False
+    # Number of modules left alone because they were planned as no-op
+    skipped_updates = 0
+    stats_lock = threading.Lock()
+
     def get_env_variables(self, toplevel):
         sm_path = os.path.relpath(self.directory, toplevel)
         displaypath = os.path.relpath(self.directory, toplevel)
@@ -109,7 +117,7 @@ class Subproject:
         return res
 
     @staticmethod
-    def create_dependency_tree(source_dir, url=None, options=None, update=False, clean=False, clobber=False, fix_remotes=False):
+    def create_dependency_tree(source_dir, url=None, options=None, update=False, clean=False, clobber=False, fix_remotes=False, jobs=1, nested=False):
         # make sure the separator is present
         source_dir_rp = os.path.join(os.path.abspath(source_dir), '')
         clobber_backup_path = os.path.join(source_dir_rp, 'clobbered.quark')
@@ -123,13 +131,67 @@ class Subproject:
         root = Subproject.create("root", root_url, source_dir, {}, {}, toplevel = True)
         if url and update:
             root.checkout()
-        conf = load_conf(source_dir)
+        # Only quark up/checkout always ask the catalog server for changes
+        conf = load_conf(source_dir, revalidate_catalog=update)
         if conf is None:
             return root, {}
         subprojects_dir = conf.get("subprojects_dir", 'lib')
         subproject_dir = join(source_dir, subprojects_dir)
         stack = [root]
         modules = {}
+        # Updates of modules discovered but not yet expanded; they run in the
+        # background (if jobs > 1) while the tree walk goes on, and are waited
+        # for only when we actually need the module subprojects.quark
+        pending_updates = {}
+        executor = ThreadPoolExecutor(max_workers=jobs) if update and jobs > 1 else None
+        # Artifact downloads are just waiting on the network, and are already
+        # bounded per host by GitlabClient, so they always go in background
+        download_executor = []
+        # Modules discovered by the last expansion, their updates are
+        # scheduled all together once their remote queries are under way
+        discovered = []
+        if update and not nested:
+            # The remote refs and the state of the svn working copies are
+            # cached for the length of the update, external projects included
+            GitSubproject.remote_refs = None
+            SvnSubproject.wc_states = None
+
+        def planned_update(mod):
+            # Modules already in the wanted state cost nothing more than the plan
+            mod.plan = mod.plan_update(clean)
+            if mod.plan["action"] == "noop":
+                mod.update_skipped()
+            else:
+                mod.update(clean, fix_remotes)
+
+        def schedule_update(mod):
+            if mod.download_only:
+                if not download_executor:
+                    from quark.gitlab import max_connections
+                    download_executor.append(ThreadPoolExecutor(max_workers=max_connections()))
+                pending_updates[mod.name] = download_executor[0].submit(planned_update, mod)
+            elif executor is None:
+                planned_update(mod)
+            else:
+                pending_updates[mod.name] = executor.submit(planned_update, mod)
+
+        def schedule_discovered():
+            if discovered:
+                from quark import aio
+
+                # With a single job the remotes are asked one at a time
+                # anyway, by plan_update: asking them ahead would only add
+                # round trips (and concurrent credential prompts)
+                aio.start(aio.gather(*[mod.prefetch(remote=executor is not None) for mod in discovered],
+                                     return_exceptions=True))
+            for mod in discovered:
+                schedule_update(mod)
+            del discovered[:]
+
+        def wait_update(mod):
+            future = pending_updates.pop(mod.name, None)
+            if future is not None:
+                future.result()
 
         def get_option(key):
             try:
@@ -143,6 +205,21 @@ class Subproject:
                     err = e
             raise err
 
+        # Each module is expanded only once, even if it is required by several
+        # parents; however its optional dependencies may be enabled by options
+        # set later on (by any module, as get_option looks everywhere), so for
+        # each option we keep track of the optdepends blocks looking at it and
+        # of the value they were evaluated with, and re-evaluate them only if
+        # the option actually changes
+        optdepends_users = {}
+        optdepends_values = {}
+        changed_options = []
+        unset = object()
+
+        def option_changed(key):
+            if key in optdepends_users and key not in changed_options:
+                changed_options.append(key)
+
         def add_module(parent, name, uri, options, conf, **kwargs):
             if uri is None:
                 # options add only, lookup from existing modules
@@ -179,7 +256,10 @@ main project abspath: %s""" % (name, uri, source_dir, target_dir_rp, source_dir_
                             backup_path = '%s.%d' % (backup_path_base, i)
                         print('%s already present; moving it to %s before new checkout' % (name, backup_path))
                         shutil.move(mod.directory, backup_path)
-                    mod.update(clean, fix_remotes)
+                    discovered.append(mod)
+                for key in mod.options:
+                    option_changed(key)
+                stack.append(mod)
             else:
                 if newmodule.exclude_from_cmake != mod.exclude_from_cmake:
                     children_conf = [join(parent.directory, dependency_file) for parent in mod.parents]
@@ -200,12 +280,13 @@ main project abspath: %s""" % (name, uri, source_dir, target_dir_rp, source_dir_
 
                 else:
                     for key, value in options.items():
+                        if key not in mod.options:
+                            option_changed(key)
                         mod.options.setdefault(key, value)
                         if mod.options[key] != value:
                             raise ValueError(
                                 "Conflicting values option '%s' of module '%s'" % (key, mod.name)
                             )
-            stack.append(mod)
             parent.children.add(mod)
 
         freeze_conf = join(root.directory, freeze_file)
@@ -214,46 +295,96 @@ main project abspath: %s""" % (name, uri, source_dir, target_dir_rp, source_dir_
                 freeze_dict = json.load(f)
         else:
             freeze_dict = {}
-        if update:
-            mkdir(subproject_dir)
-        while len(stack):
-            current_module = stack.pop()
+
+        def do_add_module(parent, name, depobject):
+            external_project = depobject.get('external_project', False)
+            add_module(parent, name,
+                       freeze_dict.get(name, depobject.get('url', None)),
+                       depobject.get('options', {}),
+                       depobject,
+                       exclude_from_cmake=depobject.get('exclude_from_cmake', external_project),
+                       external_project=external_project
+                       )
+
+        def evaluate_optdepends(module, key, optobjects):
+            try:
+                value = get_option(key)
+            except KeyError:
+                value = unset
+            optdepends_values[(module.name, key)] = value
+            for optobject in optobjects:
+                if value is not unset and value == optobject['value']:
+                    for name, depobject in optobject['depends'].items():
+                        do_add_module(module, name, depobject)
+
+        def reevaluate_optdepends(key):
+            for module, optobjects in optdepends_users[key]:
+                try:
+                    value = get_option(key)
+                except KeyError:
+                    value = unset
+                if value != optdepends_values[(module.name, key)]:
+                    evaluate_optdepends(module, key, optobjects)
+
+        def expand_module(current_module):
             if current_module.external_project:
-                generate_cmake_script(current_module.directory, update = update, clean = clean, clobber = clobber, fix_remotes=fix_remotes)
-                continue
-            conf = load_conf(current_module.directory)
+                generate_cmake_script(current_module.directory, update = update, clean = clean, clobber = clobber, fix_remotes=fix_remotes, jobs=jobs, nested=True)
+                return
+            conf = load_conf(current_module.directory, revalidate_catalog=update)
             if conf:
                 if current_module.toplevel:
                     current_module.options = conf.get('toplevel_options', {})
                     if options:
                         current_module.options.update(options)
 
-                def do_add_module(name, depobject):
-                    external_project = depobject.get('external_project', False)
-                    add_module(current_module, name,
-                               freeze_dict.get(name, depobject.get('url', None)),
-                               depobject.get('options', {}),
-                               depobject,
-                               exclude_from_cmake=depobject.get('exclude_from_cmake', external_project),
-                               external_project=external_project
-                               )
-
                 for name, depobject in conf.get('depends', {}).items():
-                    do_add_module(name, depobject)
+                    do_add_module(current_module, name, depobject)
                 for key, optobjects in conf.get('optdepends', {}).items():
                     if isinstance(optobjects, dict):
                         optobjects = [optobjects]
-                    for optobject in optobjects:
-                        try:
-                            value = get_option(key)
-                        except KeyError:
-                            continue
-                        if value == optobject['value']:
-                            for name, depobject in optobject['depends'].items():
-                                do_add_module(name, depobject)
+                    optdepends_users.setdefault(key, []).append((current_module, optobjects))
+                    evaluate_optdepends(current_module, key, optobjects)
+
+        if update:
+            mkdir(subproject_dir)
+        try:
+            while len(stack) or len(changed_options):
+                if len(changed_options):
+                    reevaluate_optdepends(changed_options.pop(0))
+                    schedule_discovered()
+                    continue
+                current_module = stack.pop()
+                # the module subprojects.quark must be on disk before we can
+                # discover its children
+                wait_update(current_module)
+                expand_module(current_module)
+                schedule_discovered()
+        finally:
+            for e in [executor] + download_executor:
+                if e is not None:
+                    e.shutdown(wait=True)
         root.set_local_ignores(subprojects_dir, modules.values())
         return root, modules
 
+    @staticmethod
+    def load_dependency_tree(source_dir, options=None):
+        """
+        Read-only counterpart of create_dependency_tree: the resolved tree is
+        cached in the .quark directory of the project, and reused as long as
+        none of the subprojects.quark, freeze.quark, catalogs or options it
+        was resolved from changed.
+        """
+        from quark import treecache
+
+        source_dir = os.path.abspath(source_dir)
+        cached = treecache.load(source_dir, options)
+        if cached is not None:
+            return cached
+        root, modules = Subproject.create_dependency_tree(source_dir, options=options, update=False)
+        if load_conf(source_dir, revalidate_catalog=False) is not None:
+            treecache.store(source_dir, root, modules, options)
+        return root, modules
+
     def __init__(self, name=None, directory=None, options=None, conf={}, exclude_from_cmake=False, external_project=False, toplevel=False):
         self.conf = conf
         self.parents = set()
@@ -264,6 +395,8 @@ main project abspath: %s""" % (name, uri, source_dir, target_dir_rp, source_dir_
         self.exclude_from_cmake = exclude_from_cmake
         self.external_project = external_project
         self.toplevel = toplevel
+        # What the last update was planned to do (see plan_update)
+        self.plan = None
 
     def __hash__(self):
         return self.name.__hash__()
@@ -286,8 +419,62 @@ main project abspath: %s""" % (name, uri, source_dir, target_dir_rp, source_dir_
     def url_from_checkout(self, *args, **kwargs):
         return self.url_from_directory(directory = self.directory, *args, **kwargs)
 
-    def mirror(self, dest):
-        raise NotImplementedError()
+    async def url_from_checkout_async(self, include_commit = True):
+        # Backends running external commands override this to overlap them
+        return self.url_from_checkout(include_commit = include_commit)
+
+    def mirror(self, dest, previous=None, mode='copy'):
+        """
+        Copies the versioned files of the checkout into dest, linking them
+        instead if mode is 'hardlink' or 'reflink' (see utils.copy_file).
+
+        If previous is not None, it's the manifest returned by the last
+        mirror into dest, and only what changed since then is updated;
+        returns the manifest of this mirror (None for plain full mirrors,
+        which may skip building it).
+        """
+        mkdir(dest)
+        files = {}
+        for kind, path, blob in self.versioned_entries():
+            if kind == 'dir':
+                mkdir(join(dest, path))
+            else:
+                files[path] = blob
+        return mirror_files(self.directory, dest, files, previous, mode)
+
+    def versioned_entries(self):
+        """
+        Yields a (kind, path, blob) tuple for each file (kind 'file') and
+        directory (kind 'dir', if the VCS tracks them) of the checkout that
+        is under version control and on disk; path is relative to the
+        checkout and blob identifies the content of the file, if it's known
+        without reading it, or is None.
+        """
+        raise QuarkError("Don't know how to mirror '%s', it's not a git or svn checkout" % self.directory)
+
+    def plan_update(self, clean=False):
+        """
+        Tells what update would do, looking at the local checkout (and, for
+        refs that may have moved, at what they point to on the remote,
+        without fetching anything): a dictionary with the
+        "action" (one of "clone", "fetch", "checkout", "download",
+        "resolve", "noop" and "error") and possibly a human-readable
+        "reason". Modules planned as "noop" aren't updated at all.
+        """
+        return {"action": "fetch"}
+
+    def update_skipped(self):
+        """Called instead of update when plan_update said there's nothing to do."""
+        with Subproject.stats_lock:
+            Subproject.skipped_updates += 1
+
+    async def prefetch(self, remote=True):
+        """
+        Runs ahead the queries plan_update is going to need; the ones of all
+        the modules discovered together are started at once, so that they
+        overlap. Queries to the server are made only if remote is set.
+        """
+        pass
 
     def toJSON(self):
         return {
@@ -300,6 +487,18 @@ main project abspath: %s""" % (name, uri, source_dir, target_dir_rp, source_dir_
         pass
 
 class GitSubproject(Subproject):
+    # Number of fetches avoided because the required commit/tag was already
+    # in the local clone
+    skipped_fetches = 0
+    stats_lock = threading.Lock()
+    # Shared mirrors already refreshed during this run, and the locks that
+    # serialize their updates between threads
+    refreshed_mirrors = set()
+    mirror_locks = {}
+    # aio.Memo of the refs of each remote (see remote_ref), reset by every
+    # update
+    remote_refs = None
+
     def get_env_variables(self, toplevel):
         return {
             **super().get_env_variables(toplevel=toplevel),
@@ -332,6 +531,9 @@ class GitSubproject(Subproject):
         else:
             # "regular" URLs (drop git+ prefix and fragment)
             self.remote = url._replace(fragment='')._replace(scheme=url.scheme.replace('git+', '')).geturl()
+        # Server of the remote, for the commands talking with it
+        self.host = ssh.host_of(self.remote)
+        self.over_ssh = ssh.uses_ssh(self.remote)
 
     def same_checkout(self, other):
         if isinstance(other, GitSubproject) and (self.remote, self.ref, self.conf.get("shallow", False)) == (other.remote, other.ref, other.conf.get("shallow", False)):
@@ -352,11 +554,11 @@ class GitSubproject(Subproject):
             # We cannot straight clone a shallow repo using a commit hash (-b doesn't support it)
             # do the dance described at https://stackoverflow.com/a/43136160/214671
             os.mkdir(self.directory)
-            with cd(self.directory):
-                fork(['git', 'init'])
-                fork(['git', 'remote', 'add', 'origin', self.remote])
-                fork(['git', 'fetch', '--depth', '1', 'origin', self.noremote_ref()])
-                fork(['git', '-c', 'advice.detachedHead=false', 'checkout', self.ref, '--'])
+            fork(['git', 'init'], cwd=self.directory)
+            fork(['git', 'remote', 'add', 'origin', self.remote], cwd=self.directory)
+            fork(['git', 'fetch', '--depth', '1', 'origin', self.noremote_ref()], cwd=self.directory,
+                 host=self.host, over_ssh=self.over_ssh)
+            fork(['git', '-c', 'advice.detachedHead=false', 'checkout', self.ref, '--'], cwd=self.directory)
         else:
             # Regular case
             extra_opts = []
@@ -366,142 +568,473 @@ class GitSubproject(Subproject):
             # git clone -n + git checkout would suffice
             if shallow and self.ref_type != 'commit' and self.ref != 'origin/HEAD':
                 extra_opts += ['-b', self.noremote_ref()]
-            fork(['git', 'clone', '-n'] + extra_opts + ['--', self.remote, self.directory])
-            with cd(self.directory):
-                opts = [self.ref]
-                # If it's a branch, create a remote-tracking one
-                if self.ref_type == 'branch' and not shallow:
-                    # Find out a sensible local branch name (needed for origin/HEAD)
-                    local_branch = self.symbolic_full_name(self.ref).split('/origin/', 1)[1]
-                    opts = [ local_branch ]
-                fork(['git', '-c', 'advice.detachedHead=false', 'checkout'] + opts + ['--'])
+            mirror = None if shallow else self.refresh_shared_mirror()
+            if mirror:
+                # Borrow the objects from the shared mirror; the clone still
+                # talks with the real remote, but has almost nothing to download.
+                # No --dissociate: the clone keeps depending on the mirror (see
+                # the README), like the ones given it by use_shared_mirror
+                extra_opts += ['--reference', mirror]
+            fork(['git', 'clone', '-n'] + extra_opts + ['--', self.remote, self.directory], host=self.host, over_ssh=self.over_ssh)
+            opts = [self.ref]
+            # If it's a branch, create a remote-tracking one
+            if self.ref_type == 'branch' and not shallow:
+                # Find out a sensible local branch name (needed for origin/HEAD)
+                local_branch = self.resolve_remote_ref(self.branch_refs(), self.ref).split('/origin/', 1)[1]
+                opts = [ local_branch ]
+            fork(['git', '-c', 'advice.detachedHead=false', 'checkout'] + opts + ['--'], cwd=self.directory)
 
     def update(self, clean=False, fix_remotes=False):
-        def actualUpdate():
-            with cd(self.directory):
-                try:
-                    current_origin = log_check_output(['git', 'config', '--get', 'remote.origin.url']).strip().decode('utf-8')
-                except CalledProcessError:
-                    current_origin = None
-                if current_origin != self.remote:
-                    if fix_remotes:
-                        logger.info("Fixing incorrect remote in %s directory (%s -> %s)" % (self.directory, current_origin, self.remote))
-                        fork(['git', 'remote', 'set-url', 'origin', self.remote])
-                    else:
-                        raise QuarkError("""
+        def actualUpdate(state):
+            current_origin = state["origin"]
+            if current_origin != self.remote:
+                if fix_remotes:
+                    logger.info("Fixing incorrect remote in %s directory (%s -> %s)" % (self.directory, current_origin, self.remote))
+                    fork(['git', 'remote', 'set-url', 'origin', self.remote], cwd=self.directory)
+                else:
+                    raise QuarkError("""
 
 Directory '%s' is a git repository,
 but its remote 'origin' (%r)
 does not match what we expect (%r).
 
 Please either remove the local clone, or fix its remote.""" % (self.directory, current_origin, self.remote))
-                if self.conf.get("shallow", False):
-                    # git fetch with shallow clones isn't very smart, and
-                    # re-fetches stuff that we already have; try to avoid this
-
-                    # FIXME: the current approach means that shallow clones
-                    # will be in detached HEAD state to a commit pretty much
-                    # always.
-                    # Probably this is not a big problem because shallow repos
-                    # in Quark aren't meant to be used for actual repo work,
-                    # and the previous implementation always had FETCH_HEAD
-                    # checked out; however, in future it would be nice to have
-                    # a cleaner solution.
-
-                    if self.ref_type == 'commit':
-                        # Easy case: we already know exactly the commit we need
-                        remote_commit = self.ref
-                    else:
-                        # Ask the remote what we are expected to have here
-                        remote_commit = log_check_output(['git', 'ls-remote', 'origin', self.noremote_ref()]).split(b'\t')[0].strip().decode('utf-8')
+            if self.conf.get("shallow", False):
+                # git fetch with shallow clones isn't very smart, and
+                # re-fetches stuff that we already have; try to avoid this
+
+                # FIXME: the current approach means that shallow clones
+                # will be in detached HEAD state to a commit pretty much
+                # always.
+                # Probably this is not a big problem because shallow repos
+                # in Quark aren't meant to be used for actual repo work,
+                # and the previous implementation always had FETCH_HEAD
+                # checked out; however, in future it would be nice to have
+                # a cleaner solution.
+
+                if self.ref_type == 'commit':
+                    # Easy case: we already know exactly the commit we need
+                    remote_commit = self.ref
+                elif self.ref_type == 'tag' and self.has_pinned_ref():
+                    # Tags don't move, the one we have is good
+                    remote_commit = self.ref
+                    GitSubproject.fetch_skipped()
+                else:
+                    # Ask the remote what we are expected to have here
+                    # (possibly already done while planning)
+                    remote_fullref, remote_commit = self.remote_ref()
+                    if remote_commit is None:
+                        raise QuarkError("%s not found in %s" % (remote_fullref, self.remote))
 
-                    try:
-                        # Try to check it out; in the common case (nothing
-                        # changed) this should be a no-op
-                        fork(['git', '-c', 'advice.detachedHead=false', 'checkout', remote_commit, '--'])
-                    except CalledProcessError:
-                        # Probably we don't have the commit; fetch it
-                        fork(['git', 'fetch', '--depth', '1', 'origin', remote_commit])
-                        # Try again
-                        fork(['git', '-c', 'advice.detachedHead=false', 'checkout', remote_commit, '--'])
+                try:
+                    # Try to check it out; in the common case (nothing
+                    # changed) this should be a no-op
+                    fork(['git', '-c', 'advice.detachedHead=false', 'checkout', remote_commit, '--'], cwd=self.directory)
+                except CalledProcessError:
+                    # Probably we don't have the commit; fetch it
+                    fork(['git', 'fetch', '--depth', '1', 'origin', remote_commit], cwd=self.directory,
+                         host=self.host, over_ssh=self.over_ssh)
+                    # Try again
+                    fork(['git', '-c', 'advice.detachedHead=false', 'checkout', remote_commit, '--'], cwd=self.directory)
+            else:
+                if self.ref_type in ('commit', 'tag') and self.has_pinned_ref():
+                    # Pinned refs don't move: if we already have it, there's
+                    # no point in asking the remote
+                    GitSubproject.fetch_skipped()
                 else:
-                    fork(['git', 'fetch'])
-                    # If we want to go on a branch, try to find a local branch that tracks it
-                    # and use it (possibly with a fast-forward)
-                    if self.ref_type == 'branch':
-                        # Resolve the remote ref
-                        remote_fullref = self.symbolic_full_name(self.ref)
-                        # Get a sensible local branch name to try
-                        local_ref = remote_fullref.split('/origin/', 1)[1]
-                        # Check if it is actually tracking our target
+                    self.use_shared_mirror()
+                    fork(['git', 'fetch'], cwd=self.directory, host=self.host, over_ssh=self.over_ssh)
+                # If we want to go on a branch, try to find a local branch that tracks it
+                # and use it (possibly with a fast-forward)
+                if self.ref_type == 'branch':
+                    # All the branches after the fetch, in a single go
+                    refs = self.branch_refs()
+                    # Resolve the remote ref
+                    remote_fullref = self.resolve_remote_ref(refs, self.ref)
+                    remote_commit = refs.get(remote_fullref, {}).get("commit")
+                    # Get a sensible local branch name to try
+                    local_ref = remote_fullref.split('/origin/', 1)[1]
+                    local = refs.get('refs/heads/' + local_ref)
+                    # Check if it is actually tracking our target; it's fine
+                    # if we don't have a local-tracking branch, git checkout
+                    # will do the right thing here
+                    if local is None or local["upstream"] in ("", remote_fullref):
                         try:
-                            local_fulltrackref = self.symbolic_full_name(local_ref + "@{u}")
-                        except CalledProcessError:
-                            # It's fine if it fails - we may not have a local-tracking branch,
-                            # so git checkout will do the right thing here
-                            local_fulltrackref = remote_fullref
-
-                        if remote_fullref == local_fulltrackref:
-                            try:
-                                # Checkout and fast-forward
-                                fork(['git', '-c', 'advice.detachedHead=false', 'checkout', local_ref, '--'])
-                                fork(['git', 'merge', '--ff-only', self.ref, '--'])
+                            # Checkout and fast-forward, skipping what is
+                            # already in place
+                            if state["branch"] != local_ref:
+                                fork(['git', '-c', 'advice.detachedHead=false', 'checkout', local_ref, '--'], cwd=self.directory)
+                            if local is not None and local["commit"] != remote_commit:
+                                fork(['git', 'merge', '--ff-only', self.ref, '--'], cwd=self.directory)
                                 # Final sanity check
-                                if log_check_output(['git', 'rev-parse', self.ref, '--']) != log_check_output(['git', 'rev-parse', local_ref, '--']):
+                                if log_check_output(['git', 'rev-parse', 'HEAD', '--'], cwd=self.directory).strip().decode('utf-8') != remote_commit:
                                     logger.warning("Warning: your local branch is ahead of required remote branch!")
-                                return
-                            except CalledProcessError:
-                                logger.warning("Couldn't fast-forward local branch, fallback to detached head mode...")
-                    # General case: plain checkout of the origin ref (going in detached HEAD)
-                    fork(['git', '-c', 'advice.detachedHead=false', 'checkout', self.ref, '--'])
+                            return
+                        except CalledProcessError:
+                            logger.warning("Couldn't fast-forward local branch, fallback to detached head mode...")
+                # General case: plain checkout of the origin ref (going in detached HEAD)
+                fork(['git', '-c', 'advice.detachedHead=false', 'checkout', self.ref, '--'], cwd=self.directory)
 
         if not exists(self.directory):
             self.checkout()
         elif not exists(self.directory + "/.git"):
             not_a_project(self.directory, "Git")
-        elif self.has_local_edit():
-            if clean:
-                self.clean_all()
-                actualUpdate()
+        else:
+            state = self.repo_state()
+            if state["dirty"]:
+                if clean:
+                    self.clean_all()
+                    actualUpdate(state)
+                else:
+                    logger.warning("Directory '%s' contains local modifications" % self.directory)
+                    self.stash()
+                    actualUpdate(state)
+                    self.pop()
             else:
-                logger.warning("Directory '%s' contains local modifications" % self.directory)
-                self.stash()
-                actualUpdate()
-                self.pop()
+                actualUpdate(state)
+
+    def plan_update(self, clean=False):
+        from quark import gitdir
+
+        if not exists(self.directory):
+            return {"action": "clone"}
+        if not exists(join(self.directory, '.git')):
+            return {"action": "error", "reason": "not a git clone"}
+        try:
+            origin = gitdir.remote_url(self.directory, rewrite=False)
+            git_dir, common_dir = gitdir.find(self.directory)
+            head = gitdir.read_ref(git_dir, common_dir, 'HEAD')
+            branch = gitdir.symbolic_ref(git_dir)
+            tag = self.local_tag()
+        except (gitdir.Unsupported, OSError):
+            # e.g. a .git file pointing to a worktree that's gone; git knows
+            # better what to make of it
+            state = self.repo_state()
+            origin, head = state["origin"], state["head"]
+            branch = None if state["branch"] is None else 'refs/heads/' + state["branch"]
+            tag = self.pinned_commit() if self.ref_type == 'tag' else None
+        if origin != self.remote:
+            return {"action": "fetch", "reason": "the remote is %r instead of %r" % (origin, self.remote)}
+
+        def noop():
+            if clean and self.repo_state()["dirty"]:
+                return {"action": "checkout", "reason": "local modifications to clean"}
+            return {"action": "noop"}
+
+        if head is None:
+            return {"action": "fetch", "reason": "nothing is checked out"}
+        if self.ref_type == 'commit':
+            if len(self.ref) >= 7 and head.startswith(self.ref):
+                return noop()
+        elif tag is not None:
+            # only lightweight tags point straight to the commit
+            if tag == head or self.pinned_commit() == head:
+                return noop()
+            return {"action": "checkout", "reason": "%s is already in the clone" % self.ref}
+        else:
+            # Floating refs and missing tags are resolved on the remote,
+            # with a single git ls-remote per repository
+            try:
+                remote_fullref, remote_commit = self.remote_ref()
+            except CalledProcessError:
+                return {"action": "fetch", "reason": "git ls-remote failed"}
+            if remote_commit is None:
+                return {"action": "fetch", "reason": "%s not found in the remote" % self.ref}
+            # Shallow clones stay in detached HEAD, full ones go on the branch
+            if head == remote_commit and (self.ref_type == 'tag' or self.conf.get("shallow", False) or
+                                          branch == remote_fullref):
+                return noop()
+            return {"action": "fetch", "reason": "%s is at %s" % (self.ref, remote_commit)}
+        if self.has_pinned_ref():
+            return {"action": "checkout", "reason": "%s is already in the clone" % self.ref}
+        return {"action": "fetch", "reason": "%s is not in the clone" % self.ref}
+
+    def update_skipped(self):
+        super().update_skipped()
+        # Not touched at all, but still worth telling (with --clean such a
+        # clone isn't planned as no-op)
+        if self.repo_state()["dirty"]:
+            logger.warning("Directory '%s' contains local modifications" % self.directory)
+
+    async def prefetch(self, remote=True):
+        from quark import gitdir
+
+        if not remote or not exists(join(self.directory, '.git')):
+            return
+        if self.ref_type == 'tag':
+            try:
+                if self.local_tag() is not None:
+                    return
+            except (gitdir.Unsupported, OSError):
+                pass
+        elif self.ref_type != 'branch':
+            return
+        await GitSubproject.remote_refs_async(self.remote)
+
+    def local_tag(self):
+        """
+        What refs/tags/<ref> points to in the clone (None if missing),
+        read from the .git directory; may raise gitdir.Unsupported.
+        """
+        from quark import gitdir
+
+        if self.ref_type != 'tag':
+            return None
+        git_dir, common_dir = gitdir.find(self.directory)
+        return gitdir.read_ref(git_dir, common_dir, 'refs/tags/' + self.ref)
+
+    @staticmethod
+    async def remote_refs_async(remote):
+        """
+        The refs of remote, as a dictionary mapping the full ref names to a
+        dictionary with their "commit" (the peeled one for tags) and the
+        "symref" they point to (e.g. for HEAD), as reported by `git
+        ls-remote`; it's asked once per update, however many modules need it.
+        """
+        from quark import aio
+
+        async def ls_remote(remote):
+            out = await aio.check_output(['git', 'ls-remote', '--symref', '--', remote], host=ssh.host_of(remote),
+                                         over_ssh=ssh.uses_ssh(remote))
+            refs = {}
+            for line in out.decode('utf-8').splitlines():
+                target, name = line.split('\t', 1)
+                if target.startswith('ref: '):
+                    refs.setdefault(name, {"commit": "", "symref": ""})["symref"] = target[len('ref: '):]
+                elif name.endswith('^{}'):
+                    # the commit an annotated tag points to
+                    refs.setdefault(name[:-3], {"commit": "", "symref": ""})["commit"] = target
+                else:
+                    ref = refs.setdefault(name, {"commit": "", "symref": ""})
+                    ref["commit"] = ref["commit"] or target
+            return refs
+
+        with GitSubproject.stats_lock:
+            if GitSubproject.remote_refs is None:
+                GitSubproject.remote_refs = aio.Memo(ls_remote)
+            memo = GitSubproject.remote_refs
+        return await memo.get(remote)
+
+    def remote_ref(self):
+        """
+        Returns the (full ref name, commit) couple our branch or tag
+        resolves to on the remote, with a commit of None if it's not there.
+        """
+        from quark import aio
+
+        refs = aio.run_sync(GitSubproject.remote_refs_async(self.remote))
+        if self.ref_type == 'tag':
+            fullref = 'refs/tags/' + self.ref
+        elif self.ref == 'origin/HEAD':
+            fullref = refs.get('HEAD', {}).get("symref") or 'HEAD'
         else:
-            actualUpdate()
+            fullref = 'refs/heads/' + self.noremote_ref()
+        return fullref, refs.get(fullref, {}).get("commit") or None
 
     def stash(self):
-        with cd(self.directory):
-            fork(['git', 'stash', '--all'])
+        fork(['git', 'stash', '--all'], cwd=self.directory)
 
     def pop(self):
-        with cd(self.directory):
-            fork(['git', 'stash', 'pop'])
+        fork(['git', 'stash', 'pop'], cwd=self.directory)
 
     def clean_all(self):
-        with cd(self.directory):
-            fork(['git', 'clean', '-fd'])
+        fork(['git', 'clean', '-fd'], cwd=self.directory)
 
     def status(self):
         fork(['git', "--git-dir=%s/.git" % self.directory, "--work-tree=%s" % self.directory, 'status'])
 
     def has_local_edit(self):
-        with cd(self.directory):
-            return log_check_output(['git', 'status', '--porcelain']) != b""
+        return self.repo_state()["dirty"]
+
+    def repo_state(self):
+        """
+        Returns what update needs to know about the clone before touching
+        it, as a dictionary: "origin" (the URL of the origin remote, or None),
+        "head" (the checked out commit, None in an empty repository),
+        "branch" (the checked out branch, None in detached HEAD) and "dirty"
+        (whether there are local modifications or untracked files).
+        The origin is read from the .git directory when possible, otherwise
+        it's asked to git concurrently with the status.
+        """
+        from quark import aio, gitdir
+
+        async def query_origin():
+            try:
+                return gitdir.remote_url(self.directory, rewrite=False)
+            except gitdir.Unsupported:
+                rc, origin, _ = await aio.run(['git', 'config', '--get', 'remote.origin.url'], cwd=self.directory,
+                                              stdout=PIPE, check=False, comment="captured")
+                # git config fails with 1 if the key is missing
+                return origin.strip().decode('utf-8') if rc == 0 else None
+
+        async def query():
+            return await aio.gather(
+                query_origin(),
+                aio.check_output(['git', 'status', '--porcelain=v2', '--branch'], cwd=self.directory))
+
+        origin, status = aio.run_sync(query())
+        state = {
+            "origin": origin,
+            "head": None,
+            "branch": None,
+            "dirty": False,
+        }
+        for line in status.splitlines():
+            if line.startswith(b'# branch.oid '):
+                oid = line.split(b' ', 2)[2].decode('utf-8')
+                state["head"] = None if oid == '(initial)' else oid
+            elif line.startswith(b'# branch.head '):
+                branch = line.split(b' ', 2)[2].decode('utf-8')
+                state["branch"] = None if branch == '(detached)' else branch
+            elif not line.startswith(b'# '):
+                state["dirty"] = True
+        return state
+
+    def branch_refs(self):
+        """
+        Returns the local and origin branches, as a dictionary mapping the
+        full ref name to a dictionary with its "commit", its "upstream" ref
+        and the ref it points to if it's symbolic ("symref", as for
+        origin/HEAD); empty strings stand for missing values.
+        """
+        out = log_check_output(['git', 'for-each-ref', '--format=%(refname)%09%(objectname)%09%(upstream)%09%(symref)',
+                                'refs/heads/', 'refs/remotes/origin/'], cwd=self.directory)
+        refs = {}
+        for line in out.decode('utf-8').splitlines():
+            name, commit, upstream, symref = line.split('\t')
+            refs[name] = {"commit": commit, "upstream": upstream, "symref": symref}
+        return refs
 
-    def symbolic_full_name(self, ref):
-        with cd(self.directory):
-            return log_check_output(['git', 'rev-parse', '--symbolic-full-name', ref, '--']).split(b'\n')[0].strip().decode('utf-8')
+    @staticmethod
+    def resolve_remote_ref(refs, ref):
+        """
+        Full name of the remote branch ref (such as origin/HEAD) refers to,
+        looked up in the output of branch_refs.
+        """
+        fullref = 'refs/remotes/' + ref
+        symref = refs.get(fullref, {}).get("symref")
+        return symref or fullref
+
+    def has_pinned_ref(self):
+        return self.pinned_commit() is not None
+
+    def pinned_commit(self):
+        """The commit our commit or tag ref resolves to in the clone, None if it's not there."""
+        ref = self.ref
+        if self.ref_type == 'tag':
+            ref = 'refs/tags/' + ref
+        try:
+            return log_check_output(['git', 'rev-parse', '--verify', '--quiet', ref + '^{commit}', '--'],
+                                    cwd=self.directory).strip().decode('utf-8')
+        except CalledProcessError:
+            return None
+
+    def refresh_shared_mirror(self):
+        """
+        Makes sure that the shared bare mirror of our remote (see
+        QUARK_GIT_CACHE) exists and is up to date; it is fetched at most once
+        per run. Returns its path, or None if the shared cache is disabled.
+        """
+        cache_dir = git_cache_dir()
+        if cache_dir is None:
+            return None
+        import hashlib
+        import tempfile
+
+        mirror = join(cache_dir, hashlib.sha1(self.remote.encode('utf-8')).hexdigest() + '.git')
+        with GitSubproject.stats_lock:
+            lock = GitSubproject.mirror_locks.setdefault(mirror, threading.Lock())
+        with lock:
+            if mirror in GitSubproject.refreshed_mirrors:
+                return mirror
+            if not exists(mirror):
+                mkdir(cache_dir)
+                # Clone in a temporary directory, so that a concurrent quark
+                # never sees a half-baked mirror
+                tmp_mirror = tempfile.mkdtemp(dir=cache_dir, prefix='.tmp-')
+                fork(['git', 'clone', '--mirror', '--', self.remote, tmp_mirror], host=self.host, over_ssh=self.over_ssh)
+                # Clones borrow objects from here: never throw away anything
+                fork(['git', 'config', 'gc.pruneExpire', 'never'], cwd=tmp_mirror)
+                fork(['git', 'config', 'gc.reflogExpireUnreachable', 'never'], cwd=tmp_mirror)
+                try:
+                    os.rename(tmp_mirror, mirror)
+                except OSError:
+                    # someone else got there first
+                    shutil.rmtree(tmp_mirror, ignore_errors=True)
+            else:
+                fork(['git', 'fetch', 'origin'], cwd=mirror, host=self.host, over_ssh=self.over_ssh)
+            GitSubproject.refreshed_mirrors.add(mirror)
+        return mirror
+
+    def use_shared_mirror(self):
+        """
+        Refreshes the shared mirror and makes sure our clone borrows objects
+        from it (which is not the case for clones made before enabling the
+        cache), so that the following fetch has little to download.
+        """
+        mirror = self.refresh_shared_mirror()
+        if mirror is None or not isdir(join(self.directory, '.git')):
+            return
+        alternates_path = join(self.directory, '.git', 'objects', 'info', 'alternates')
+        mirror_objects = join(mirror, 'objects')
+        try:
+            with open(alternates_path, 'r') as f:
+                alternates = [L.strip() for L in f]
+        except IOError:
+            alternates = []
+        if mirror_objects not in alternates:
+            mkdir(os.path.dirname(alternates_path))
+            with open(alternates_path, 'a') as f:
+                f.write(mirror_objects + '\n')
+
+    @staticmethod
+    def fetch_skipped():
+        with GitSubproject.stats_lock:
+            GitSubproject.skipped_fetches += 1
 
     @staticmethod
     def url_from_directory(directory, include_commit = True):
-        with cd(directory):
-            try:
-                origin = log_check_output(['git', 'remote', 'get-url', 'origin'], universal_newlines=True)[:-1]
-            except CalledProcessError:
+        from quark import gitdir
+        try:
+            # Answered from the .git directory, no process needed
+            return GitSubproject.url_from_metadata(directory, include_commit)
+        except gitdir.Unsupported:
+            from quark import aio
+            return aio.run_sync(GitSubproject.url_from_directory_async(directory, include_commit))
+
+    async def url_from_checkout_async(self, include_commit = True):
+        return await GitSubproject.url_from_directory_async(self.directory, include_commit)
+
+    @staticmethod
+    async def url_from_directory_async(directory, include_commit = True):
+        from quark import aio, gitdir
+        try:
+            return GitSubproject.url_from_metadata(directory, include_commit)
+        except gitdir.Unsupported:
+            pass
+        try:
+            origin, commit = await aio.gather(
+                aio.check_output(['git', 'remote', 'get-url', 'origin'], cwd=directory, universal_newlines=True),
+                aio.check_output(['git', 'log', '-1', '--format=%H'], cwd=directory, universal_newlines=True))
+        except CalledProcessError as ex:
+            if ex.cmd[1] == 'remote':
                 raise QuarkError("Cannot obtain remote")
-            commit = log_check_output(['git', 'log', '-1', '--format=%H'], universal_newlines=True)[:-1]
+            raise
+        return GitSubproject.url_from_origin(origin[:-1], commit[:-1], include_commit)
+
+    @staticmethod
+    def url_from_metadata(directory, include_commit = True):
+        """
+        url_from_directory reading the .git directory directly; raises
+        gitdir.Unsupported if git has to be asked instead.
+        """
+        from quark import gitdir
+        origin = gitdir.remote_url(directory)
+        commit = gitdir.head_commit(directory) if include_commit else None
+        return GitSubproject.url_from_origin(origin, commit, include_commit)
+
+    @staticmethod
+    def url_from_origin(origin, commit, include_commit = True):
         parsed = None
         try:
             parsed = urllib.parse.urlparse(origin)
@@ -522,32 +1055,59 @@ Please either remove the local clone, or fix its remote.""" % (self.directory, c
             ret += '#commit=%s' % (commit,)
         return ret
 
-    def mirror(self, dst_dir):
-        source_dir = self.directory
-        def mkdir_p(path):
-            if path.strip() != '' and not os.path.exists(path):
-                os.makedirs(path)
-
-        env = os.environ.copy()
-        env['LC_MESSAGES'] = 'C'
-
-        def tracked_files():
-            p = Popen(['git', 'ls-tree', '-r', '--name-only', 'HEAD'], stdout=PIPE, env=env)
-            out = p.communicate()[0]
-            if p.returncode != 0 or not out.strip():
-                return None
-            return [e.strip() for e in out.splitlines() if os.path.exists(e)]
-
-        def cp(src, dst):
-            r, f = os.path.split(dst)
-            mkdir_p(r)
-            shutil.copy2(src, dst)
-
-        with cd(source_dir):
-            for t in tracked_files():
-                cp(t, os.path.join(dst_dir, t.decode()))
+    def mirror(self, dst_dir, previous=None, mode='copy'):
+        """
+        Copies the files tracked in HEAD, as they are in the working tree,
+        into dst_dir. See Subproject.mirror for previous and mode.
+        """
+        modified = self.modified_files()
+        if not modified and previous is None and mode == 'copy':
+            # The working tree matches HEAD: git writes the files straight
+            # from its object store (with the same filters, line endings and
+            # symlinks handling as in the working tree)
+            mkdir(dst_dir)
+            fork(['git', 'checkout-index', '--all', '--force',
+                  '--prefix=' + join(os.path.abspath(dst_dir), '')], cwd=self.directory)
+            return None
+        return mirror_files(self.directory, dst_dir, {path: blob for _, path, blob in self.versioned_entries(modified)},
+                            previous, mode)
+
+    def modified_files(self):
+        """Tracked files that differ from HEAD, in the index or on disk."""
+        changes = log_check_output(['git', 'status', '--porcelain', '-z', '--untracked-files=no'], cwd=self.directory)
+        modified = set()
+        records = iter(changes.split(b'\0'))
+        for record in records:
+            if not record:
+                continue
+            modified.add(os.fsdecode(record[3:]))
+            if record[0:1] in (b'R', b'C'):
+                # renames and copies are followed by the original path
+                modified.add(os.fsdecode(next(records)))
+        return modified
+
+    def versioned_entries(self, modified=None):
+        # The files tracked in HEAD; their blob ids hold for the ones not
+        # modified locally
+        if modified is None:
+            modified = self.modified_files()
+        out = log_check_output(['git', 'ls-tree', '-r', '-z', '--full-tree', 'HEAD'], cwd=self.directory)
+        for entry in out.split(b'\0'):
+            if not entry:
+                continue
+            info, path = entry.split(b'\t', 1)
+            _, kind, blob = info.split()
+            if kind == b'commit':
+                # submodules aren't part of the mirror
+                continue
+            path = os.fsdecode(path)
+            # tracked files deleted locally are skipped
+            if os.path.lexists(join(self.directory, path)):
+                yield 'file', path, None if path in modified else blob.decode('ascii')
 
     def set_local_ignores(self, subprojects_dir, modules):
+        from quark.treecache import cache_dir as tree_cache_dir
+
         BEGIN = "# Following lines automatically generated by quark"
         END = "# Previous lines automatically generated by quark"
         # .git/info may not exist
@@ -587,6 +1147,7 @@ Please either remove the local clone, or fix its remote.""" % (self.directory, c
                                     self.directory),
                                 "") + "\n")
                 fd.write(os.path.join(subprojects_dir, "CMakeLists.txt") + "\n")
+                fd.write(os.path.join(tree_cache_dir, "") + "\n")
                 fd.write(END + "\n")
 
         with open(quark_exclude_path, "w") as new_exc:
@@ -650,6 +1211,8 @@ class SvnSubproject(Subproject):
             if '@' in url.path:
                 self.rev = url.path.split('@')[-1]
         self.url = url._replace(fragment='')
+        self.host = ssh.host_of(self.url.geturl())
+        self.over_ssh = ssh.uses_ssh(self.url.geturl())
 
     def same_checkout(self, other):
         if isinstance(other, SvnSubproject) and (self.url, self.rev) == (other.url, other.rev):
@@ -657,7 +1220,7 @@ class SvnSubproject(Subproject):
         return False
 
     def checkout(self):
-        fork(['svn', 'checkout', self.url.geturl(), self.directory])
+        fork(['svn', 'checkout', self.url.geturl(), self.directory], host=self.host, over_ssh=self.over_ssh)
 
     def update(self, clean=False, fix_remotes=False):
         if not exists(self.directory):
@@ -665,90 +1228,175 @@ class SvnSubproject(Subproject):
         elif not exists(self.directory + "/.svn"):
             not_a_project(self.directory, "Subversion")
         else:
-            with cd(self.directory):
-                if self.has_local_edit():
-                    if clean:
-                        fork(['svn', 'revert', '-R', '.'])
-                        fork(['svn', 'cleanup', '--remove-unversioned', '.'])
-                    else:
-                        logger.warning("Directory '%s' contains local modifications" % self.directory)
-                # svn switch _would be ok_ even just to perform an update, but,
-                # unlike svn up, it touches the timestamp of all the files,
-                # forcing full rebuilds; so, if we are already on the correct
-                # url just use svn up
-
-                # Notice that, unlike other svn commands, -r in svn up works as
-                # a peg revision (the @ syntax), so it takes the URL of the
-                # current working copy and looks it up in the repository _as it
-                # was at the requested revision_ (or HEAD if none is specified)
-                target_base,target_rev = (self.url.geturl().split('@') + [''])[:2]
-                if target_base == self.url_from_checkout(include_commit = False):
-                    fork(['svn', 'up'] + (["-r" + target_rev] if target_rev else []))
+            from quark import aio
+
+            # Usually queried already by prefetch, with all the other working
+            # copies
+            local_edit, current_url = aio.run_sync(self.wc_state())
+            if local_edit:
+                if clean:
+                    fork(['svn', 'revert', '-R', '.'], cwd=self.directory)
+                    fork(['svn', 'cleanup', '--remove-unversioned', '.'], cwd=self.directory)
                 else:
-                    fork(['svn', 'switch', self.url.geturl()])
+                    logger.warning("Directory '%s' contains local modifications" % self.directory)
+            # svn switch _would be ok_ even just to perform an update, but,
+            # unlike svn up, it touches the timestamp of all the files,
+            # forcing full rebuilds; so, if we are already on the correct
+            # url just use svn up
+
+            # Notice that, unlike other svn commands, -r in svn up works as
+            # a peg revision (the @ syntax), so it takes the URL of the
+            # current working copy and looks it up in the repository _as it
+            # was at the requested revision_ (or HEAD if none is specified)
+            target_base,target_rev = (self.url.geturl().split('@') + [''])[:2]
+            if target_base == current_url:
+                fork(['svn', 'up'] + (["-r" + target_rev] if target_rev else []), cwd=self.directory,
+                     host=self.host, over_ssh=self.over_ssh)
+            else:
+                fork(['svn', 'switch', self.url.geturl()], cwd=self.directory, host=self.host, over_ssh=self.over_ssh)
+
+    # Local modifications and URL of the working copies, for the length of
+    # an update (see wc_state)
+    wc_states = None
+
+    async def wc_state(self):
+        """
+        Whether the working copy has local modifications and its URL
+        (without revision), queried once per update.
+        """
+        from quark import aio
+
+        if SvnSubproject.wc_states is None:
+            # Both queried at once, batched with the other working copies
+            SvnSubproject.wc_states = aio.Memo(lambda mod: aio.gather(
+                mod.has_local_edit_async(), mod.url_from_checkout_async(include_commit = False)))
+        return await SvnSubproject.wc_states.get(self)
+
+    async def prefetch(self, remote=True):
+        # Local queries: the ones of all the working copies discovered
+        # together make a single svn st and a single svn info
+        if exists(join(self.directory, '.svn')):
+            await self.wc_state()
+
+    def plan_update(self, clean=False):
+        if not exists(self.directory):
+            return {"action": "clone"}
+        if not exists(join(self.directory, '.svn')):
+            return {"action": "error", "reason": "not a Subversion working copy"}
+        # svn up also restores missing files and updates externals, it's
+        # never skipped
+        return {"action": "fetch", "reason": "svn up asks the server"}
 
     def status(self):
         fork(['svn', 'status', self.directory])
 
     def has_local_edit(self):
-        xml = log_check_output(['svn', 'st', '--xml', self.directory], universal_newlines=True)
-        doc = ElementTree.fromstring(xml)
-        return len(doc.findall('./target/entry/wc-status[@item="modified"]')) != 0
+        from quark import aio
+        return aio.run_sync(self.has_local_edit_async())
+
+    async def has_local_edit_async(self):
+        target = await SvnSubproject.query_xml('st', self.directory)
+        return len(target.findall('./entry/wc-status[@item="modified"]')) != 0
+
+    # svn info/st batches, created on the first use (see query_xml)
+    batches = {}
+
+    @staticmethod
+    async def query_xml(command, directory):
+        """
+        Runs `svn <command> --xml` on directory, returning its <entry>
+        element (for info) or its <target> element (for st); the queries
+        issued together for different working copies are run as a single
+        svn invocation, with all of them as targets.
+        """
+        from quark import aio
+
+        async def run_batch(targets):
+            import xml.etree.ElementTree as ElementTree
+
+            # Sorted, so that the command line doesn't depend on scheduling
+            targets = sorted(targets)
+            try:
+                xml = await aio.check_output(['svn', command, '--xml'] + targets, universal_newlines=True)
+            except CalledProcessError:
+                if len(targets) == 1:
+                    raise
+                # One bad working copy spoils the whole batch, retry one by
+                # one so that each gets its own result (or error)
+                results = await aio.gather(*[run_batch([target]) for target in targets], return_exceptions=True)
+                return {target: result if isinstance(result, Exception) else result.get(target, KeyError(target))
+                        for target, result in zip(targets, results)}
+            doc = ElementTree.fromstring(xml)
+            # svn reports each target with the path it was given
+            elements = doc.findall('./entry') if command == 'info' else doc.findall('./target')
+            return {os.path.normpath(element.get('path')): element for element in elements}
+
+        batch = SvnSubproject.batches.get(command)
+        if batch is None:
+            batch = SvnSubproject.batches[command] = aio.Batch(run_batch)
+        return await batch.query(os.path.normpath(os.path.abspath(directory)))
 
     @staticmethod
     def url_from_directory(directory, include_commit = True):
-        xml = log_check_output(['svn', 'info', '--xml', directory], universal_newlines=True)
-        doc = ElementTree.fromstring(xml)
-        ret = doc.findall('./entry/url')[0].text
+        from quark import aio
+        return aio.run_sync(SvnSubproject.url_from_directory_async(directory, include_commit))
+
+    async def url_from_checkout_async(self, include_commit = True):
+        return await SvnSubproject.url_from_directory_async(self.directory, include_commit)
+
+    @staticmethod
+    async def url_from_directory_async(directory, include_commit = True):
+        entry = await SvnSubproject.query_xml('info', directory)
+        ret = entry.findall('./url')[0].text
         if include_commit:
-            ret += "@" + doc.findall('./entry/commit')[0].get('revision')
+            ret += "@" + entry.findall('./commit')[0].get('revision')
         return ret
 
-    def mirror(self, dst, quick = False):
+    def mirror(self, dst, previous=None, mode='copy'):
         src = self.directory
 
-        os.chdir(src)
-        if not quick and isdir(dst):
+        if previous is None and isdir(dst):
             shutil.rmtree(dst)
-        if not isdir(dst):
-            os.makedirs(dst)
-
-        # Forziamo il locale a inglese, perché parseremo l'output di svn e non
-        # vogliamo errori dovuti alle traduzioni.
-        env = os.environ.copy()
-        env["LC_MESSAGES"] = "C"
-
-        dirs = ["."]
-
-        # Esegue svn info ricorsivamente per iterare su tutti i file versionati.
-        for D in dirs:
-            infos = {}
-            for L in Popen(["svn", "info", "--recursive", D], stdout=PIPE, env=env).stdout:
-                L = L.decode()
-                if L.strip():
-                    k,v = L.strip().split(": ", 1)
-                    infos[k] = v
-                else:
-                    if infos["Schedule"] == "delete":
-                        continue
-                    fn = infos["Path"]
-                    infos = {}
-                    if fn == ".":
-                        continue
-                    fn1 = join(src, fn)
-                    fn2 = join(dst, fn)
-                    if isdir(fn1):
-                        if not isdir(fn2):
-                            os.makedirs(fn2)
-                    elif not quick or newer(fn1, fn2):
-                        shutil.copy2(fn1, fn2)
+        if previous is None and mode == 'copy':
+            # svn writes the versioned files itself, local modifications
+            # included (a trailing @ keeps @ in the path from being taken
+            # as a peg revision)
+            fork(['svn', 'export', '--quiet', '--force', '--ignore-externals',
+                  src + '@' if '@' in src else src, dst])
+            return None
+        mkdir(dst)
+        return super().mirror(dst, previous, mode)
+
+    def versioned_entries(self):
+        # Everything but the root and what is scheduled for deletion; the
+        # XML of svn info is parsed as it comes
+        import xml.etree.ElementTree as ElementTree
+
+        proc = Popen(['svn', 'info', '--recursive', '--xml', '.'], stdout=PIPE, cwd=self.directory)
+        try:
+            for _, element in ElementTree.iterparse(proc.stdout):
+                if element.tag != 'entry':
+                    continue
+                kind, path = element.get('kind'), os.path.normpath(element.get('path'))
+                if path != '.' and element.findtext('./wc-info/schedule') != 'delete' and \
+                        os.path.lexists(join(self.directory, path)):
+                    yield kind, path, None
+                # Don't keep the whole document in memory
+                element.clear()
+        finally:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if returncode != 0:
+            raise CalledProcessError(returncode, proc.args)
 
     def set_local_ignores(self, subprojects_dir, modules):
         # Svn doesn't support local sandbox ignore lists
         pass
 
 class GitlabSubproject(Subproject):
-    GITLAB_TOKEN_HEADER = "PRIVATE-TOKEN"
+    download_only = True
+
+    TAR_FORMATS = (".tar.bz2", ".tar.gz", ".tar.xz")
 
     PROGRESS_ICONS = itertools.cycle([
         "o...",
@@ -760,6 +1408,7 @@ class GitlabSubproject(Subproject):
     ])
 
     def get_env_variables(self, toplevel):
+        self._resolve_job()
         return {
             **super().get_env_variables(toplevel=toplevel),
             **{
@@ -778,11 +1427,29 @@ class GitlabSubproject(Subproject):
         }  # type: dict[str, None | str]
 
         self._gitlab_setup(url)
+        self._client = None
         self._parse_url(url)
 
+    @property
+    def client(self):
+        # Created on demand, the HTTP machinery is needed only to download
+        if self._client is None:
+            from quark.gitlab import GitlabClient
+
+            self._client = GitlabClient.get(self.gitlab_url, self.gitlab_token)
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
     def update(self, clean=False, fix_remotes=False):
+        import tempfile
+
         assert self.directory  # Make Pyright happy
 
+        self._resolve_job()
+
         # Check whether the last download matches the currently-wanted one.
         #
         # NOTE: The current logic will force a re-download after a freeze (the URL changes).
@@ -799,19 +1466,46 @@ class GitlabSubproject(Subproject):
 
         os.mkdir(self.directory)
         with tempfile.TemporaryDirectory(dir=self.directory, prefix=".quark-") as tempdir:
-            archive_path = self._download(tempdir)
+            archive_path, shared, extracted = self._fetch(tempdir)
 
             if self.do_extract:
-                self._extract(archive_path, tempdir)
+                if not extracted:
+                    self._extract(archive_path)
+            elif shared:
+                # Don't steal the file from the artifact store; a hard link
+                # shares its mode too, so making it executable would change
+                # the store and every other project linking it: those get a
+                # copy instead
+                target = join(self.directory, os.path.basename(archive_path))
+                if self.make_executable and not os.stat(archive_path).st_mode & stat.S_IXUSR:
+                    shutil.copy2(archive_path, target)
+                else:
+                    try:
+                        os.link(archive_path, target)
+                    except OSError:
+                        shutil.copy2(archive_path, target)
             else:
                 target = shutil.move(archive_path, self.directory)
-                if self.make_executable:
-                    os.chmod(target, os.stat(target).st_mode | stat.S_IXUSR)
+            if not self.do_extract and self.make_executable and not os.stat(target).st_mode & stat.S_IXUSR:
+                os.chmod(target, os.stat(target).st_mode | stat.S_IXUSR)
 
         # Update the stamp file
         with open(stamp_file, "w", encoding="utf-8", newline="\n") as fileobj:
             json.dump(self.stamp, fileobj)
 
+    def plan_update(self, clean=False):
+        stamp_file = join(self.directory, ".stamp.quark")
+        if not exists(stamp_file):
+            return {"action": "download"}
+        if self.parsed_endpoint_url is None:
+            # Finding out the job of the ref takes the server
+            return {"action": "resolve", "reason": "the job of %s may have changed" % self.parsed_ref}
+        with open(stamp_file, "r", encoding="utf-8", newline="\n") as fileobj:
+            data = json.load(fileobj)
+        if data["job_id"] == self.stamp["job_id"] and data["url"] == self.stamp["url"]:
+            return {"action": "noop"}
+        return {"action": "download", "reason": "the artifact changed"}
+
     def url_from_directory(self, directory, include_commit=True):
         stamp_file = join(directory, ".stamp.quark")
         if not exists(stamp_file):
@@ -891,6 +1585,9 @@ The keyring package is available:
     def _parse_url(self, url):
         fragments = Subproject._parse_fragment(url) if url.fragment else {}
 
+        # Set once the job to download from is known (see _resolve_job)
+        self.parsed_endpoint_url = None
+
         # There are mainly used for logging messages.
         self.parsed_job = None
         self.parsed_ref = None
@@ -915,23 +1612,11 @@ The keyring package is available:
             self.parsed_job = fragments.get("job")
             self.parsed_ref = fragments.get("ref")
 
-            artifact_path = "/".join(parts[parts.index("artifacts") + 1 :])
+            self.parsed_artifact_path = "/".join(parts[parts.index("artifacts") + 1 :])
 
-            if "ref" in fragments:
-                print_msg("resolving job id for " + self.parsed_artifact_name, self._print_msg_comment())
-                job = self.stamp["job_id"] = self._resolve_job_id(
-                    self.parsed_project_name,
-                    fragments["ref"],
-                    fragments["job"],
-                )
-            else:
+            if "ref" not in fragments:
                 job = self.stamp["job_id"] = str(fragments["job"])
-
-            self.parsed_endpoint_url = "/projects/%s/jobs/%s/artifacts/%s" % (
-                urllib.parse.quote_plus(self.parsed_project_name),
-                job,
-                artifact_path,
-            )
+                self._set_job_endpoint(job)
         elif url.scheme == "gitlab+package":
             project_name, package_name, package_version, package_file_name = url.path.rsplit("/", 3)
 
@@ -945,50 +1630,127 @@ The keyring package is available:
         else:
             raise QuarkError("Unsupported URL: " + url.geturl())
 
-    def _resolve_job_id(self, project: str, ref: str, job_name: str) -> str:
-        # NOTE: This method requires an API token. A CI job token isn't sufficient. As such, this
-        # should be called only when freezing or when a PAT is readily available.
-
-        # Latest successful pipeline for a given ref
-        req = urllib.request.Request(
-            url="%s/api/v4/projects/%s/pipelines?ref=%s&status=success&page=1&per_page=1" % (
-                self.gitlab_url,
-                urllib.parse.quote_plus(project),
-                urllib.parse.quote_plus(ref),
-            ),
-            headers={
-                self.GITLAB_TOKEN_HEADER: self.gitlab_token,
-            },
+    def _resolve_job(self):
+        # Resolving the job of a ref costs a couple of API calls, so it's done
+        # only when actually needed, and not while building the dependency tree
+        if self.parsed_endpoint_url is not None:
+            return
+        print_msg("resolving job id for " + self.parsed_artifact_name, self._print_msg_comment())
+        job = self.stamp["job_id"] = self.client.resolve_job_id(
+            self.parsed_project_name,
+            self.parsed_ref,
+            self.parsed_job,
         )
+        self._set_job_endpoint(job)
 
-        with urllib.request.urlopen(req) as response:
-            pipeline = json.loads(response.read().decode("utf-8"))
-            if len(pipeline) != 1:
-                raise QuarkError("Could not find latest successful pipeline for ref %s" % ref)
-            pipeline = pipeline[0]
-
-        # Jobs in latest pipeline
-        req = urllib.request.Request(
-            url="%s/api/v4/projects/%s/pipelines/%s/jobs?scope=success&include_retried=true&page=1&per_page=100" % (
-                self.gitlab_url,
-                urllib.parse.quote_plus(project),
-                pipeline["id"],
-            ),
-            headers={
-                self.GITLAB_TOKEN_HEADER: self.gitlab_token,
-            },
+    def _set_job_endpoint(self, job):
+        self.parsed_endpoint_url = "/projects/%s/jobs/%s/artifacts/%s" % (
+            urllib.parse.quote_plus(self.parsed_project_name),
+            job,
+            self.parsed_artifact_path,
         )
 
-        with urllib.request.urlopen(req) as response:
-            jobs = json.loads(response.read().decode("utf-8"))
+    def _fetch(self, tempdir: str):
+        """
+        Gets the wanted artifact, from the local artifact store if it's there
+        (which requires knowing its SHA1, either from the URL or from a
+        previous download of the same job artifact), otherwise downloading it
+        and adding it to the store.
+
+        Returns the path to the artifact (None if it has been extracted while
+        downloading and there's no store to keep it in), whether it lives in
+        the store (and thus must not be moved or modified) and whether it has
+        already been extracted into place.
+        """
+        store = artifact_cache_dir()
+        if store:
+            cached = self._lookup_store(store)
+            if cached:
+                return cached, True, False
+        archive_path, extracted = self._download(tempdir, store)
+        if store:
+            try:
+                return self._add_to_store(store, archive_path), True, extracted
+            except OSError as err:
+                logger.warning("Couldn't add %s to the artifact store: %s" % (self.parsed_artifact_name, err))
+        return archive_path, False, extracted
+
+    def _endpoint_key(self) -> str:
+        import hashlib
+
+        return hashlib.sha1(self.client.api_url(self.parsed_endpoint_url).encode("utf-8")).hexdigest()
+
+    def _job_index_path(self, store: str) -> str:
+        # Job artifacts never change, so the job id + artifact path are as good as a SHA1
+        return join(store, "jobs", self._endpoint_key() + ".json")
+
+    def _lookup_store(self, store: str):
+        import hashlib
 
-        for job in jobs:
-            if job["name"] == job_name:
-                return str(job["id"])
+        sha1 = self.stamp["sha1"]
+        if not sha1 and self.stamp["job_id"]:
+            try:
+                with open(self._job_index_path(store), "r", encoding="utf-8") as fileobj:
+                    sha1 = json.load(fileobj)["sha1"]
+            except (IOError, OSError, ValueError, KeyError):
+                return None
+        if not sha1:
+            return None
+
+        entry_dir = join(store, "sha1", sha1)
+        try:
+            entries = [e for e in os.listdir(entry_dir) if not e.startswith(".")]
+        except OSError:
+            return None
+        if len(entries) != 1:
+            return None
+        path = join(entry_dir, entries[0])
+
+        # Stored files are hard-linked into the projects, so they may have
+        # been modified in place; it's cheap to double check
+        print_msg("verifying cached " + self.parsed_artifact_name, self._print_msg_comment())
+        digestobj = hashlib.sha1()
+        with open(path, "rb") as fileobj:
+            for chunk in self._iter_chunks(fileobj):
+                digestobj.update(chunk)
+        if digestobj.hexdigest() != sha1:
+            logger.warning("Cached artifact %s is corrupted, downloading it again" % path)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
 
-        raise QuarkError("Could not find job %s in pipeline %s" % (job_name, pipeline["id"]))
+        self.stamp["sha1"] = sha1
+        return path
+
+    def _add_to_store(self, store: str, archive_path: str) -> str:
+        import tempfile
+
+        sha1 = self.stamp["sha1"]
+        assert sha1  # Make Pyright happy
+        entry_dir = join(store, "sha1", sha1)
+        if not isdir(entry_dir):
+            mkdir(join(store, "sha1"))
+            # Build the entry aside and rename it into place, so that a
+            # concurrent quark never sees a half-baked entry
+            tmp_dir = tempfile.mkdtemp(dir=join(store, "sha1"), prefix=".tmp-")
+            shutil.move(archive_path, join(tmp_dir, os.path.basename(archive_path)))
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # someone else got there first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        if self.stamp["job_id"]:
+            index_path = self._job_index_path(store)
+            mkdir(os.path.dirname(index_path))
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(index_path), prefix=".tmp-")
+            with os.fdopen(fd, "w", encoding="utf-8") as fileobj:
+                json.dump({"sha1": sha1}, fileobj)
+            os.replace(tmp_path, index_path)
+        entries = [e for e in os.listdir(entry_dir) if not e.startswith(".")]
+        return join(entry_dir, entries[0])
+
+    def _download(self, tempdir: str, store=None):
+        from quark.gitlab import Download
 
-    def _download(self, tempdir: str) -> str:
         assert self.parsed_artifact_name  # Make Pyright happy
         assert self.parsed_endpoint_url  # Make Pyright happy
 
@@ -998,15 +1760,11 @@ The keyring package is available:
 
         os.mkdir(dl_dir)
 
-        req = urllib.request.Request(
-            url="%s/api/v4/%s" % (self.gitlab_url, self.parsed_endpoint_url.lstrip("/")),
-            headers={
-                self.GITLAB_TOKEN_HEADER: self.gitlab_token,
-            },
-        )
+        # Interrupted downloads are kept next to the store, to be resumed later
+        partial_dir = join(store, "partial", self._endpoint_key()) if store else None
 
         try:
-            with urllib.request.urlopen(req) as response:
+            with Download(self.client, self.parsed_endpoint_url, partial_dir) as response:
                 # NOTE: The response filename (i.e. the one returned in the Content-Disposition
                 # header) is used to allow extraction of the entire artifacts zip from a CI pipeline
                 # without having to change the self._extract() format detection logic (which is
@@ -1017,30 +1775,67 @@ The keyring package is available:
                 # filename.
                 response_filename = response.headers.get_filename(self.parsed_artifact_name)
                 archive_path = join(dl_dir, response_filename)
-                sha1 = self._download_and_hash_with_progress(response, archive_path)
+                extracted = self.do_extract and archive_path.endswith(self.TAR_FORMATS)
+                # A persistent download already writes the archive on its own
+                output_path = None if response.persistent else archive_path
+                if extracted:
+                    # Tar archives can be read sequentially, so they are
+                    # extracted while downloading; the archive itself hits
+                    # the disk only if the artifact store wants it
+                    sha1 = self._download_and_extract(response, join(tempdir, "extract"),
+                                                      output_path if store else None)
+                else:
+                    sha1 = self._download_and_hash_with_progress(response, output_path)
+                response.finish(archive_path)
         except Exception as err:
-            raise QuarkError("Error downloading '%s'" % (req.full_url)) from err
+            raise QuarkError("Error downloading '%s'" % self.client.api_url(self.parsed_endpoint_url)) from err
 
-        # Verify or update the SHA1
+        # Verify or update the SHA1; nothing has been put in place yet, so on
+        # mismatch the whole download goes away together with tempdir
         print_msg("verifying " + self.parsed_artifact_name, self._print_msg_comment())
         if self.stamp["sha1"] and sha1 != self.stamp["sha1"]:
             raise QuarkError("SHA1 mismatch: %s != %s" % (sha1, self.stamp["sha1"]))
 
         self.stamp["sha1"] = sha1
 
-        return archive_path
+        if extracted:
+            # Same filesystem, these are just renames
+            for i in os.listdir(join(tempdir, "extract")):
+                shutil.move(join(tempdir, "extract", i), self.directory)
+            if not store:
+                return None, True
 
-    def _download_and_hash_with_progress(self, req, dest: str) -> str:
-        digestobj = hashlib.sha1()
-        size = 0
-        with open(dest, "wb") as output:
-            for icon, chunk in zip(self.PROGRESS_ICONS, self._iter_chunks(req)):
-                if sys.stdout.isatty():
-                    print("Downloading %s %.2fMB\r" % (icon, size / (1024 * 1024)), end="")
-                output.write(chunk)
-                digestobj.update(chunk)
-                size += len(chunk)
-        return digestobj.hexdigest()
+        return archive_path, extracted
+
+    def _print_progress(self, size: int):
+        if sys.stdout.isatty():
+            print("Downloading %s %.2fMB\r" % (next(self.PROGRESS_ICONS), size / (1024 * 1024)), end="")
+
+    def _download_and_hash_with_progress(self, req, dest=None) -> str:
+        from quark.gitlab import HashingReader
+
+        with contextlib.ExitStack() as stack:
+            output = stack.enter_context(open(dest, "wb")) if dest else None
+            reader = HashingReader(req, output, self._print_progress)
+            reader.drain()
+        return reader.hexdigest()
+
+    def _download_and_extract(self, req, extract_dir: str, dest=None) -> str:
+        import tarfile
+
+        from quark.gitlab import HashingReader
+
+        print_msg("extracting " + self.parsed_artifact_name, self._print_msg_comment())
+        os.mkdir(extract_dir)
+        with contextlib.ExitStack() as stack:
+            output = stack.enter_context(open(dest, "wb")) if dest else None
+            reader = HashingReader(req, output, self._print_progress)
+            with tarfile.open(fileobj=reader, mode="r|*") as tar:
+                tar.extractall(extract_dir)
+            # The SHA1 covers the whole file, including whatever follows the
+            # end-of-archive marker
+            reader.drain()
+        return reader.hexdigest()
 
     def _iter_chunks(self, reader, chunk_size=819200):
         buf = reader.read(chunk_size)
@@ -1049,26 +1844,52 @@ The keyring package is available:
             buf = reader.read(chunk_size)
             yield buf
 
-    def _extract(self, archive_path: str, tempdir: str):
+    def _extract(self, archive_path: str):
+        import tarfile
+
+        # The archive has already been verified, so it can be extracted
+        # straight into place (if this fails midway there's no stamp file, and
+        # the next update starts from scratch)
         assert self.directory  # Make Pyright happy
 
         print_msg("extracting " + self.parsed_artifact_name, self._print_msg_comment())
 
-        extract_dir = join(tempdir, "extract")
-        os.mkdir(extract_dir)
-
-        if archive_path.endswith((".tar.bz2", ".tar.gz", ".tar.xz")):
+        if archive_path.endswith(self.TAR_FORMATS):
             with tarfile.open(archive_path, "r") as tar:
-                tar.extractall(extract_dir)
+                tar.extractall(self.directory)
         elif archive_path.endswith(".zip"):
-            with zipfile.ZipFile(archive_path, "r") as zip:
-                zip.extractall(extract_dir)
+            self._extract_zip(archive_path)
         else:
             raise QuarkError("Unsupported format: " + archive_path)
 
-        # Move files into place
-        for i in os.listdir(extract_dir):
-            shutil.move(join(extract_dir, i), self.directory)
+    def _extract_zip(self, archive_path: str):
+        import zipfile
+
+        # Zip members are compressed independently, so they can be inflated
+        # in parallel; ZipFile objects can't be shared between threads, so
+        # each worker opens its own
+        with zipfile.ZipFile(archive_path, "r") as zip:
+            members = zip.infolist()
+        local = threading.local()
+        archives = []
+
+        def extract(member):
+            if not hasattr(local, "zip"):
+                local.zip = zipfile.ZipFile(archive_path, "r")
+                archives.append(local.zip)
+            try:
+                local.zip.extract(member, self.directory)
+            except FileExistsError:
+                # Another worker created the same parent directory meanwhile
+                local.zip.extract(member, self.directory)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, min(os.cpu_count() or 1, len(members)))) as executor:
+                for _ in executor.map(extract, members):
+                    pass
+        finally:
+            for archive in archives:
+                archive.close()
 
     def _print_msg_comment(self) -> str:
         ret = "from " + self.parsed_project_name
@@ -1080,8 +1901,46 @@ The keyring package is available:
             ret += ", pkg: " + self.parsed_pkg
         return ret
 
-def generate_cmake_script(source_dir, url=None, options=None, print_tree=False,update=True, clean=False, clobber=False, fix_remotes = False):
-    root, modules = Subproject.create_dependency_tree(source_dir, url, options, update=update, clean=clean, clobber=clobber, fix_remotes = fix_remotes)
+def plan_update(source_dir, options=None, clean=False):
+    """
+    Dry run of `quark up`: resolves the dependency tree from what is on disk
+    and returns what updating each module would do (see
+    Subproject.plan_update), as a list of dictionaries sorted by module
+    name. The dependencies of the modules that aren't up to date come from
+    their subprojects.quark as it is now (if they are there at all), so
+    they are marked as "provisional".
+    """
+    from quark import aio
+
+    root, modules = Subproject.create_dependency_tree(source_dir, options=options, update=False)
+    GitSubproject.remote_refs = None
+    ordered = sorted(modules.values(), key=lambda mod: mod.name)
+    aio.start(aio.gather(*[mod.prefetch() for mod in ordered], return_exceptions=True))
+    # Besides the remote queries above planning is local work, but svn
+    # queries are batched across threads
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        for mod, plan in zip(ordered, executor.map(lambda mod: mod.plan_update(clean), ordered)):
+            mod.plan = plan
+
+    # mod.parents has only the first module requiring it
+    parents = {}
+    for mod in [root] + ordered:
+        for child in mod.children:
+            parents.setdefault(child.name, []).append(mod)
+    provisional = {}
+
+    def is_provisional(mod):
+        if mod.name not in provisional:
+            provisional[mod.name] = False
+            provisional[mod.name] = any(parent is not root and (parent.plan["action"] != "noop" or is_provisional(parent))
+                                        for parent in parents.get(mod.name, []))
+        return provisional[mod.name]
+
+    return [dict(mod.plan, name=mod.name, url=mod.urlstring, directory=os.path.relpath(mod.directory, source_dir),
+                 provisional=is_provisional(mod)) for mod in ordered]
+
+def generate_cmake_script(source_dir, url=None, options=None, print_tree=False,update=True, clean=False, clobber=False, fix_remotes = False, jobs = 1, nested = False):
+    root, modules = Subproject.create_dependency_tree(source_dir, url, options, update=update, clean=clean, clobber=clobber, fix_remotes = fix_remotes, jobs = jobs, nested = nested)
     if print_tree:
         print(json.dumps(root.toJSON(), indent=4))
     conf = load_conf(source_dir)
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+from os.path import exists, join
+
+from quark.utils import (
+    QuarkError,
+    catalog_cache,
+    catalog_etags,
+    catalog_urls_overrides,
+    dependency_file,
+    freeze_file,
+    load_catalog,
+    mkdir,
+    user_cache_dir,
+)
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the layout of the cache file changes
+CACHE_VERSION = 2
+cache_dir = '.quark'
+cache_file = 'tree.json'
+
+def cache_path(source_dir):
+    """
+    In the root of git checkouts the cache goes in .quark, which is in their
+    local ignore list; svn has nothing like that (the file would show up in
+    svn status), so anywhere else it goes in the user cache.
+    """
+    if exists(join(source_dir, '.git')) and not exists(join(source_dir, '.svn')):
+        return join(source_dir, cache_dir, cache_file)
+    return user_cache_dir('trees', hashlib.sha1(os.path.abspath(source_dir).encode('utf-8')).hexdigest() + '.json')
+
+def file_digest(filepath):
+    try:
+        with open(filepath, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+def catalog_digest(url):
+    # Revalidated like for any read-only command (see catalog_ttl), the ETag
+    # tells whether the catalog changed, without hashing it
+    catalog = load_catalog(url, revalidate=False)
+    return catalog_etags.get(url) or hashlib.sha1(json.dumps(catalog, sort_keys=True).encode('utf-8')).hexdigest()
+
+def compute_key(source_dir, directories, catalogs, options):
+    """
+    Builds the set of inputs the resolved tree depends from: the content of
+    every subprojects.quark met while resolving it, of freeze.quark, of the
+    catalogs and the command-line options.
+    """
+    return {
+        "files": {os.path.relpath(filepath, source_dir): file_digest(filepath) for filepath in
+                  [join(source_dir, freeze_file)] + [join(d, dependency_file) for d in directories]},
+        "catalogs": {url: catalog_digest(url) for url in catalogs},
+        "catalog_overrides": {str(k): v for k, v in catalog_urls_overrides.items()},
+        "options": options or {},
+    }
+
+def store(source_dir, root, modules, options=None):
+    def module_entry(mod):
+        return {
+            "name": mod.name,
+            "url": mod.urlstring,
+            "directory": os.path.relpath(mod.directory, source_dir),
+            "options": mod.options,
+            "conf": mod.conf,
+            "exclude_from_cmake": mod.exclude_from_cmake,
+            "external_project": mod.external_project,
+            "children": sorted(c.name for c in mod.children),
+        }
+
+    data = {
+        "version": CACHE_VERSION,
+        "key": compute_key(source_dir,
+                           [source_dir] + [mod.directory for mod in modules.values()],
+                           sorted(catalog_cache.keys()), options),
+        # The root URL isn't stored: its commit moves with every pull,
+        # without touching any of the inputs above
+        "root": {
+            "options": root.options,
+            "children": sorted(c.name for c in root.children),
+        },
+        "modules": [module_entry(mod) for mod in modules.values()],
+    }
+    filepath = cache_path(source_dir)
+    try:
+        mkdir(os.path.dirname(filepath))
+        with open(filepath + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(filepath + '.tmp', filepath)
+    except (IOError, OSError, TypeError, ValueError) as ex:
+        # The cache is just an optimization, never fail because of it
+        logger.debug("Couldn't write dependency tree cache %s: %s" % (filepath, ex))
+
+def load(source_dir, options=None):
+    """
+    Returns the (root, modules) tuple stored by the last resolve of the
+    dependency tree of source_dir, or None if there's no such cache or any
+    of its inputs changed since then.
+    """
+    from quark.subproject import Subproject, url_from_directory
+
+    filepath = cache_path(source_dir)
+    if not exists(filepath):
+        return None
+    try:
+        with open(filepath, 'r') as f:
+            data = json.load(f)
+        if data.get("version") != CACHE_VERSION:
+            return None
+        key = data["key"]
+        directories = [source_dir] + [join(source_dir, m["directory"]) for m in data["modules"]]
+        if compute_key(source_dir, directories, sorted(key["catalogs"].keys()), options) != key:
+            return None
+    except Exception as ex:
+        logger.debug("Ignoring dependency tree cache %s: %s" % (filepath, ex))
+        return None
+
+    try:
+        root_url = url_from_directory(source_dir)
+    except QuarkError:
+        root_url = None
+    root = Subproject.create("root", root_url, source_dir, data["root"]["options"], {}, toplevel = True)
+    modules = {}
+    for m in data["modules"]:
+        modules[m["name"]] = Subproject.create(m["name"], m["url"], join(source_dir, m["directory"]),
+                                               m["options"], m["conf"],
+                                               exclude_from_cmake=m["exclude_from_cmake"],
+                                               external_project=m["external_project"])
+    for parent, children in [(root, data["root"]["children"])] + \
+            [(modules[m["name"]], m["children"]) for m in data["modules"]]:
+        for name in children:
+            parent.children.add(modules[name])
+            modules[name].parents.add(parent)
+    return root, modules
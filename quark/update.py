@@ -1,7 +1,7 @@
 from argparse import ArgumentParser
-from .subproject import generate_cmake_script, Subproject, url_from_directory
-from .utils import parse_option
+from .utils import parse_option, print_msg, reserve_stdout
 from os import getcwd, path
+import json
 from .utils import catalog_urls_overrides
 
 def run():
@@ -29,7 +29,16 @@ def run():
     parser.add_argument("-F", "--fix-remotes", action="store_true", default=False,
             help="If the remote of a git subproject doesn't match what we expect, force it " +
             "to the expected value instead of giving up; useful if a repo moved.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+            help="Number of subprojects to fetch/update in parallel")
+    parser.add_argument("--plan", action="store_true", default=False,
+            help="Don't update anything, just print in JSON format what updating each subproject " +
+            "would do (clone, fetch, checkout, download, resolve, noop or error), judging from " +
+            "the local checkouts and, for git branches and missing tags, from what they point to " +
+            "on the remote (one git ls-remote per remote, nothing is fetched)")
     optlist = parser.parse_args()
+    # The backends are imported only now, --help doesn't need them
+    from .subproject import generate_cmake_script, plan_update, GitSubproject, Subproject, url_from_directory
     source_dir = path.abspath(optlist.source_directory or getcwd())
     options = {}
     if optlist.options:
@@ -44,11 +53,23 @@ def run():
         for k,v in optlist.catalog_override:
             catalog_urls_overrides[k] = v
 
+    if optlist.plan:
+        # The plan must be parsable, whatever the commands we run print
+        with reserve_stdout() as output:
+            json.dump({"modules": plan_update(source_dir, options=options, clean=optlist.clean)}, output,
+                      indent=2, sort_keys=True)
+            output.write("\n")
+        return
+
     if not optlist.deps_only:
         root_url = url_from_directory(source_dir, include_commit = False)
         root = Subproject.create("root", root_url, source_dir, {}, toplevel = True)
         root.update(optlist.clean)
-    generate_cmake_script(source_dir, print_tree=optlist.verbose, options=options, clean=optlist.clean, clobber = optlist.clobber, fix_remotes = optlist.fix_remotes)
+    generate_cmake_script(source_dir, print_tree=optlist.verbose, options=options, clean=optlist.clean, clobber = optlist.clobber, fix_remotes = optlist.fix_remotes, jobs = optlist.jobs)
+    if Subproject.skipped_updates:
+        print_msg("%d modules already up to date" % Subproject.skipped_updates)
+    if GitSubproject.skipped_fetches:
+        print_msg("skipped %d fetches, required commits/tags already present" % GitSubproject.skipped_fetches)
 
 if __name__ == "__main__":
     run()
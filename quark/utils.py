@@ -1,20 +1,26 @@
-from contextlib import contextmanager
 import sys
 import os
 import os.path as path
-import subprocess
 import argparse
 import json
 import logging
 import errno
 import copy
 import re
+import time
 
 dependency_file = 'subprojects.quark'
 freeze_file = 'freeze.quark'
 logger = logging.getLogger(__name__)
 catalog_cache = {}
+# ETag of the catalogs in catalog_cache, if their server sent one
+catalog_etags = {}
 catalog_urls_overrides = {}
+# Seconds to wait for the catalog server when there's a cached copy to fall back to
+catalog_timeout = 10
+
+class QuarkError(RuntimeError):
+    pass
 
 def workaround_url_read(url):
     """
@@ -40,10 +46,24 @@ def workaround_url_read(url):
     system certificate store; so, if urllib fails due to SSL errors, we try
     that route as well.
     """
-    from urllib.request import urlopen
-    from urllib.error import URLError
+    return workaround_url_open(url)[0]
+
+def workaround_url_open(url, headers=None, timeout=None):
+    """
+    Like workaround_url_read, but also sends the given headers and returns the
+    (body, response headers) tuple; body is None if the server answered 304
+    Not Modified to a conditional request.
+    """
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
     try:
-        return urlopen(url).read()
+        kwargs = {} if timeout is None else {"timeout": timeout}
+        with urlopen(Request(url, headers=headers or {}), **kwargs) as response:
+            return response.read(), response.headers
+    except HTTPError as ex:
+        if ex.code == 304:
+            return None, ex.headers
+        raise
     except URLError as ex:
         import ssl
         if len(ex.args) and isinstance(ex.args[0], ssl.SSLError):
@@ -52,8 +72,9 @@ def workaround_url_read(url):
                 return log_check_output(["curl", "-s", url])
 
             try:
-                # Try with command-line cURL
-                return curl_url_read(url)
+                # Try with command-line cURL (no conditional requests there,
+                # just get the whole thing)
+                return curl_url_read(url), {}
             except:
                 # Re-raise original exception - maybe SSL _is_ broken after all
                 raise ex
@@ -61,7 +82,92 @@ def workaround_url_read(url):
             workaround_url_read = curl_url_read
         raise
 
-def load_conf(folder):
+def catalog_cache_dir():
+    return cache_setting("QUARK_CATALOG_CACHE", "catalogs", True)
+
+def catalog_ttl():
+    """
+    Seconds during which the read-only commands use a catalog fetched by a
+    previous run as is, without asking the server whether it changed.
+    """
+    return float(os.environ.get("QUARK_CATALOG_TTL", "300"))
+
+def load_catalog(url, revalidate=True):
+    """
+    Returns the catalog at url, going through the on-disk catalog cache; a
+    cached copy is always revalidated with the server (with a conditional
+    request), unless revalidate is False and it's younger than catalog_ttl().
+    """
+    # The catalog is often the same for all dependencies, don't
+    # hammer the server *and* make sure we have a coherent view
+    if url not in catalog_cache:
+        catalog_cache[url] = fetch_catalog(url, revalidate)
+    return catalog_cache[url]
+
+def fetch_catalog(url, revalidate=True):
+    import hashlib
+    import subprocess
+    import tempfile
+
+    cache_dir = catalog_cache_dir()
+    if not cache_dir:
+        catalog_etags.pop(url, None)
+        return json.loads(workaround_url_read(url).decode('utf-8'))
+
+    cache_file = path.join(cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+    cached = None
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached["url"] != url:
+            cached = None
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        cached = None
+    if cached is not None and not revalidate and time.time() - cached["fetched"] < catalog_ttl():
+        catalog_etags[url] = cached.get("etag")
+        return cached["catalog"]
+    import http.client
+
+    headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    try:
+        body, response_headers = workaround_url_open(url, headers, catalog_timeout if cached else None)
+        if body is not None:
+            entry = {
+                "url": url,
+                "etag": response_headers.get("ETag"),
+                "last_modified": response_headers.get("Last-Modified"),
+                "catalog": json.loads(body.decode('utf-8')),
+            }
+        else:
+            entry = cached
+    except (OSError, http.client.HTTPException, subprocess.CalledProcessError, ValueError) as ex:
+        # HTTPException: e.g. IncompleteRead, the connection dropped mid-body
+        if cached is None:
+            raise
+        catalog_etags[url] = cached.get("etag")
+        logger.warning("Couldn't fetch catalog %s (%s), using the copy from %s" % (
+            url, ex, time.strftime("%Y-%m-%d %H:%M", time.localtime(cached["fetched"]))))
+        return cached["catalog"]
+
+    entry["fetched"] = time.time()
+    catalog_etags[url] = entry["etag"]
+    try:
+        mkdir(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, cache_file)
+    except (IOError, OSError) as ex:
+        # The cache is just an optimization, never fail because of it
+        logger.debug("Couldn't write catalog cache %s: %s" % (cache_file, ex))
+    return entry["catalog"]
+
+def load_conf(folder, revalidate_catalog=True):
     filepath = path.join(folder, dependency_file)
     if path.exists(filepath):
         jsonfile = path.join(folder, dependency_file)
@@ -81,11 +187,7 @@ def load_conf(folder):
                     if catalog_url in catalog_urls_overrides:
                         catalog_url = catalog_urls_overrides[catalog_url]
 
-                    # The catalog is often the same for all dependencies, don't
-                    # hammer the server *and* make sure we have a coherent view
-                    if catalog_url not in catalog_cache:
-                        catalog_cache[catalog_url] = json.loads(workaround_url_read(catalog_url).decode('utf-8'))
-                    cat = catalog_cache[catalog_url]
+                    cat = load_catalog(catalog_url, revalidate_catalog)
 
                     def filldefault(depends):
                         for module, opts in depends.items():
@@ -110,7 +212,44 @@ def load_conf(folder):
     else:
         return None
 
-def print_msg(msg, comment = "", stream = sys.stdout):
+def user_cache_dir(*parts):
+    """
+    Per-user directory for caches shared between all the projects on the
+    machine (QUARK_CACHE_DIR, or the platform-specific default).
+    """
+    base = os.environ.get("QUARK_CACHE_DIR")
+    if not base:
+        if sys.platform == "win32":
+            base = path.join(os.environ.get("LOCALAPPDATA", path.expanduser("~")), "quark", "cache")
+        else:
+            base = path.join(os.environ.get("XDG_CACHE_HOME", path.expanduser(path.join("~", ".cache"))), "quark")
+    return path.join(base, *parts)
+
+def cache_setting(variable, subdir, default):
+    """
+    Reads the environment variable controlling a cache, which can be either a
+    boolean (to enable it in its default location) or the path to use;
+    returns None if the cache is disabled.
+    """
+    value = os.environ.get(variable, "")
+    if not value:
+        enabled = default
+    else:
+        try:
+            enabled = str2bool(value)
+        except argparse.ArgumentTypeError:
+            return path.abspath(path.expanduser(value))
+    return user_cache_dir(subdir) if enabled else None
+
+def git_cache_dir():
+    # Shared git mirrors are opt-in (unset or empty means disabled), clones
+    # made with them depend on the cache
+    return cache_setting("QUARK_GIT_CACHE", "git", False)
+
+def artifact_cache_dir():
+    return cache_setting("QUARK_ARTIFACT_CACHE", "artifacts", True)
+
+def print_msg(msg, comment = "", stream = sys.stdout, cwd = None):
     if comment:
         comment = " (" + comment + ")"
     yellow = green = reset = blue = ""
@@ -121,22 +260,37 @@ def print_msg(msg, comment = "", stream = sys.stdout):
         blue  = "\x1b[34m"
     stream.write(
         yellow + "quark: " +
-        green + os.getcwd() + reset + '$ ' +
+        green + (cwd or os.getcwd()) + reset + '$ ' +
         msg +
         blue + comment +
         reset + "\n")
     stream.flush()
 
-def print_cmd(cmd, comment = "", stream = sys.stdout):
-    print_msg(" ".join(cmd), comment, stream)
+def print_cmd(cmd, comment = "", stream = sys.stdout, cwd = None):
+    print_msg(" ".join(cmd), comment, stream, cwd)
+
+def reserve_stdout(mode='w'):
+    """
+    Returns a file object writing to the standard output, which from now on
+    is taken by it alone: anything else written there (by us, e.g. with
+    print_cmd, or by the commands we run) goes to the standard error.
+    """
+    sys.stdout.flush()
+    output = os.fdopen(os.dup(sys.stdout.fileno()), mode)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    return output
 
-def fork(*args, **kwargs):
-    print_cmd(args[0])
-    return subprocess.check_call(*args, **kwargs)
+# Synchronous facade of the quark.aio commands engine (imported lazily, as
+# asyncio is relatively expensive and some commands, e.g. `quark query`, never
+# run anything)
 
-def log_check_output(*args, **kwargs):
-    print_cmd(args[0], "captured")
-    return subprocess.check_output(*args, **kwargs)
+def fork(cmd, **kwargs):
+    from quark import aio
+    return aio.run_sync(aio.check_call(cmd, **kwargs))
+
+def log_check_output(cmd, **kwargs):
+    from quark import aio
+    return aio.run_sync(aio.check_output(cmd, **kwargs))
 
 def parse_option(s):
     eq = s.find('=')
@@ -166,6 +320,107 @@ def mkdir(path):
         if ex.errno != errno.EEXIST or not os.path.isdir(path):
             raise
 
+# How the files are put in the destination by copy_files/mirror_files
+MIRROR_MODES = ('copy', 'hardlink', 'reflink')
+# Linux ioctl cloning a file (copy-on-write) on btrfs, XFS and the like
+FICLONE = 0x40049409
+link_fallback_warned = False
+
+def copy_file(src, dst, mode='copy'):
+    """
+    Puts src in dst (which must not exist) as a copy, a hard link or a
+    reflink (a copy-on-write clone); symlinks are always copied as such, and
+    if the link can't be made (different filesystems, unsupported
+    filesystem or platform) the file is copied.
+    """
+    import shutil
+
+    global link_fallback_warned
+    if mode != 'copy' and not path.islink(src):
+        try:
+            if mode == 'hardlink':
+                os.link(src, dst)
+            else:
+                import fcntl
+
+                with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                shutil.copystat(src, dst)
+            return
+        except (OSError, ImportError) as ex:
+            if path.lexists(dst):
+                os.unlink(dst)
+            if not link_fallback_warned:
+                link_fallback_warned = True
+                logger.warning("Cannot %s %s (%s), copying the files instead" % (mode, src, ex))
+    shutil.copy2(src, dst, follow_symlinks=False)
+
+def copy_files(src_dir, dst_dir, relpaths, jobs=8, mode='copy'):
+    """
+    Puts the files relpaths (relative to src_dir) into dst_dir with
+    copy_file; the copies run in jobs threads, as they spend most of their
+    time waiting on the filesystem.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    for d in sorted(set(path.dirname(p) for p in relpaths)):
+        mkdir(path.join(dst_dir, d))
+
+    def copy(relpath):
+        dst = path.join(dst_dir, relpath)
+        # Never write through what's there, it may be a symlink or a hard
+        # link to the source
+        if path.lexists(dst):
+            os.unlink(dst)
+        copy_file(path.join(src_dir, relpath), dst, mode)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # list() to get the exceptions out
+        list(executor.map(copy, relpaths))
+
+def mirror_files(src_dir, dst_dir, files, previous=None, mode='copy'):
+    """
+    Mirrors files from src_dir into dst_dir; files maps each relative path
+    to an identifier of its content, if known without reading it (e.g. the
+    git blob of an unmodified file), or None.
+
+    Returns the manifest of the mirror, mapping each path to its size,
+    mtime, mode and content identifier. Given the manifest of the previous
+    mirror into dst_dir, the files unchanged since then are left alone and
+    the ones not there anymore are removed.
+    """
+    manifest = {}
+    changed = []
+    for relpath, blob in files.items():
+        st = os.lstat(path.join(src_dir, relpath))
+        entry = {"size": st.st_size, "mtime": st.st_mtime_ns, "mode": st.st_mode, "blob": blob}
+        manifest[relpath] = entry
+        old = (previous or {}).get(relpath)
+        if old is not None and old["mode"] == entry["mode"] and path.lexists(path.join(dst_dir, relpath)):
+            if blob is not None and old["blob"] is not None:
+                # The content is known on both sides, the stat data proves
+                # nothing (e.g. a checkout can leave size and mtime alone)
+                if old["blob"] == blob:
+                    continue
+            elif (old["size"], old["mtime"]) == (entry["size"], entry["mtime"]):
+                continue
+        changed.append(relpath)
+    copy_files(src_dir, dst_dir, changed, mode=mode)
+
+    for relpath in set(previous or {}) - set(manifest):
+        dst = path.join(dst_dir, relpath)
+        if path.lexists(dst):
+            os.unlink(dst)
+        # Prune the directories left empty
+        parent = path.dirname(relpath)
+        while parent:
+            try:
+                os.rmdir(path.join(dst_dir, parent))
+            except OSError:
+                break
+            parent = path.dirname(parent)
+    return manifest
+
 def str2bool(v):
     if v.lower() in {'yes', 'true', 't', 'y', '1', 'on'}:
         return True
@@ -179,11 +434,3 @@ def cmake_escape(s):
     equals = max(re.findall('=+', s), key=len, default='') + '='
     return '[%s[%s]%s]' % (equals, s, equals)
 
-@contextmanager
-def DirectoryContext(newdir):
-    prevdir = os.getcwd()
-    os.chdir(newdir)
-    try:
-        yield
-    finally:
-        os.chdir(prevdir)
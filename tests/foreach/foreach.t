@@ -31,10 +31,9 @@
   $ ROOT_TEST=$CRAMPTESTDIR/checkout/test_dir_1
   $ $_QUARK up > /dev/null 2>&1
 
-# Test foreach's output with a simple echo of its env variables
+# Test foreach's output with a simple echo of its env variables; the URL of
+# the root is read from its .git directory, without running git
   $ $_QUARK foreach 'echo $name $sm_path $displaypath $sha1 $toplevel $rev $version_control'
-  .* (re)
-  .* (re)
   Entering test_dir_2
   test_dir_2 src/test_dir_2 src/test_dir_2 .+ /tmp/cramtests-.*/foreach.t/checkout/test_dir_1 git (re)
   Entering test_dir_3
@@ -42,10 +41,9 @@
   Entering test_dir_4
   test_dir_4 src/test_dir_4 src/test_dir_4 .+ /tmp/cramtests-.*/foreach.t/checkout/test_dir_1 git (re)
 
-# Test foreach with a shell script
+# Test foreach with a shell script; the dependency tree is unchanged, so it's
+# loaded from the cache without querying the root repository
   $ $_QUARK foreach $TESTDIR/foreach.sh
-  .* (re)
-  .* (re)
   Entering test_dir_2
   name: test_dir_2
   sm_path: src/test_dir_2
@@ -80,11 +78,48 @@
 # The check for the hashes is done by the regex '[a-fA-F0-9]{40}'
 # (Match exactly 40 times any word character)
   $ $_QUARK foreach 'echo $name $sm_path $displaypath $sha1 $toplevel $rev $version_control'
-  .* (re)
-  .* (re)
   Entering test_dir_2
   test_dir_2 src/test_dir_2 src/test_dir_2 [a-fA-F0-9]{40} /tmp/cramtests-.*/foreach.t/checkout/test_dir_1 git (re)
   Entering test_dir_3
   test_dir_3 src/test_dir_3 src/test_dir_3 [a-fA-F0-9]{40} /tmp/cramtests-.*/foreach.t/checkout/test_dir_1 git (re)
   Entering test_dir_4
   test_dir_4 src/test_dir_4 src/test_dir_4 [a-fA-F0-9]{40} /tmp/cramtests-.*/foreach.t/checkout/test_dir_1 git (re)
+
+# Run in parallel: the output of each subproject is collected and printed in
+# order, stderr included
+  $ $_QUARK foreach -j 3 'echo $name; echo $sm_path >&2'
+  Entering test_dir_2
+  test_dir_2
+  src/test_dir_2
+  Entering test_dir_3
+  test_dir_3
+  src/test_dir_3
+  Entering test_dir_4
+  test_dir_4
+  src/test_dir_4
+
+# Streamed output, each line prefixed with the subproject name
+  $ $_QUARK foreach -j 3 --stream 'echo $version_control; echo $sm_path' | sort
+  test_dir_2: git
+  test_dir_2: src/test_dir_2
+  test_dir_3: git
+  test_dir_3: src/test_dir_3
+  test_dir_4: git
+  test_dir_4: src/test_dir_4
+
+# Stop at the first failure, with the status of the failed command...
+  $ $_QUARK foreach -q 'pwd | sed "s|.*/||"; test $name != test_dir_3 || exit 3'
+  test_dir_2
+  test_dir_3
+  Command failed in test_dir_3 (exit status 3)
+  [3]
+
+# ... or keep going and summarize the failures
+  $ $_QUARK foreach -q -j 2 --keep-going 'echo $name; test $name = test_dir_3'
+  test_dir_2
+  test_dir_3
+  test_dir_4
+  Command failed in 2 subprojects:
+    test_dir_2 (exit status 1)
+    test_dir_4 (exit status 1)
+  [1]
@@ -0,0 +1,83 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from unittest import mock
+
+from quark import aio
+from quark.utils import fork, log_check_output
+
+
+def python(code):
+    return [sys.executable, "-c", code]
+
+
+class TestAio(unittest.TestCase):
+    def test_facade(self):
+        self.assertEqual(b"out\n", log_check_output(python("print('out')")))
+        self.assertEqual("out\n", log_check_output(python("print('out')"), universal_newlines=True))
+        self.assertEqual(0, fork(python("pass")))
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            log_check_output(python("print('partial'); raise SystemExit(3)"))
+        self.assertEqual(3, cm.exception.returncode)
+        self.assertEqual(b"partial\n", cm.exception.output)
+
+    def test_cwd_and_env(self):
+        out = log_check_output(python("import os; print(os.getcwd(), os.environ['QUARK_TEST'])"),
+                               cwd=aio.__file__.rsplit("quark", 1)[0], env={"QUARK_TEST": "x"},
+                               universal_newlines=True)
+        self.assertTrue(out.endswith(" x\n"))
+
+    def test_commands_overlap(self):
+        start = time.time()
+        results = aio.run_sync(aio.gather(*[
+            aio.check_output(python("import time; time.sleep(0.5); print(%d)" % i)) for i in range(4)]))
+        self.assertEqual([b"%d\n" % i for i in range(4)], results)
+        self.assertLess(time.time() - start, 1.5)
+
+    def test_host_limit(self):
+        start = time.time()
+        with mock.patch.dict(os.environ, {"QUARK_MAX_PER_HOST": "1"}):
+            aio.run_sync(aio.gather(*[
+                aio.check_output(python("import time; time.sleep(0.3)"), host="limited.example.com") for i in range(3)]))
+        self.assertGreater(time.time() - start, 0.9)
+
+    def test_run_sync_from_threads(self):
+        results = {}
+
+        def worker(i):
+            results[i] = log_check_output(python("print(%d)" % i))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual({i: b"%d\n" % i for i in range(8)}, results)
+
+    def test_no_run_sync_on_loop(self):
+        async def nested():
+            return fork(python("pass"))
+
+        with self.assertRaises(RuntimeError):
+            aio.run_sync(nested())
+
+    def test_batch(self):
+        batches = []
+
+        async def run_batch(targets):
+            batches.append(sorted(targets))
+            return {target: ValueError(target) if target == "bad" else target.upper()
+                    for target in targets if target != "missing"}
+
+        batch = aio.Batch(run_batch)
+        results = aio.run_sync(aio.gather(*[batch.query(t) for t in ("a", "b", "a")]))
+        self.assertEqual(["A", "B", "A"], results)
+        self.assertEqual([["a", "b"]], batches)
+
+        for target, error in (("bad", ValueError), ("missing", KeyError)):
+            with self.assertRaises(error):
+                aio.run_sync(batch.query(target))
+        self.assertEqual("C", aio.run_sync(batch.query("c")))
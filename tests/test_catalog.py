@@ -0,0 +1,132 @@
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from os.path import join
+from unittest import mock
+
+from quark import utils
+
+CATALOG = {"imagelib": {"url": "git+https://git.example.com/imagelib.git"}}
+
+
+class CatalogHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.server.truncated:
+            # announces more than it sends
+            self.send_response(200)
+            self.send_header("Content-Length", "1000")
+            self.end_headers()
+            self.wfile.write(b"{")
+            return
+        if self.headers.get("If-None-Match") == self.server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(self.server.catalog).encode()
+        self.send_response(200)
+        self.send_header("ETag", self.server.etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestCatalogCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), CatalogHandler)
+        self.server.requests = []
+        self.server.catalog = CATALOG
+        self.server.etag = '"v1"'
+        self.server.truncated = False
+        thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d/catalog.json" % self.server.server_address[1]
+        self.env = mock.patch.dict(os.environ, {"QUARK_CACHE_DIR": join(self.tmpdir, "cache")})
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        self.stop_server()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def stop_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def load(self, **kwargs):
+        # Each quark invocation starts with an empty in-process cache
+        with mock.patch.object(utils, "catalog_cache", {}):
+            return utils.load_catalog(self.url, **kwargs)
+
+    def test_fresh_copy_used_as_is(self):
+        # by the read-only commands
+        self.assertEqual(CATALOG, self.load(revalidate=False))
+        self.assertEqual(CATALOG, self.load(revalidate=False))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_revalidation(self):
+        self.assertEqual(CATALOG, self.load())
+        # quark up asks every time, however fresh the cached copy
+        self.assertEqual(CATALOG, self.load())
+        self.assertEqual('"v1"', self.server.requests[1]["If-None-Match"])
+        self.server.catalog = {}
+        self.server.etag = '"v2"'
+        # read-only commands don't, within the TTL
+        self.assertEqual(CATALOG, self.load(revalidate=False))
+        self.assertEqual(2, len(self.server.requests))
+        self.assertEqual({}, self.load())
+        self.assertEqual(3, len(self.server.requests))
+        self.server.catalog = CATALOG
+        self.server.etag = '"v3"'
+        with mock.patch.dict(os.environ, {"QUARK_CATALOG_TTL": "0"}):
+            self.assertEqual(CATALOG, self.load(revalidate=False))
+            self.assertEqual(4, len(self.server.requests))
+
+    def test_offline_fallback(self):
+        self.assertEqual(CATALOG, self.load())
+        self.stop_server()
+        with mock.patch.dict(os.environ, {"QUARK_CATALOG_TTL": "0"}):
+            self.assertEqual(CATALOG, self.load())
+
+    def test_truncated_fallback(self):
+        self.assertEqual(CATALOG, self.load())
+        self.server.truncated = True
+        self.assertEqual(CATALOG, self.load())
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_tree_cache_key(self):
+        from quark import treecache
+
+        def key():
+            with mock.patch.object(utils, "catalog_cache", {}):
+                return treecache.catalog_digest(self.url)
+
+        self.assertEqual('"v1"', key())
+        self.server.catalog = {}
+        self.server.etag = '"v2"'
+        self.assertEqual('"v1"', key())
+        # once the cached copy is stale, the key follows the server
+        with mock.patch.dict(os.environ, {"QUARK_CATALOG_TTL": "0"}):
+            self.assertEqual('"v2"', key())
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_cache_disabled(self):
+        with mock.patch.dict(os.environ, {"QUARK_CATALOG_CACHE": "no"}):
+            self.assertEqual(CATALOG, self.load())
+            self.assertEqual(CATALOG, self.load())
+            self.assertEqual(2, len(self.server.requests))
+            self.stop_server()
+            with self.assertRaises(OSError):
+                self.load()
+        self.assertFalse(os.path.exists(join(self.tmpdir, "cache")))
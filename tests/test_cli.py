@@ -0,0 +1,66 @@
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+
+from quark import cli
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+        self.bin_dir = join(self.tmpdir, "bin")
+        os.mkdir(self.bin_dir)
+        self.env = mock.patch.dict(os.environ, {
+            "QUARK_CACHE_DIR": join(self.tmpdir, "cache"),
+            "PATH": self.bin_dir,
+        })
+        self.env.start()
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def add_exe(self, name, code=0):
+        path = join(self.bin_dir, name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\necho \"$@\" > %s.out\nexit %d\n" % (join(self.tmpdir, name), code))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+        return path
+
+    def run_main(self, *args):
+        with mock.patch.object(sys, "argv", ["quark"] + list(args)):
+            cli.main()
+
+    def test_builtin_in_process(self):
+        # the console scripts of the builtins are never spawned
+        self.add_exe("quark-status", 1)
+        status = mock.Mock()
+        with mock.patch.object(cli, "commands", [("status", status)]), \
+                mock.patch.object(sys, "argv", ["quark", "st", "-v"]):
+            cli.main()
+            self.assertEqual(["quark st", "-v"], sys.argv)
+        status.assert_called_once_with()
+
+    @unittest.skipIf(os.name == "nt", "needs a POSIX shell")
+    def test_plugins(self):
+        self.add_exe("quark-hello")
+        self.run_main("hello", "world")
+        with open(join(self.tmpdir, "quark-hello.out")) as f:
+            self.assertEqual("world\n", f.read())
+
+        with mock.patch.object(cli, "scan_plugins", wraps=cli.scan_plugins) as scan:
+            self.run_main("hello")
+            self.assertEqual(0, scan.call_count)
+            # new plugins are found
+            self.add_exe("quark-other", 3)
+            with self.assertRaises(SystemExit) as cm:
+                self.run_main("other")
+            self.assertEqual(3, cm.exception.code)
+            with self.assertRaises(SystemExit):
+                self.run_main()
+            self.assertEqual(["hello", "other"], sorted(cli.plugins()))
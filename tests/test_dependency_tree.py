@@ -0,0 +1,410 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+
+from quark import aio, gitdir, subproject
+from quark.subproject import GitSubproject, Subproject, generate_cmake_script, plan_update
+from quark.utils import freeze_file
+
+
+def git(*args, cwd=None):
+    subprocess.check_call(("git",) + args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class TestDependencyTree(unittest.TestCase):
+    """
+    Builds a diamond-shaped tree of local git repositories:
+
+        root -> a, b, d
+        a    -> c (C_FOO)
+        b    -> c, d (D_BAR) and, if B_OPT, c (C_EXTRA)
+        c    -> d and, if C_EXTRA, e
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+        self.repos = join(self.tmpdir, "repos")
+        os.mkdir(self.repos)
+        self._make_repo("e", None)
+        self._make_repo("d", None)
+        self._make_repo("c", {
+            "depends": {"d": {"url": self._url("d")}},
+            "optdepends": {"C_EXTRA": [{"value": True, "depends": {"e": {"url": self._url("e")}}}]},
+        })
+        self._make_repo("a", {
+            "depends": {"c": {"url": self._url("c"), "options": {"C_FOO": True}}},
+        })
+        self._make_repo("b", {
+            "depends": {"c": {"url": self._url("c")}, "d": {"options": {"D_BAR": 3}}},
+            "optdepends": {"B_OPT": {"value": True, "depends": {"c": {"options": {"C_EXTRA": True}}}}},
+        })
+        self._make_repo("root", {
+            "toplevel_options": {"B_OPT": True},
+            "depends": {
+                "d": {"url": self._url("d")},
+                "a": {"url": self._url("a")},
+                "b": {"url": self._url("b") + "#branch=master"},
+            },
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _url(self, name):
+        return "git+file://" + join(self.repos, name)
+
+    def _make_repo(self, name, conf):
+        path = join(self.repos, name)
+        os.mkdir(path)
+        git("-c", "init.defaultBranch=master", "init", "-q", cwd=path)
+        if conf is not None:
+            with open(join(path, "subprojects.quark"), "w") as f:
+                json.dump(conf, f)
+        with open(join(path, "CMakeLists.txt"), "w") as f:
+            f.write("project(%s)\n" % name)
+        git("add", "-A", cwd=path)
+        git("-c", "user.name=test", "-c", "user.email=test", "commit", "-q", "-m", "init", cwd=path)
+
+    def _checkout(self, dest, **kwargs):
+        git("clone", "-q", "file://" + join(self.repos, "root"), dest)
+        generate_cmake_script(dest, **kwargs)
+        with open(join(dest, "lib", "CMakeLists.txt")) as f:
+            return f.read()
+
+    def test_cmake_script(self):
+        cmakelists = self._checkout(join(self.tmpdir, "serial"))
+        self.assertEqual(
+            "set(D_BAR 3 CACHE INTERNAL \"\" FORCE)\n"
+            "add_subdirectory([=[d]=])\n"
+            "add_subdirectory([=[e]=])\n"
+            "set(C_EXTRA ON CACHE INTERNAL \"\" FORCE)\n"
+            "set(C_FOO ON CACHE INTERNAL \"\" FORCE)\n"
+            "add_subdirectory([=[c]=])\n"
+            "add_subdirectory([=[a]=])\n"
+            "add_subdirectory([=[b]=])\n"
+            "set(B_OPT ON CACHE INTERNAL \"\" FORCE)\n",
+            cmakelists,
+        )
+
+    def test_parallel_update_same_cmake_script(self):
+        serial = self._checkout(join(self.tmpdir, "serial"))
+        parallel = self._checkout(join(self.tmpdir, "parallel"), jobs=4)
+        self.assertEqual(serial, parallel)
+        for name in "abcde":
+            self.assertTrue(os.path.isdir(join(self.tmpdir, "parallel", "lib", name, ".git")))
+
+    def test_no_chdir(self):
+        # The VCS layer runs in threads, it must never touch the process cwd
+        with mock.patch("os.chdir", side_effect=AssertionError("os.chdir called")):
+            self._checkout(join(self.tmpdir, "checkout"), jobs=4)
+            root, modules = Subproject.load_dependency_tree(join(self.tmpdir, "checkout"))
+            self.assertEqual(self._url("c") + "#commit=",
+                             GitSubproject.url_from_directory(modules["c"].directory)[:len(self._url("c")) + 8])
+            modules["c"].mirror(join(self.tmpdir, "mirror"))
+        with open(join(self.tmpdir, "mirror", "CMakeLists.txt")) as f:
+            self.assertEqual("project(c)\n", f.read())
+
+    def test_update_spawns(self):
+        dest = join(self.tmpdir, "checkout")
+        self._checkout(dest)
+        # moving a branch forward is a fetch, a checkout and a fast-forward
+        with open(join(self.repos, "d", "new"), "w") as f:
+            f.write("new\n")
+        git("add", "-A", cwd=join(self.repos, "d"))
+        git("-c", "user.name=test", "-c", "user.email=test", "commit", "-q", "-m", "new", cwd=join(self.repos, "d"))
+        git("checkout", "-q", "--detach", cwd=join(dest, "lib", "d"))
+
+        commands = []
+        real_run = aio.run
+
+        async def run(cmd, **kwargs):
+            commands.append((os.path.basename(kwargs.get("cwd") or ""), cmd))
+            return await real_run(cmd, **kwargs)
+
+        with mock.patch.object(aio, "run", run):
+            generate_cmake_script(dest)
+        # the branches are resolved with a git ls-remote per repository, and
+        # the modules already there are only checked for local modifications
+        self.assertEqual(sorted(self._url(name)[len("git+"):] for name in "abcde"),
+                         sorted(cmd[-1] for cwd, cmd in commands if cmd[:2] == ["git", "ls-remote"]))
+        for name in "abce":
+            self.assertEqual([["git", "status", "--porcelain=v2", "--branch"]],
+                             [cmd for cwd, cmd in commands if cwd == name])
+        # the status, the fetch, the refs, the checkout, the merge and the
+        # final check
+        self.assertEqual(6, len([cmd for cwd, cmd in commands if cwd == "d"]))
+        self.assertTrue(os.path.exists(join(dest, "lib", "d", "new")))
+
+    def test_remote_queries_ahead_only_in_parallel(self):
+        dest = join(self.tmpdir, "checkout")
+        self._checkout(dest)
+        flags = []
+        real_prefetch = GitSubproject.prefetch
+
+        async def prefetch(mod, remote=True):
+            flags.append(remote)
+            await real_prefetch(mod, remote)
+
+        with mock.patch.object(GitSubproject, "prefetch", prefetch):
+            generate_cmake_script(dest)
+            self.assertEqual({False}, set(flags))
+            del flags[:]
+            generate_cmake_script(dest, jobs=4)
+            self.assertEqual({True}, set(flags))
+
+    def test_remote_refs_kept_by_nested_updates(self):
+        dest = join(self.tmpdir, "checkout")
+        self._checkout(dest)
+        generate_cmake_script(dest)
+        memo = GitSubproject.remote_refs
+        self.assertIsNotNone(memo)
+        # e.g. an external project: still the same update
+        generate_cmake_script(join(dest, "lib", "a"), nested=True)
+        self.assertIs(memo, GitSubproject.remote_refs)
+        generate_cmake_script(dest)
+        self.assertIsNot(memo, GitSubproject.remote_refs)
+
+    def test_shared_dependencies_expanded_once(self):
+        dest = join(self.tmpdir, "checkout")
+        git("clone", "-q", "file://" + join(self.repos, "root"), dest)
+        generate_cmake_script(dest)
+        loaded = []
+
+        def load_conf(folder, **kwargs):
+            loaded.append(os.path.basename(folder.rstrip(os.sep)))
+            return real_load_conf(folder, **kwargs)
+
+        real_load_conf = subproject.load_conf
+        with mock.patch.object(subproject, "load_conf", load_conf):
+            root, modules = Subproject.create_dependency_tree(dest)
+        self.assertEqual(["a", "b", "c", "d", "e"], sorted(modules))
+        self.assertEqual(["a", "b", "c", "checkout", "checkout", "d", "e"], sorted(loaded))
+
+    def test_late_option_enables_optdepends(self):
+        # z is expanded (through y) before x enables Z_OPT on it
+        self._make_repo("w", None)
+        self._make_repo("z", {
+            "optdepends": {"Z_OPT": [{"value": True, "depends": {"w": {"url": self._url("w")}}}]},
+        })
+        self._make_repo("y", {"depends": {"z": {"url": self._url("z")}}})
+        self._make_repo("x", {"depends": {"z": {"url": self._url("z"), "options": {"Z_OPT": True}}}})
+        with open(join(self.repos, "root", "subprojects.quark"), "w") as f:
+            json.dump({"depends": {"x": {"url": self._url("x")}, "y": {"url": self._url("y")}}}, f)
+        git("-c", "user.name=test", "-c", "user.email=test", "commit", "-q", "-a", "-m", "xyz",
+            cwd=join(self.repos, "root"))
+        dest = join(self.tmpdir, "checkout")
+        git("clone", "-q", "file://" + join(self.repos, "root"), dest)
+        generate_cmake_script(dest)
+        root, modules = Subproject.create_dependency_tree(dest)
+        self.assertEqual(["w", "x", "y", "z"], sorted(modules))
+        self.assertEqual({"w"}, {c.name for c in modules["z"].children})
+
+    def test_load_dependency_tree_cache(self):
+        dest = join(self.tmpdir, "checkout")
+        git("clone", "-q", "file://" + join(self.repos, "root"), dest)
+        generate_cmake_script(dest)
+        root, modules = Subproject.load_dependency_tree(dest)
+        with mock.patch.object(Subproject, "create_dependency_tree") as create:
+            cached_root, cached_modules = Subproject.load_dependency_tree(dest)
+            self.assertFalse(create.called)
+        self.assertEqual(root.options, cached_root.options)
+        self.assertEqual({c.name for c in root.children}, {c.name for c in cached_root.children})
+        self.assertEqual(sorted(modules), sorted(cached_modules))
+        for name, mod in modules.items():
+            self.assertEqual(mod.urlstring, cached_modules[name].urlstring)
+            self.assertEqual(mod.options, cached_modules[name].options)
+            self.assertEqual({c.name for c in mod.children}, {c.name for c in cached_modules[name].children})
+
+        # any change in a subprojects.quark invalidates the cache
+        with open(join(dest, "lib", "e", "subprojects.quark"), "w") as f:
+            json.dump({"depends": {}}, f)
+        with mock.patch.object(Subproject, "create_dependency_tree", return_value=(root, modules)) as create:
+            Subproject.load_dependency_tree(dest)
+            self.assertTrue(create.called)
+
+    def test_tree_cache_root_commit(self):
+        dest = join(self.tmpdir, "checkout")
+        git("clone", "-q", "file://" + join(self.repos, "root"), dest)
+        generate_cmake_script(dest)
+        Subproject.load_dependency_tree(dest)
+        # a new root commit doesn't touch any input of the cache...
+        git("-c", "user.name=test", "-c", "user.email=test", "commit", "-q", "--allow-empty", "-m", "new", cwd=dest)
+        with mock.patch.object(Subproject, "create_dependency_tree") as create:
+            root, _ = Subproject.load_dependency_tree(dest)
+            self.assertFalse(create.called)
+        # ...but the root URL follows it
+        self.assertEqual(GitSubproject.url_from_directory(dest), root.urlstring)
+
+    def test_tree_cache_outside_git(self):
+        # e.g. an svn root, which has no local ignore list
+        dest = join(self.tmpdir, "plain")
+        os.mkdir(dest)
+        with open(join(dest, "subprojects.quark"), "w") as f:
+            json.dump({"depends": {}}, f)
+        with mock.patch.dict(os.environ, {"QUARK_CACHE_DIR": join(self.tmpdir, "cache")}):
+            Subproject.load_dependency_tree(dest)
+            self.assertEqual(["subprojects.quark"], os.listdir(dest))
+            self.assertEqual(1, len(os.listdir(join(self.tmpdir, "cache", "trees"))))
+            with mock.patch.object(Subproject, "create_dependency_tree") as create:
+                root, modules = Subproject.load_dependency_tree(dest)
+                self.assertFalse(create.called)
+        self.assertIsNone(root.urlstring)
+        self.assertEqual({}, modules)
+
+    def test_frozen_update_skips_fetch(self):
+        dest = join(self.tmpdir, "checkout")
+        git("clone", "-q", "file://" + join(self.repos, "root"), dest)
+        generate_cmake_script(dest)
+        root, modules = Subproject.create_dependency_tree(dest)
+        with open(join(dest, freeze_file), "w") as f:
+            json.dump({name: mod.url_from_checkout() for name, mod in modules.items()}, f)
+
+        commands = []
+
+        def fork(*args, **kwargs):
+            commands.append(args[0])
+            return real_fork(*args, **kwargs)
+
+        real_fork = subproject.fork
+        # d moved away from its frozen commit, which it still has
+        git("-c", "user.name=test", "-c", "user.email=test", "commit", "-q", "--allow-empty", "-m", "local",
+            cwd=join(dest, "lib", "d"))
+        skipped = Subproject.skipped_updates
+        fetches = GitSubproject.skipped_fetches
+        with mock.patch.object(subproject, "fork", fork):
+            generate_cmake_script(dest)
+        # the others are already there, not even planned to be fetched
+        self.assertEqual(skipped + len(modules) - 1, Subproject.skipped_updates)
+        self.assertEqual(fetches + 1, GitSubproject.skipped_fetches)
+        self.assertFalse([cmd for cmd in commands if "fetch" in cmd])
+        self.assertIn("checkout", commands[-1])
+
+    def test_plan_fresh_tree(self):
+        dest = join(self.tmpdir, "checkout")
+        git("clone", "-q", "file://" + join(self.repos, "root"), dest)
+        plan = plan_update(dest)
+        # only the direct dependencies are known before cloning them
+        self.assertEqual(["a", "b", "d"], [entry["name"] for entry in plan])
+        self.assertEqual({"clone"}, {entry["action"] for entry in plan})
+        self.assertEqual(join("lib", "b"), plan[1]["directory"])
+        self.assertFalse(any(entry["provisional"] for entry in plan))
+
+    def test_plan_checked_out_tree(self):
+        dest = join(self.tmpdir, "checkout")
+        self._checkout(dest)
+        self.assertEqual({"noop"}, {entry["action"] for entry in plan_update(dest)})
+        # the branch moved on the remote
+        with open(join(self.repos, "c", "new"), "w") as f:
+            f.write("new\n")
+        git("add", "-A", cwd=join(self.repos, "c"))
+        git("-c", "user.name=test", "-c", "user.email=test", "commit", "-q", "-m", "new", cwd=join(self.repos, "c"))
+        plan = {entry["name"]: entry for entry in plan_update(dest)}
+        self.assertEqual("fetch", plan["c"]["action"])
+        self.assertEqual("noop", plan["a"]["action"])
+        self.assertTrue(plan["e"]["provisional"])
+        self.assertTrue(plan["d"]["provisional"])
+        self.assertFalse(plan["b"]["provisional"])
+
+        root, modules = Subproject.create_dependency_tree(dest)
+        with open(join(dest, freeze_file), "w") as f:
+            json.dump({name: mod.url_from_checkout() for name, mod in modules.items()}, f)
+        plan = plan_update(dest)
+        self.assertEqual(["a", "b", "c", "d", "e"], [entry["name"] for entry in plan])
+        self.assertEqual({"noop"}, {entry["action"] for entry in plan})
+        self.assertFalse(any(entry["provisional"] for entry in plan))
+
+        # the modules planned as no-op just look for local modifications,
+        # to warn about them
+        with open(join(dest, "lib", "c", "CMakeLists.txt"), "a") as f:
+            f.write("# local edit\n")
+        commands = []
+        real_run = aio.run
+
+        async def run(cmd, **kwargs):
+            commands.append(cmd)
+            return await real_run(cmd, **kwargs)
+
+        with mock.patch.object(aio, "run", run), self.assertLogs("quark.subproject", "WARNING") as logs:
+            generate_cmake_script(dest)
+        self.assertEqual([["git", "status", "--porcelain=v2", "--branch"]] * 5, commands)
+        self.assertEqual(["Directory '%s' contains local modifications" % join(dest, "lib", "c")],
+                         [record.getMessage() for record in logs.records])
+        self.assertEqual("checkout", {entry["name"]: entry for entry in plan_update(dest, clean=True)}["c"]["action"])
+
+    def test_plan_unreadable_git_dir(self):
+        dest = join(self.tmpdir, "checkout")
+        self._checkout(dest)
+        # e.g. a file removed by a concurrent git: git itself is asked instead
+        with mock.patch.object(gitdir, "symbolic_ref", side_effect=FileNotFoundError("HEAD")):
+            self.assertEqual({"noop"}, {entry["action"] for entry in plan_update(dest)})
+
+    def test_plan_tags_and_shallow(self):
+        git("-c", "user.name=test", "-c", "user.email=test", "tag", "-a", "-m", "v1", "v1", cwd=join(self.repos, "d"))
+        git("tag", "v1", cwd=join(self.repos, "e"))
+        self._make_repo("f", None)
+        self._make_repo("tags", {
+            "depends": {
+                "d": {"url": self._url("d") + "#tag=v1"},
+                "e": {"url": self._url("e") + "#tag=v1", "shallow": True},
+                "f": {"url": self._url("f") + "#branch=master", "shallow": True},
+            },
+        })
+        dest = join(self.tmpdir, "checkout")
+        git("clone", "-q", "file://" + join(self.repos, "tags"), dest)
+        generate_cmake_script(dest)
+        self.assertEqual({"noop"}, {entry["action"] for entry in plan_update(dest)})
+
+        # a shallow clone follows its branch with ls-remote, fetching only
+        # the new commit
+        with open(join(self.repos, "f", "new"), "w") as f:
+            f.write("new\n")
+        git("add", "-A", cwd=join(self.repos, "f"))
+        git("-c", "user.name=test", "-c", "user.email=test", "commit", "-q", "-m", "new", cwd=join(self.repos, "f"))
+        self.assertEqual("fetch", {entry["name"]: entry for entry in plan_update(dest)}["f"]["action"])
+        generate_cmake_script(dest)
+        self.assertTrue(os.path.exists(join(dest, "lib", "f", "new")))
+        self.assertEqual({"noop"}, {entry["action"] for entry in plan_update(dest)})
+
+    def test_shared_git_cache(self):
+        cache_dir = join(self.tmpdir, "cache")
+        with mock.patch.dict(os.environ, {"QUARK_CACHE_DIR": cache_dir, "QUARK_GIT_CACHE": "yes"}):
+            self._checkout(join(self.tmpdir, "checkout"))
+        mirrors = os.listdir(join(cache_dir, "git"))
+        self.assertEqual(5, len(mirrors))
+        for name in "abcde":
+            with open(join(self.tmpdir, "checkout", "lib", name, ".git", "objects", "info", "alternates")) as f:
+                self.assertIn(os.path.dirname(f.read().strip()).split(os.sep)[-1], mirrors)
+
+    def test_git_cache_disabled_by_default(self):
+        cache_dir = join(self.tmpdir, "cache")
+        cwd = join(self.tmpdir, "cwd")
+        os.mkdir(cwd)
+        commands = []
+        real_fork = subproject.fork
+
+        def fork(*args, **kwargs):
+            commands.append(args[0])
+            return real_fork(*args, **kwargs)
+
+        old_cwd = os.getcwd()
+        os.chdir(cwd)
+        try:
+            with mock.patch.dict(os.environ, {"QUARK_CACHE_DIR": cache_dir}), \
+                    mock.patch.object(subproject, "fork", fork):
+                os.environ.pop("QUARK_GIT_CACHE", None)
+                self._checkout(join(self.tmpdir, "checkout"))
+                os.environ["QUARK_GIT_CACHE"] = ""
+                generate_cmake_script(join(self.tmpdir, "checkout"))
+        finally:
+            os.chdir(old_cwd)
+        self.assertFalse([cmd for cmd in commands if "--reference" in cmd or "--mirror" in cmd])
+        self.assertEqual([], os.listdir(cwd))
+        self.assertFalse(os.path.exists(cache_dir))
+        for name in "abcde":
+            self.assertFalse(os.path.exists(join(self.tmpdir, "checkout", "lib", name, ".git", "objects", "info",
+                                                 "alternates")))
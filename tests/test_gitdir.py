@@ -0,0 +1,101 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+
+from quark import aio, gitdir
+from quark.subproject import GitSubproject
+
+
+def git(*args, cwd=None):
+    return subprocess.check_output(("git",) + args, cwd=cwd, stderr=subprocess.DEVNULL).decode().strip()
+
+
+class TestGitDir(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+        # Keep the user configuration out of the way
+        self.env = mock.patch.dict(os.environ, {"HOME": self.tmpdir, "XDG_CONFIG_HOME": join(self.tmpdir, ".config")})
+        self.env.start()
+        self.repo = join(self.tmpdir, "repo")
+        os.mkdir(self.repo)
+        git("-c", "init.defaultBranch=master", "init", "-q", cwd=self.repo)
+        git("remote", "add", "origin", "git@example.com:group/repo.git", cwd=self.repo)
+        for i in range(2):
+            git("-c", "user.name=test", "-c", "user.email=test", "commit", "-q", "--allow-empty", "-m", str(i),
+                cwd=self.repo)
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def assertSameAsGit(self, directory):
+        self.assertEqual(git("remote", "get-url", "origin", cwd=directory), gitdir.remote_url(directory))
+        self.assertEqual(git("rev-parse", "HEAD", cwd=directory), gitdir.head_commit(directory))
+        git_dir, _ = gitdir.find(directory)
+        # git symbolic-ref -q fails quietly in detached HEAD
+        self.assertEqual(subprocess.run(("git", "symbolic-ref", "-q", "HEAD"), cwd=directory, stdout=subprocess.PIPE)
+                         .stdout.decode().strip() or None, gitdir.symbolic_ref(git_dir))
+
+    def test_layouts(self):
+        self.assertSameAsGit(self.repo)
+        # detached HEAD
+        git("checkout", "-q", "HEAD~1", cwd=self.repo)
+        self.assertSameAsGit(self.repo)
+        # packed refs
+        git("checkout", "-q", "master", cwd=self.repo)
+        git("pack-refs", "--all", cwd=self.repo)
+        self.assertFalse(os.path.exists(join(self.repo, ".git", "refs", "heads", "master")))
+        self.assertSameAsGit(self.repo)
+        # git worktree add
+        worktree = join(self.tmpdir, "worktree")
+        git("worktree", "add", "-q", "-b", "other", worktree, "HEAD~1", cwd=self.repo)
+        self.assertTrue(os.path.isfile(join(worktree, ".git")))
+        self.assertSameAsGit(worktree)
+
+    def test_config_syntax(self):
+        with open(join(self.repo, ".git", "config"), "a") as f:
+            f.write('[remote "up\\"stream"]  # comment\n'
+                    '\turl = "/path/with spaces" ; comment\n'
+                    '\tURL = second\n'
+                    '[Custom]\n\tflag\n')
+        config = gitdir.read_config(join(self.repo, ".git", "config"))
+        self.assertEqual(["/path/with spaces", "second"], config[("remote", 'up"stream', "url")])
+        self.assertEqual([True], config[("custom", None, "flag")])
+        self.assertEqual("/path/with spaces", gitdir.remote_url(self.repo, 'up"stream'))
+        self.assertEqual("second", gitdir.remote_url(self.repo, 'up"stream', rewrite=False))
+
+    def test_unsupported(self):
+        with open(join(self.tmpdir, ".gitconfig"), "w") as f:
+            f.write('[url "https://example.com/"]\n\tinsteadOf = git@example.com:\n')
+        with self.assertRaises(gitdir.Unsupported):
+            gitdir.remote_url(self.repo)
+        # git config --get doesn't rewrite
+        self.assertEqual("git@example.com:group/repo.git", gitdir.remote_url(self.repo, rewrite=False))
+        # and the CLI gets the right answer
+        self.assertEqual("git+https://example.com/group/repo.git#commit=" + git("rev-parse", "HEAD", cwd=self.repo),
+                         GitSubproject.url_from_directory(self.repo))
+        os.unlink(join(self.tmpdir, ".gitconfig"))
+
+        git("config", "include.path", "other", cwd=self.repo)
+        with self.assertRaises(gitdir.Unsupported):
+            gitdir.remote_url(self.repo)
+        git("config", "--unset", "include.path", cwd=self.repo)
+
+        with mock.patch.dict(os.environ, {"GIT_DIR": join(self.repo, ".git")}):
+            with self.assertRaises(gitdir.Unsupported):
+                gitdir.head_commit(self.repo)
+
+        git("remote", "remove", "origin", cwd=self.repo)
+        with self.assertRaises(gitdir.Unsupported):
+            gitdir.remote_url(self.repo)
+
+    def test_url_from_directory_no_spawn(self):
+        with mock.patch.object(aio, "run", side_effect=AssertionError("git spawned")):
+            url = GitSubproject.url_from_directory(self.repo)
+            self.assertEqual(url, aio.run_sync(GitSubproject.url_from_directory_async(self.repo)))
+        self.assertEqual("git+quarkunknown:///git%40example.com%3Agroup/repo.git#commit=" +
+                         git("rev-parse", "HEAD", cwd=self.repo), url)
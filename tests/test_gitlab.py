@@ -0,0 +1,382 @@
+import hashlib
+import http.server
+import io
+import json
+import os
+import shutil
+import socketserver
+import tarfile
+import tempfile
+import threading
+import unittest
+import zipfile
+from os.path import join
+from unittest import mock
+
+from quark.gitlab import GitlabClient
+from quark.subproject import GitlabSubproject, QuarkError, Subproject
+
+CONTENT = b"#!/bin/sh\necho hello\n"
+SHA1 = hashlib.sha1(CONTENT).hexdigest()
+
+
+class TestGitlabArtifactStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+        self.env = mock.patch.dict(os.environ, {
+            "QUARK_GITLAB_PRIVATE_TOKEN": "token",
+            "QUARK_CACHE_DIR": join(self.tmpdir, "cache"),
+        })
+        self.env.start()
+        self.downloads = 0
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _fake_download(self, project, tempdir, store=None):
+        self.downloads += 1
+        os.mkdir(join(tempdir, "dl"))
+        path = join(tempdir, "dl", project.parsed_artifact_name)
+        with open(path, "wb") as f:
+            f.write(CONTENT)
+        project.stamp["sha1"] = SHA1
+        return path, False
+
+    def _update(self, name, url):
+        project = Subproject.create(name, url, join(self.tmpdir, name), {})
+        self.assertIsInstance(project, GitlabSubproject)
+        with mock.patch.object(GitlabSubproject, "_download", autospec=True, side_effect=self._fake_download):
+            project.update()
+        with open(join(project.directory, "tool.sh"), "rb") as f:
+            self.assertEqual(CONTENT, f.read())
+        return project
+
+    def test_job_artifact_served_from_store(self):
+        url = "gitlab+ci://gitlab.example.com/group/project/artifacts/bin/tool.sh#job=1234&executable=true"
+        self._update("first", url)
+        self.assertEqual(1, self.downloads)
+        second = self._update("second", url)
+        self.assertEqual(1, self.downloads)
+        self.assertEqual(SHA1, second.stamp["sha1"])
+        self.assertTrue(os.access(join(second.directory, "tool.sh"), os.X_OK))
+
+    def test_executable_copy_leaves_store_alone(self):
+        url = "gitlab+ci://gitlab.example.com/group/project/artifacts/bin/tool.sh#job=1234"
+        plain = self._update("plain", url)
+        executable = self._update("executable", url + "&executable=true")
+        self.assertEqual(1, self.downloads)
+        self.assertTrue(os.access(join(executable.directory, "tool.sh"), os.X_OK))
+        self.assertFalse(os.access(join(plain.directory, "tool.sh"), os.X_OK))
+        self.assertFalse(os.access(join(self._update("other", url).directory, "tool.sh"), os.X_OK))
+
+    def test_frozen_url_served_from_store(self):
+        self._update("first", "gitlab+package://gitlab.example.com/group/project/tool/1.0/tool.sh")
+        self._update("second", "gitlab+package://gitlab.example.com/group/project/tool/1.0/tool.sh#sha1=" + SHA1)
+        self.assertEqual(1, self.downloads)
+
+    def test_corrupted_store_entry(self):
+        url = "gitlab+ci://gitlab.example.com/group/project/artifacts/bin/tool.sh#job=1234"
+        first = self._update("first", url)
+        # hard-linked file modified in place
+        with open(join(first.directory, "tool.sh"), "ab") as f:
+            f.write(b"garbage")
+        self._update("second", url)
+        self.assertEqual(2, self.downloads)
+
+    def test_store_disabled(self):
+        url = "gitlab+ci://gitlab.example.com/group/project/artifacts/bin/tool.sh#job=1234"
+        with mock.patch.dict(os.environ, {"QUARK_ARTIFACT_CACHE": "no"}):
+            self._update("first", url)
+            self._update("second", url)
+        self.assertEqual(2, self.downloads)
+        self.assertFalse(os.path.exists(join(self.tmpdir, "cache")))
+
+
+class FakeGitlab(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    Minimal stand-in for the GitLab API, serving the routes in self.routes
+    (path -> (status, headers, body)) and recording the requests it gets.
+
+    Range requests are honored if self.ranges is set; self.truncate maps
+    paths to the sizes at which their next responses break off, self.stall
+    to the sizes at which they hang until the server stops.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeGitlabHandler)
+        self.routes = {}
+        self.requests = []
+        self.connections = set()
+        self.ranges = True
+        self.truncate = {}
+        self.stall = {}
+        self.stalled = 0
+        self.unstall = threading.Event()
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def stop(self):
+        self.unstall.set()
+        self.shutdown()
+        self.server_close()
+
+
+class FakeGitlabHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((self.path, dict(self.headers)))
+        self.server.connections.add(self.client_address)
+        status, headers, body = self.server.routes.get(self.path, (404, {}, b"not found"))
+        requested = self.headers.get("Range")
+        if status == 200 and requested and self.server.ranges and \
+                self.headers.get("If-Range", headers.get("ETag")) == headers.get("ETag"):
+            start = int(requested[len("bytes="):-1])
+            status = 206
+            headers = dict(headers)
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, len(body) - 1, len(body))
+            body = body[start:]
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        cuts = self.server.truncate.get(self.path)
+        if cuts:
+            body = body[:cuts.pop(0)]
+            self.close_connection = True
+        stalls = self.server.stall.get(self.path)
+        if stalls:
+            self.wfile.write(body[:stalls.pop(0)])
+            self.wfile.flush()
+            self.server.stalled += 1
+            self.server.unstall.wait(10)
+            self.server.stalled -= 1
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestGitlabClient(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeGitlab()
+        self.client = GitlabClient(self.server.url, "token")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def _json(self, path, data):
+        self.server.routes["/api/v4" + path] = (200, {"Content-Type": "application/json"}, json.dumps(data).encode())
+
+    def test_connections_are_reused(self):
+        self._json("/version", {"version": "1"})
+        for _ in range(5):
+            self.assertEqual({"version": "1"}, self.client.get_json("/version"))
+        self.assertEqual(5, len(self.server.requests))
+        self.assertEqual(1, len(self.server.connections))
+        self.assertEqual("token", self.server.requests[0][1]["PRIVATE-TOKEN"])
+
+    def test_redirect_and_errors(self):
+        self.server.routes["/api/v4/projects/1/jobs/2/artifacts/a.txt"] = (302, {"Location": "/storage/a.txt"}, b"")
+        self.server.routes["/storage/a.txt"] = (200, {}, CONTENT)
+        with self.client.request("/projects/1/jobs/2/artifacts/a.txt") as response:
+            self.assertEqual(CONTENT, response.read())
+        with self.assertRaises(Exception):
+            self.client.get_json("/missing")
+
+    def test_job_resolution_is_batched_per_pipeline(self):
+        self._json("/projects/group%2Fproject/pipelines?ref=main&status=success&page=1&per_page=1", [{"id": 10}])
+        self._json("/projects/group%2Fproject/pipelines/10/jobs?scope=success&include_retried=true&page=1&per_page=100",
+                   [{"name": "build-%d" % i, "id": 100 + i} for i in range(15)])
+        results = {}
+
+        def resolve(i):
+            results[i] = self.client.resolve_job_id("group/project", "main", "build-%d" % i)
+
+        threads = [threading.Thread(target=resolve, args=(i,)) for i in range(15)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual({i: str(100 + i) for i in range(15)}, results)
+        self.assertEqual(2, len(self.server.requests))
+
+
+def make_archive(fmt, files):
+    buf = io.BytesIO()
+    if fmt == "zip":
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zip:
+            for name, data in files.items():
+                zip.writestr(name, data)
+    else:
+        with tarfile.open(fileobj=buf, mode="w:" + fmt) as tar:
+            for name, data in files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+class TestGitlabExtraction(unittest.TestCase):
+    FILES = {
+        "bin/tool.sh": CONTENT,
+        "lib/a/liba.so": b"a" * 100000,
+        "lib/a/libb.so": b"b" * 100000,
+        "lib/c/libc.so": b"c" * 100000,
+        "README": b"readme\n",
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+        self.server = FakeGitlab()
+        self.env = mock.patch.dict(os.environ, {
+            "QUARK_GITLAB_PRIVATE_TOKEN": "token",
+            "QUARK_CACHE_DIR": join(self.tmpdir, "cache"),
+        })
+        self.env.start()
+        self.client = GitlabClient(self.server.url, "token")
+
+    def tearDown(self):
+        self.env.stop()
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _update(self, name, filename, archive, sha1=""):
+        self.server.routes["/api/v4/projects/group%2Fproject/jobs/1234/artifacts/" + filename] = (200, {}, archive)
+        url = "gitlab+ci://gitlab.example.com/group/project/artifacts/%s#job=1234&extract=true" % filename
+        if sha1:
+            url += "&sha1=" + sha1
+        project = Subproject.create(name, url, join(self.tmpdir, name), {})
+        project.client = self.client
+        project.update()
+        return project
+
+    def _check_extracted(self, project):
+        entries = sorted(e for e in os.listdir(project.directory) if e != ".stamp.quark")
+        self.assertEqual(["README", "bin", "lib"], entries)
+        for name, data in self.FILES.items():
+            with open(join(project.directory, name), "rb") as f:
+                self.assertEqual(data, f.read())
+
+    def test_formats(self):
+        for fmt in ("gz", "bz2", "xz", "zip"):
+            for store in ("yes", "no"):
+                with mock.patch.dict(os.environ, {"QUARK_ARTIFACT_CACHE": store}):
+                    archive = make_archive(fmt, self.FILES)
+                    filename = "pkg.zip" if fmt == "zip" else "pkg.tar." + fmt
+                    project = self._update("%s-%s" % (fmt, store), filename, archive)
+                    self._check_extracted(project)
+                    self.assertEqual(hashlib.sha1(archive).hexdigest(), project.stamp["sha1"])
+
+    def test_streamed_archive_kept_in_store(self):
+        archive = make_archive("gz", self.FILES)
+        self._update("first", "pkg.tar.gz", archive)
+        # served from the store, extracted from the file
+        self._check_extracted(self._update("second", "pkg.tar.gz", archive))
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_sha1_mismatch(self):
+        archive = make_archive("gz", self.FILES)
+        with mock.patch.dict(os.environ, {"QUARK_ARTIFACT_CACHE": "no"}):
+            with self.assertRaises(QuarkError):
+                self._update("bad", "pkg.tar.gz", archive, sha1=SHA1)
+        self.assertEqual([], os.listdir(join(self.tmpdir, "bad")))
+
+
+class TestResumableDownload(unittest.TestCase):
+    DATA = bytes(range(256)) * 400
+    PATH = "/projects/group%2Fproject/jobs/1234/artifacts/data.bin"
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+        self.server = FakeGitlab()
+        self.server.routes["/api/v4" + self.PATH] = (200, {"ETag": '"v1"'}, self.DATA)
+        self.env = mock.patch.dict(os.environ, {
+            "QUARK_GITLAB_PRIVATE_TOKEN": "token",
+            "QUARK_CACHE_DIR": join(self.tmpdir, "cache"),
+            "QUARK_DOWNLOAD_BACKOFF": "0",
+        })
+        self.env.start()
+        self.client = GitlabClient(self.server.url, "token")
+
+    def tearDown(self):
+        self.env.stop()
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def _update(self, name, sha1=""):
+        url = "gitlab+ci://gitlab.example.com/group/project/artifacts/data.bin#job=1234"
+        if sha1:
+            url += "&sha1=" + sha1
+        project = Subproject.create(name, url, join(self.tmpdir, name), {})
+        project.client = self.client
+        project.update()
+        with open(join(project.directory, "data.bin"), "rb") as f:
+            self.assertEqual(self.DATA, f.read())
+        self.assertEqual(hashlib.sha1(self.DATA).hexdigest(), project.stamp["sha1"])
+        return project
+
+    def _ranges(self):
+        return [headers.get("Range") for _, headers in self.server.requests]
+
+    def test_resume_after_truncation(self):
+        for store in ("yes", "no"):
+            self.server.requests = []
+            self.server.truncate["/api/v4" + self.PATH] = [1000, 5000]
+            with mock.patch.dict(os.environ, {"QUARK_ARTIFACT_CACHE": store}):
+                self._update("project-" + store)
+            self.assertEqual([None, "bytes=1000-", "bytes=6000-"], self._ranges())
+
+    def test_resume_in_next_run(self):
+        self.server.truncate["/api/v4" + self.PATH] = [30000]
+        with mock.patch.dict(os.environ, {"QUARK_DOWNLOAD_RETRIES": "0"}):
+            with self.assertRaises(QuarkError):
+                self._update("project")
+        self._update("project", sha1=hashlib.sha1(self.DATA).hexdigest())
+        self.assertEqual([None, "bytes=30000-"], self._ranges())
+        self.assertEqual([], os.listdir(join(self.tmpdir, "cache", "artifacts", "partial")))
+
+    def test_changed_artifact_restarts(self):
+        self.server.truncate["/api/v4" + self.PATH] = [30000]
+        with mock.patch.dict(os.environ, {"QUARK_DOWNLOAD_RETRIES": "0"}):
+            with self.assertRaises(QuarkError):
+                self._update("project")
+        self.server.routes["/api/v4" + self.PATH] = (200, {"ETag": '"v2"'}, self.DATA)
+        self._update("project")
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_server_without_ranges(self):
+        self.server.ranges = False
+        self.server.truncate["/api/v4" + self.PATH] = [1000, 5000]
+        self._update("project")
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_resume_after_stall(self):
+        self.server.stall["/api/v4" + self.PATH] = [1000]
+        with mock.patch.dict(os.environ, {"QUARK_GITLAB_TIMEOUT": "0.2"}):
+            self.client = GitlabClient(self.server.url, "token")
+        self._update("project")
+        # given up on the stalled response, which is still hanging
+        self.assertEqual(1, self.server.stalled)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_gives_up(self):
+        self.server.truncate["/api/v4" + self.PATH] = [0] * 10
+        with mock.patch.dict(os.environ, {"QUARK_DOWNLOAD_RETRIES": "2"}):
+            with self.assertRaises(QuarkError):
+                self._update("project")
+        self.assertEqual(3, len(self.server.requests))
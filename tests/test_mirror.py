@@ -0,0 +1,215 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+
+from quark import mirror, utils
+from quark.subproject import GitSubproject, SvnSubproject
+
+
+def git(*args, cwd=None):
+    subprocess.check_call(("git",) + args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def snapshot(directory):
+    """Relative path -> file content or symlink target."""
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(directory):
+        if ".git" in dirnames:
+            dirnames.remove(".git")
+        for name in filenames + [d for d in dirnames if os.path.islink(join(dirpath, d))]:
+            path = join(dirpath, name)
+            relpath = os.path.relpath(path, directory)
+            if os.path.islink(path):
+                result[relpath] = ("link", os.readlink(path))
+            else:
+                with open(path, "rb") as f:
+                    result[relpath] = f.read()
+    return result
+
+
+class TestGitMirror(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+        self.repo = join(self.tmpdir, "repo")
+        os.makedirs(join(self.repo, "src", "deep"))
+        git("-c", "init.defaultBranch=master", "init", "-q", cwd=self.repo)
+        git("remote", "add", "origin", "file:///nowhere", cwd=self.repo)
+        for relpath in ("CMakeLists.txt", join("src", "a.c"), join("src", "deep", "b.c"), "gone.txt"):
+            with open(join(self.repo, relpath), "w") as f:
+                f.write("content of %s\n" % relpath)
+        os.symlink("src/a.c", join(self.repo, "link.c"))
+        os.symlink("src", join(self.repo, "srclink"))
+        git("add", "-A", cwd=self.repo)
+        git("-c", "user.name=test", "-c", "user.email=test", "commit", "-q", "-m", "init", cwd=self.repo)
+        with open(join(self.repo, "untracked.txt"), "w") as f:
+            f.write("not mirrored\n")
+        self.expected = snapshot(self.repo)
+        del self.expected["untracked.txt"]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def mirror(self, *args):
+        dest = join(self.tmpdir, "mirror")
+        self.manifest = GitSubproject.create("repo", "git+file:///nowhere", self.repo, {}).mirror(dest, *args)
+        return snapshot(dest)
+
+    def copied(self, *args):
+        copied = []
+        real_copy_file = utils.copy_file
+
+        def copy_file(src, dst, mode):
+            copied.append(os.path.relpath(src, self.repo))
+            return real_copy_file(src, dst, mode)
+
+        with mock.patch.object(utils, "copy_file", copy_file):
+            self.assertEqual(self.expected, self.mirror(*args))
+        return sorted(copied)
+
+    def test_clean(self):
+        self.assertEqual(self.expected, self.mirror())
+
+    def test_local_modifications(self):
+        with open(join(self.repo, "src", "a.c"), "w") as f:
+            f.write("modified\n")
+        os.unlink(join(self.repo, "gone.txt"))
+        self.expected[join("src", "a.c")] = b"modified\n"
+        del self.expected["gone.txt"]
+        self.assertEqual(self.expected, self.mirror())
+        # a second mirror overwrites the first one, symlinks included
+        with open(join(self.repo, "src", "a.c"), "w") as f:
+            f.write("modified again\n")
+        self.expected[join("src", "a.c")] = b"modified again\n"
+        self.assertEqual(self.expected, self.mirror())
+
+    def test_incremental(self):
+        self.assertEqual(sorted(self.expected), self.copied({}))
+        self.assertEqual([], self.copied(self.manifest))
+
+        # touched but unchanged (e.g. switching branches back and forth)
+        os.utime(join(self.repo, "CMakeLists.txt"), (0, 0))
+        with open(join(self.repo, "src", "a.c"), "w") as f:
+            f.write("modified\n")
+        os.unlink(join(self.repo, "src", "deep", "b.c"))
+        self.expected[join("src", "a.c")] = b"modified\n"
+        del self.expected[join("src", "deep", "b.c")]
+        self.assertEqual([join("src", "a.c")], self.copied(self.manifest))
+        self.assertFalse(os.path.exists(join(self.tmpdir, "mirror", "src", "deep")))
+
+        # modified again after the previous mirror
+        with open(join(self.repo, "src", "a.c"), "w") as f:
+            f.write("modified twice\n")
+        os.utime(join(self.repo, "src", "a.c"), (1, 1))
+        self.expected[join("src", "a.c")] = b"modified twice\n"
+        self.assertEqual([join("src", "a.c")], self.copied(self.manifest))
+
+    def test_same_stat_other_blob(self):
+        self.mirror({})
+        # committed with the same size and mtime: only the blob tells
+        relpath = join("src", "a.c")
+        with open(join(self.repo, relpath), "w") as f:
+            f.write("CONTENT of %s\n" % relpath)
+        mtime = self.manifest[relpath]["mtime"]
+        os.utime(join(self.repo, relpath), ns=(mtime, mtime))
+        git("-c", "user.name=test", "-c", "user.email=test", "commit", "-q", "-a", "-m", "same size", cwd=self.repo)
+        self.expected[relpath] = ("CONTENT of %s\n" % relpath).encode()
+        self.assertEqual([relpath], self.copied(self.manifest))
+
+    def test_links(self):
+        self.mirror({}, "hardlink")
+        self.assertTrue(os.path.samefile(join(self.repo, "src", "a.c"), join(self.tmpdir, "mirror", "src", "a.c")))
+        self.assertEqual("src/a.c", os.readlink(join(self.tmpdir, "mirror", "link.c")))
+        # going back to copies must not write through the links
+        self.assertEqual(self.expected, self.mirror({}, "copy"))
+        self.assertFalse(os.path.samefile(join(self.repo, "src", "a.c"), join(self.tmpdir, "mirror", "src", "a.c")))
+        # reflinks, or copies where not supported
+        self.assertEqual(self.expected, self.mirror({}, "reflink"))
+
+    def test_run_incremental(self):
+        dest = join(self.tmpdir, "mirror")
+        argv = ["quark mirror", "--incremental", self.repo, dest]
+        with mock.patch("sys.argv", argv):
+            mirror.run()
+        self.assertEqual(self.expected, {k: v for k, v in snapshot(dest).items() if k != mirror.manifest_file})
+        self.assertEqual(sorted(self.expected), sorted(mirror.load_manifest(dest)["."]))
+        git("rm", "-q", "gone.txt", cwd=self.repo)
+        git("-c", "user.name=test", "-c", "user.email=test", "commit", "-q", "-m", "rm", cwd=self.repo)
+        del self.expected["gone.txt"]
+        with mock.patch("sys.argv", argv):
+            mirror.run()
+        self.assertEqual(self.expected, {k: v for k, v in snapshot(dest).items() if k != mirror.manifest_file})
+
+    def test_archive(self):
+        archive = join(self.tmpdir, "mirror.tar.gz")
+        with mock.patch("sys.argv", ["quark mirror", "--format", "tar.gz", "--prefix", "rel", self.repo, archive]):
+            mirror.run()
+        dest = join(self.tmpdir, "extracted")
+        with tarfile.open(archive) as tar:
+            self.assertTrue(all(name.startswith("rel/") for name in tar.getnames()))
+            tar.extractall(dest)
+        self.assertEqual(self.expected, snapshot(join(dest, "rel")))
+
+
+FAKE_SVN = """#!%s
+import json, os, sys
+with open(os.path.join(os.path.dirname(sys.argv[0]), "calls"), "a") as f:
+    f.write(json.dumps([os.getcwd()] + sys.argv[1:]) + "\\n")
+if sys.argv[1] == "info":
+    entry = '<entry kind="%%s" path="%%s"><wc-info><schedule>%%s</schedule></wc-info></entry>'
+    print("<?xml version='1.0'?><info>" + "".join(entry %% e for e in [
+        ("dir", ".", "normal"), ("file", "CMakeLists.txt", "normal"), ("dir", "src", "normal"),
+        ("dir", "src/empty", "normal"), ("file", "src/a.c", "add"), ("file", "src/gone.c", "delete"),
+        ("file", "missing.c", "normal"), ("file", "link.c", "normal")]) + "</info>")
+"""
+
+
+class TestSvnMirror(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+        self.bin = join(self.tmpdir, "bin")
+        os.mkdir(self.bin)
+        with open(join(self.bin, "svn"), "w") as f:
+            f.write(FAKE_SVN % sys.executable)
+        os.chmod(join(self.bin, "svn"), 0o755)
+        self.env = mock.patch.dict(os.environ, {"PATH": self.bin + os.pathsep + os.environ["PATH"]})
+        self.env.start()
+        self.wc = join(self.tmpdir, "wc")
+        os.makedirs(join(self.wc, "src", "empty"))
+        for relpath in ("CMakeLists.txt", join("src", "a.c"), join("src", "gone.c"), "unversioned.txt"):
+            with open(join(self.wc, relpath), "w") as f:
+                f.write("content of %s\n" % relpath)
+        os.symlink("src/a.c", join(self.wc, "link.c"))
+        self.module = SvnSubproject.create("wc", "svn://host/wc", self.wc, {})
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def calls(self):
+        with open(join(self.bin, "calls")) as f:
+            return [json.loads(line) for line in f]
+
+    def test_export(self):
+        dest = join(self.tmpdir, "mirror")
+        self.assertIsNone(self.module.mirror(dest))
+        self.assertEqual([[os.getcwd(), "export", "--quiet", "--force", "--ignore-externals", self.wc, dest]],
+                         self.calls())
+
+    def test_listing(self):
+        dest = join(self.tmpdir, "mirror")
+        manifest = self.module.mirror(dest, {})
+        self.assertEqual(["CMakeLists.txt", "link.c", join("src", "a.c")], sorted(manifest))
+        self.assertEqual({
+            "CMakeLists.txt": b"content of CMakeLists.txt\n",
+            "link.c": ("link", "src/a.c"),
+            join("src", "a.c"): b"content of %s\n" % join("src", "a.c").encode(),
+        }, snapshot(dest))
+        self.assertTrue(os.path.isdir(join(dest, "src", "empty")))
+        self.assertEqual([[self.wc, "info", "--recursive", "--xml", "."]], self.calls())
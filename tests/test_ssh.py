@@ -0,0 +1,143 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from os.path import join
+from unittest import mock
+
+from quark import aio, ssh
+from quark.utils import log_check_output
+
+# Stands for ssh: logs its options, keeps count of the sessions running at
+# the same time and plays the ControlMaster=auto protocol with plain files
+# as sockets (a master takes a while to come up, like a real handshake)
+FAKE_SSH = r'''#!%s
+import os, sys, time
+log = os.environ["FAKE_SSH_LOG"]
+args = sys.argv[1:]
+options = dict(args[i + 1].split("=", 1) for i, arg in enumerate(args) if arg == "-o")
+socket = options["ControlPath"].replace("%%C", "c0ffee")
+running = os.path.join(os.path.dirname(log), "running")
+if "-O" in args:
+    os.remove(socket)
+    role = "exit"
+elif os.path.exists(socket):
+    role = "client"
+else:
+    time.sleep(0.3)
+    try:
+        os.close(os.open(socket, os.O_CREAT | os.O_EXCL))
+        role = "master"
+    except FileExistsError:
+        sys.stderr.write("ControlSocket %%s already exists, disabling multiplexing\n" %% socket)
+        role = "race"
+marker = os.path.join(running, str(os.getpid()))
+open(marker, "w").close()
+concurrent = len(os.listdir(running))
+time.sleep(0.1)
+os.remove(marker)
+with open(log, "a") as f:
+    f.write("%%s %%d %%s\n" %% (role, concurrent, " ".join(args)))
+''' % sys.executable
+
+# Runs GIT_SSH_COMMAND through the shell, as git does
+GIT_LIKE = "import os, subprocess; subprocess.check_call(os.environ['GIT_SSH_COMMAND'] + ' example.com true', shell=True)"
+
+
+class TestSsh(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+
+    def test_host_of(self):
+        self.assertEqual("example.com", ssh.host_of("ssh://git@Example.com:2222/group/repo.git"))
+        self.assertEqual("example.com", ssh.host_of("git@example.com:group/repo.git"))
+        self.assertEqual("example.com", ssh.host_of("svn+ssh://example.com/repo/trunk@123"))
+        self.assertEqual("example.com", ssh.host_of("https://example.com/group/repo.git"))
+        self.assertIsNone(ssh.host_of("file:///srv/repo"))
+        self.assertIsNone(ssh.host_of("/srv/repo"))
+        self.assertIsNone(ssh.host_of("C:\\repos\\repo"))
+
+    def test_uses_ssh(self):
+        self.assertTrue(ssh.uses_ssh("ssh://git@example.com:2222/group/repo.git"))
+        self.assertTrue(ssh.uses_ssh("git@example.com:group/repo.git"))
+        self.assertTrue(ssh.uses_ssh("svn+ssh://example.com/repo/trunk@123"))
+        self.assertFalse(ssh.uses_ssh("https://example.com/group/repo.git"))
+        self.assertFalse(ssh.uses_ssh("svn://example.com/repo/trunk"))
+        self.assertFalse(ssh.uses_ssh("file:///srv/repo"))
+        self.assertFalse(ssh.uses_ssh("/srv/repo"))
+
+    def test_disabled(self):
+        with mock.patch.dict(os.environ, {"QUARK_SSH_MULTIPLEX": ""}):
+            self.assertIsNone(ssh.environ(host="example.com"))
+            env = {"PATH": "/bin"}
+            self.assertIs(env, ssh.environ(env, "example.com"))
+
+    @unittest.skipIf(sys.platform == "win32", "no ControlMaster on Windows")
+    def test_environ(self):
+        with mock.patch.dict(os.environ, {"QUARK_SSH_MULTIPLEX": "1", "SVN_SSH": "ssh -i key"}):
+            os.environ.pop("GIT_SSH_COMMAND", None)
+            os.environ.pop("GIT_SSH", None)
+            env = ssh.environ(host="example.com")
+            self.assertTrue(env["GIT_SSH_COMMAND"].startswith(
+                "ssh -o ControlMaster=auto -o ControlPath=%s/%%C " % ssh.host_dir("example.com")))
+            self.assertTrue(env["SVN_SSH"].startswith("ssh -i key -o ControlMaster=auto "))
+            # GIT_SSH would be overridden by GIT_SSH_COMMAND
+            self.assertNotIn("GIT_SSH_COMMAND", ssh.environ({"GIT_SSH": "plink"}, "example.com"))
+            # the commands not talking with a server are left alone
+            self.assertEqual("", log_check_output([sys.executable, "-c",
+                                                   "import os; print(os.environ.get('SVN_SSH', ''), end='')"],
+                                                  env={}, universal_newlines=True))
+        ssh.close_masters()
+
+    @unittest.skipIf(sys.platform == "win32", "no ControlMaster on Windows")
+    def test_one_master_per_host(self):
+        bindir = join(self.tmpdir, "bin")
+        os.makedirs(bindir)
+        os.makedirs(join(self.tmpdir, "running"))
+        with open(join(bindir, "ssh"), "w") as f:
+            f.write(FAKE_SSH)
+        os.chmod(join(bindir, "ssh"), 0o755)
+        log = join(self.tmpdir, "ssh.log")
+        env = {
+            "PATH": bindir + os.pathsep + os.environ["PATH"],
+            "FAKE_SSH_LOG": log,
+            "QUARK_SSH_MULTIPLEX": "1",
+            "QUARK_MAX_PER_HOST": "2",
+        }
+        # a host of its own, the semaphores and masters last for the process
+        host = "multiplexed.example.com"
+        with mock.patch.dict(os.environ, env):
+            os.environ.pop("GIT_SSH_COMMAND", None)
+            os.environ.pop("GIT_SSH", None)
+            aio.run_sync(aio.gather(*[aio.check_call([sys.executable, "-c", GIT_LIKE], host=host,
+                                                     over_ssh=True)
+                                      for i in range(6)]))
+            control = ssh.host_dir(host)
+            ssh.close_masters()
+        with open(log) as f:
+            sessions = [line.split(" ", 2) for line in f.read().splitlines()]
+        roles = [role for role, _, _ in sessions]
+        # no race to become the master, which is closed at the end
+        self.assertEqual(["client"] * 5 + ["master"], sorted(roles[:-1]))
+        self.assertEqual("exit", roles[-1])
+        self.assertLessEqual(max(int(concurrent) for _, concurrent, _ in sessions), 2)
+        for _, _, args in sessions[:-1]:
+            self.assertEqual("-o ControlMaster=auto -o ControlPath=%s/%%C -o ControlPersist=60 example.com true"
+                             % control, args)
+        self.assertFalse(os.path.exists(control))
+
+    @unittest.skipIf(sys.platform == "win32", "no ControlMaster on Windows")
+    def test_not_over_ssh(self):
+        # e.g. an https remote: limited like the others, but no master to wait
+        # for and nothing to change in the environment
+        host = "https.example.com"
+        with mock.patch.dict(os.environ, {"QUARK_SSH_MULTIPLEX": "1"}):
+            os.environ.pop("GIT_SSH_COMMAND", None)
+            out = aio.run_sync(aio.gather(*[aio.check_output(
+                [sys.executable, "-c", "import os; print(os.environ.get('GIT_SSH_COMMAND', ''), end='')"],
+                universal_newlines=True, host=host) for i in range(3)]))
+            ssh.close_masters()
+        self.assertEqual([""] * 3, out)
+        self.assertNotIn(host, aio._masters)
@@ -0,0 +1,61 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from os.path import abspath, dirname, join
+
+ROOT = dirname(dirname(abspath(__file__)))
+
+
+@unittest.skipIf(sys.version_info < (3, 7), "-X importtime requires Python 3.7")
+class TestImportTime(unittest.TestCase):
+    """
+    Keeps the startup of the command line fast: `quark query` is invoked
+    many times by build systems, so it must not import any of the modules
+    needed only by some backend. Import times are not checked, as they
+    depend too much on the machine running the tests.
+    """
+
+    HEAVY = {
+        "tarfile", "zipfile", "xml.etree.ElementTree", "http.client", "urllib.request",
+        "ssl", "hashlib", "tempfile", "quark.gitlab", "quark.subproject", "quark.treecache",
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def importtime(self, *args):
+        """
+        Runs quark with the given arguments, returning the imported modules
+        as a name -> (self time, cumulative time, nesting level) dict.
+        """
+        code = "import sys; sys.argv = ['quark'] + sys.argv[1:]\nfrom quark.cli import main\nmain()"
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code] + list(args),
+                              cwd=self.tmpdir, env=dict(os.environ, PYTHONPATH=ROOT),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(0, proc.returncode, proc.stderr)
+        modules = {}
+        for line in proc.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            self_us, cumulative_us, name = line[len("import time:"):].split("|")
+            level = (len(name) - len(name.lstrip())) // 2
+            modules[name.strip()] = (int(self_us), int(cumulative_us), level)
+        return modules
+
+    def test_query(self):
+        with open(join(self.tmpdir, "subprojects.quark"), "w") as f:
+            f.write('{"subprojects_dir": "ext"}')
+        modules = self.importtime("query", "subprojects_dir")
+        self.assertEqual(set(), self.HEAVY & set(modules))
+
+    def test_help(self):
+        # the command modules themselves don't need any backend either
+        for cmd in ("checkout", "status", "freeze", "foreach", "mirror", "update"):
+            modules = self.importtime(cmd, "--help")
+            self.assertEqual(set(), self.HEAVY & set(modules), cmd)
@@ -1,8 +1,16 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
 import typing
 import unittest
 import urllib.parse
+from os.path import join
+from unittest import mock
 
-from quark.subproject import Subproject
+from quark import aio
+from quark.subproject import SvnSubproject, Subproject
 
 
 class TestSubproject(unittest.TestCase):
@@ -30,3 +38,68 @@ class TestSubproject(unittest.TestCase):
     @staticmethod
     def _parse_fragment(url: str) -> typing.Dict[str, str]:
         return Subproject._parse_fragment(urllib.parse.urlparse(url))
+
+
+class TestSvnBatching(unittest.TestCase):
+    """svn info/st on many working copies, with a fake svn."""
+
+    def setUp(self):
+        self.commands = []
+        patcher = mock.patch.object(aio, "run", self.fake_svn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def fake_svn(self, cmd, **kwargs):
+        self.commands.append(cmd)
+        targets = cmd[3:]
+        if "/wc/bad" in targets:
+            raise subprocess.CalledProcessError(1, cmd)
+        if cmd[1] == "up":
+            return 0, None, None
+        if cmd[1] == "info":
+            xml = "<info>%s</info>" % "".join(
+                '<entry path="%s"><url>svn://host%s</url><commit revision="%d"/></entry>' % (t, t, len(t))
+                for t in targets)
+        else:
+            xml = "<status>%s</status>" % "".join(
+                '<target path="%s"><entry path="%s/f"><wc-status item="%s"/></entry></target>'
+                % (t, t, "modified" if t.endswith("dirty") else "unversioned") for t in targets)
+        return 0, xml.encode(), None
+
+    def test_one_call_per_batch(self):
+        directories = ["/wc/a", "/wc/b/", "/wc/dirty"]
+        urls = aio.run_sync(aio.gather(*[SvnSubproject.url_from_directory_async(d) for d in directories]))
+        self.assertEqual(["svn://host/wc/a@5", "svn://host/wc/b@5", "svn://host/wc/dirty@9"], urls)
+        self.assertEqual(1, len(self.commands))
+        self.assertEqual(["svn", "info", "--xml"], self.commands[0][:3])
+        self.assertEqual(["/wc/a", "/wc/b", "/wc/dirty"], sorted(self.commands[0][3:]))
+
+        edits = aio.run_sync(aio.gather(*[SvnSubproject.query_xml("st", d) for d in directories]))
+        self.assertEqual([False, False, True],
+                         [len(t.findall('./entry/wc-status[@item="modified"]')) != 0 for t in edits])
+        self.assertEqual(2, len(self.commands))
+
+    def test_bad_working_copy(self):
+        results = aio.run_sync(aio.gather(
+            *[SvnSubproject.url_from_directory_async(d, include_commit=False) for d in ("/wc/a", "/wc/bad")],
+            return_exceptions=True))
+        self.assertEqual("svn://host/wc/a", results[0])
+        self.assertIsInstance(results[1], subprocess.CalledProcessError)
+        # the batch, then each working copy on its own
+        self.assertEqual(["/wc/a", "/wc/bad"], sorted(self.commands[0][3:]))
+        self.assertEqual([["/wc/a"], ["/wc/bad"]], sorted(cmd[3:] for cmd in self.commands[1:]))
+
+    def test_update_queries_all_working_copies_at_once(self):
+        tmpdir = tempfile.mkdtemp(prefix="quark-test-")
+        self.addCleanup(shutil.rmtree, tmpdir, ignore_errors=True)
+        names = ("a", "b", "dirty")
+        for name in names:
+            os.makedirs(join(tmpdir, "lib", name, ".svn"))
+        with open(join(tmpdir, "subprojects.quark"), "w") as f:
+            json.dump({"depends": {name: {"url": "svn://host" + join(tmpdir, "lib", name)} for name in names}}, f)
+        Subproject.create_dependency_tree(tmpdir, update=True)
+        queries = [cmd for cmd in self.commands if cmd[1] != "up"]
+        self.assertEqual([["svn", "info", "--xml"], ["svn", "st", "--xml"]], sorted(cmd[:3] for cmd in queries))
+        for cmd in queries:
+            self.assertEqual([join(tmpdir, "lib", name) for name in names], cmd[3:])
+        self.assertEqual(3, len([cmd for cmd in self.commands if cmd[1] == "up"]))